@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Measure the startup of the svteaser CLI and check it stays under a budget.
+
+Workflow managers run svteaser thousands of times, so `svteaser -h` has to return without importing any of the
+heavy libraries and each `svteaser <cmd> -h` should only import what its command needs. Every invocation runs in
+a fresh interpreter and the median wall time over --repeats runs is compared with the budgets:
+
+    python benchmarks/check_startup.py
+    python benchmarks/check_startup.py --budget 0.1 --command-budget 0.5 -o startup.json
+
+Exits non-zero when an invocation is over its budget or imports a library it shouldn't.
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Check the checkout this script is in, not whatever svteaser is installed
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from truvari import setup_logging
+
+from svteaser.main import TOOLS
+
+CLI = os.path.join(REPO, "bin", "svteaser")
+
+# Libraries that are slow to import. Plain `svteaser -h` may import none of them
+HEAVY = ["pandas", "numpy", "pysam", "truvari", "acebinf"]
+# Commands that work on dataframes and may import pandas up front
+PANDAS_COMMANDS = ["aggregate"]
+
+# Runs the CLI as bin/svteaser would and records the modules it imported
+PROBE = """\
+import sys, json, runpy
+out_fn = sys.argv.pop(1)
+sys.argv[0] = {cli!r}
+try:
+    runpy.run_path({cli!r}, run_name="__main__")
+except SystemExit:
+    pass
+finally:
+    with open(out_fn, "w") as fout:
+        json.dump(sorted(sys.modules), fout)
+"""
+
+def time_cli(argv, repeats):
+    """
+    Median wall seconds of running the CLI with argv in fresh interpreters and the modules it imported
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO] + [p for p in [env.get("PYTHONPATH")] if p])
+    walls = []
+    with tempfile.NamedTemporaryFile(suffix=".json") as out_fh:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            ret = subprocess.run([sys.executable, "-c", PROBE.format(cli=CLI), out_fh.name] + argv, env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+            walls.append(time.perf_counter() - start)
+            if ret.returncode != 0:
+                logging.error(f"svteaser {' '.join(argv)} failed")
+                logging.error(ret.stderr.decode())
+                exit(1)
+        with open(out_fh.name, "r") as fh:
+            modules = json.load(fh)
+    return statistics.median(walls), modules
+
+def check_startup(args):
+    """
+    Time `svteaser -h` and every `svteaser <cmd> -h`. Returns their results and the number over budget
+    """
+    checks = [("-h", ["-h"], args.budget, HEAVY)]
+    for cmd in TOOLS:
+        forbidden = [] if cmd in PANDAS_COMMANDS else ["pandas"]
+        checks.append((cmd, [cmd, "-h"], args.command_budget, forbidden))
+
+    results = []
+    failures = 0
+    for name, argv, budget, forbidden in checks:
+        wall, modules = time_cli(argv, args.repeats)
+        imported = [lib for lib in forbidden if lib in modules]
+        passed = wall <= budget and not imported
+        failures += not passed
+        results.append({"name": name, "wall": wall, "budget": budget, "forbidden_imports": imported,
+                        "passed": passed})
+        msg = f"svteaser {' '.join(argv)}: {wall:.3f}s (budget {budget:.3f}s)"
+        if imported:
+            msg += f", imported {', '.join(imported)}"
+        (logging.info if passed else logging.error)(msg)
+    return results, failures
+
+def startup_main(args):
+    """
+    Measure CLI startup and check it's under budget
+    """
+    args = parseArgs(args)
+    results, failures = check_startup(args)
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump({"python": sys.version.split()[0], "repeats": args.repeats, "results": results}, fout,
+                      indent=4)
+        logging.info(f"Wrote {args.output}")
+    if failures:
+        logging.error(f"{failures} invocation(s) over budget")
+        exit(1)
+
+def parseArgs(args):
+    """
+    Argument parsing
+    """
+    parser = argparse.ArgumentParser(prog="check_startup", description=inspect.getdoc(sys.modules[__name__]),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Results json to write")
+    parser.add_argument("--budget", type=float, default=0.25,
+                        help="Seconds `svteaser -h` may take (%(default)s)")
+    parser.add_argument("--command-budget", type=float, default=1.0,
+                        help="Seconds each `svteaser <cmd> -h` may take (%(default)s)")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Runs of each invocation. The median is checked (%(default)s)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Verbose logging")
+    args = parser.parse_args(args)
+    setup_logging(args.debug)
+    return args
+
+if __name__ == '__main__':
+    startup_main(sys.argv[1:])
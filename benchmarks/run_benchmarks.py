@@ -0,0 +1,713 @@
+#!/usr/bin/env python
+"""
+Time and memory-profile SVTeaser's hot paths over synthetic references and SV catalogs.
+
+Every scale (--genome-size x --num-svs) gets a random reference and a catalog of non-overlapping INS/DEL
+that the cases run over. Each case runs in a fresh process after its inputs are prepared, so only the
+measured call is timed and its peak RSS isn't inflated by setup. Results are written as json:
+
+    python benchmarks/run_benchmarks.py -o before.json --genome-size 10M 100M --num-svs 1000 10000
+    python benchmarks/run_benchmarks.py -o after.json --genome-size 10M 100M --num-svs 1000 10000 \\
+        --baseline before.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+
+SURVIVOR and art_illumina are replaced by the stubs in benchmarks/stubs unless --no-stubs is given.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import inspect
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy as np
+import pysam
+from truvari import setup_logging
+
+# Benchmark the checkout this script is in, not whatever svteaser is installed
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+STUBS = os.path.join(REPO, "benchmarks", "stubs")
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+LINE_WIDTH = 60
+# Bases generated at a time when writing the reference, a multiple of the line width
+CHUNK_SIZE = LINE_WIDTH * 100000
+# Bumped when the synthetic data changes so old workspaces are regenerated
+DATA_VERSION = 1
+
+SIZE_SUFFIXES = {"k": 10**3, "m": 10**6, "g": 10**9}
+
+def parse_size(value):
+    """
+    Parse sizes like 1000, 10k, 1.5M or 3G
+    """
+    mult = SIZE_SUFFIXES.get(value[-1:].lower(), 1)
+    number = value[:-1] if mult != 1 else value
+    try:
+        return int(float(number) * mult)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size {value}")
+
+def format_size(value):
+    """
+    Shortest of the parse_size spellings for a size
+    """
+    for suffix, mult in sorted(SIZE_SUFFIXES.items(), key=lambda item: -item[1]):
+        if value >= mult and value % mult == 0:
+            return f"{value // mult}{suffix.upper()}"
+    return str(value)
+
+def chrom_lengths(genome_size, num_chroms=None):
+    """
+    Split the genome into chromosomes of decreasing length, one per 10Mb up to 24
+    """
+    if num_chroms is None:
+        num_chroms = min(24, max(1, genome_size // 10**7))
+    weights = np.arange(2 * num_chroms, num_chroms, -1, dtype=np.float64)
+    lengths = np.floor(genome_size * weights / weights.sum()).astype(np.int64)
+    lengths[0] += genome_size - lengths.sum()
+    return OrderedDict((f"chr{idx + 1}", int(length)) for idx, length in enumerate(lengths))
+
+def ref_gap(length):
+    """
+    Length of the N runs at each end of a synthetic chromosome
+    """
+    return min(10000, length // 20)
+
+def write_reference(path, lengths, seed):
+    """
+    Write a random ACGT fasta with N runs at the chromosome ends and index it
+    """
+    rng = np.random.default_rng(seed)
+    newlines = np.full((CHUNK_SIZE // LINE_WIDTH, 1), ord("\n"), dtype=np.uint8)
+    with open(path, "wb") as fout:
+        for name, length in lengths.items():
+            fout.write(f">{name}\n".encode())
+            gap = ref_gap(length)
+            for start in range(0, length, CHUNK_SIZE):
+                end = min(length, start + CHUNK_SIZE)
+                seq = BASES[rng.integers(0, 4, end - start, dtype=np.uint8)]
+                seq[:max(0, gap - start)] = ord("N")
+                seq[max(0, length - gap - start):] = ord("N")
+                full = (len(seq) // LINE_WIDTH) * LINE_WIDTH
+                lines = seq[:full].reshape(-1, LINE_WIDTH)
+                fout.write(np.hstack([lines, newlines[:len(lines)]]).tobytes())
+                if full < len(seq):
+                    fout.write(seq[full:].tobytes() + b"\n")
+    pysam.faidx(path)
+
+def place_svs(lengths, num_svs, min_size, max_size, seed):
+    """
+    Spread num_svs non-overlapping INS/DEL evenly over the N-free part of the chromosomes, one per slot.
+    Returns chrom index, 1-based position, size and is_ins arrays in reference order
+    """
+    rng = np.random.default_rng(seed)
+    chroms = list(lengths.values())
+    gaps = np.array([ref_gap(length) for length in chroms], dtype=np.int64)
+    spans = np.array(chroms, dtype=np.int64) - 2 * gaps
+    bounds = np.cumsum(spans)
+    slot = int(bounds[-1]) // max(1, num_svs)
+    if slot < 2 * max_size + 2:
+        logging.error(f"Genome is too small for {num_svs} SVs of up to {max_size}bp")
+        exit(1)
+    sizes = rng.integers(min_size, max_size + 1, num_svs)
+    is_ins = rng.random(num_svs) < 0.5
+    starts = np.arange(num_svs, dtype=np.int64) * slot + rng.integers(1, slot - sizes - 1)
+    chrom_idx = np.searchsorted(bounds, starts, side="right")
+    offsets = starts - np.concatenate(([0], bounds[:-1]))[chrom_idx]
+    # Slots straddling a chromosome end lose the SVs that would run off of it
+    keep = offsets + sizes + 1 < spans[chrom_idx]
+    if not keep.all():
+        logging.info(f"Dropped {int((~keep).sum())} SVs crossing chromosome ends")
+    return chrom_idx[keep], (gaps[chrom_idx] + offsets + 1)[keep], sizes[keep], is_ins[keep]
+
+def vcf_header(lengths, extra=""):
+    """
+    Header of the synthetic vcfs over the given contigs
+    """
+    contigs = "".join(f"##contig=<ID={name},length={length}>\n" for name, length in lengths.items())
+    return ("##fileformat=VCFv4.2\n" + contigs +
+            '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">\n'
+            '##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length of structural variant">\n' + extra +
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+
+def catalog_records(ref_path, lengths, num_svs, min_size, max_size, seed):
+    """
+    The catalog's SVs as (chrom, pos, svtype, ref, alt) with sequence resolved alleles
+    """
+    chrom_idx, positions, sizes, is_ins = place_svs(lengths, num_svs, min_size, max_size, seed)
+    rng = np.random.default_rng(seed + 1)
+    ins_seq = BASES[rng.integers(0, 4, int(sizes[is_ins].sum()), dtype=np.uint8)].tobytes().decode()
+    ins_pos = 0
+    ref = pysam.FastaFile(ref_path)
+    names = list(lengths.keys())
+    chrom = None
+    seq = ""
+    for cidx, pos, size, ins in zip(chrom_idx.tolist(), positions.tolist(), sizes.tolist(), is_ins.tolist()):
+        if names[cidx] != chrom:
+            chrom = names[cidx]
+            seq = ref.fetch(chrom)
+        if ins:
+            anchor = seq[pos - 1]
+            yield chrom, pos, "INS", anchor, anchor + ins_seq[ins_pos:ins_pos + size]
+            ins_pos += size
+        else:
+            ref_allele = seq[pos - 1:pos + size]
+            yield chrom, pos, "DEL", ref_allele, ref_allele[0]
+
+def record_line(chrom, pos, sv_id, svtype, ref_allele, alt_allele):
+    """
+    A catalog vcf record line
+    """
+    svlen = len(alt_allele) - len(ref_allele)
+    return f"{chrom}\t{pos}\t{sv_id}\t{ref_allele}\t{alt_allele}\t.\tPASS\tSVTYPE={svtype};SVLEN={svlen}\tGT\t0/1\n"
+
+def write_data(data, lengths, opts):
+    """
+    Write the catalog and the inputs derived from it
+    - catalog.vcf: the sequence resolved SVs
+    - shuffled.vcf: the catalog out of order, for sorting
+    - survivor.vcf/survivor.insertions.fa: the catalog as SURVIVOR simSV writes it
+    - regions.vcf: the catalog on chrom_start_end contigs of region_length windows
+    - comp.vcf.gz: calls resembling the catalog with missing, shifted and false SVs
+    """
+    records = list(catalog_records(data["reference"], lengths, opts["num_svs"], opts["sv_size_min"],
+                                   opts["sv_size_max"], opts["seed"]))
+    lines = [record_line(chrom, pos, f"{svtype}{idx}", svtype, ref_allele, alt_allele)
+             for idx, (chrom, pos, svtype, ref_allele, alt_allele) in enumerate(records)]
+    header = vcf_header(lengths)
+    with open(data["catalog"], "w") as fout:
+        fout.write(header)
+        fout.writelines(lines)
+
+    rng = np.random.default_rng(opts["seed"] + 2)
+    with open(data["shuffled"], "w") as fout:
+        fout.write(header)
+        fout.writelines(lines[idx] for idx in rng.permutation(len(lines)))
+
+    surv_header = vcf_header(lengths, '##INFO=<ID=END,Number=1,Type=Integer,Description="End of the SV">\n')
+    surv_header = surv_header.replace("\tSAMPLE\n", "\n")
+    with open(data["survivor_vcf"], "w") as fout, open(data["insertions"], "w") as ins_out:
+        fout.write(surv_header)
+        for idx, (chrom, pos, svtype, ref_allele, alt_allele) in enumerate(records):
+            svlen = abs(len(alt_allele) - len(ref_allele))
+            end = pos + svlen if svtype == "DEL" else pos
+            fout.write(f"{chrom}\t{pos}\t{svtype}{idx}SUR\tN\t<{svtype}>\t.\tLowQual\t"
+                       f"PRECISE;SVTYPE={svtype};SVLEN={svlen};END={end}\tGT:GL:GQ:FT:RC:DR:DV:RR:RV\t1/1\n")
+            if svtype == "INS":
+                ins_out.write(f">{chrom}_{pos}\n{alt_allele[1:]}\n")
+
+    window = opts["region_length"]
+    region_lines = []
+    contigs = OrderedDict()
+    for idx, (chrom, pos, svtype, ref_allele, alt_allele) in enumerate(records):
+        start = (pos - 1) // window * window
+        end = min(start + window, lengths[chrom])
+        name = f"{chrom}_{start}_{end}"
+        if pos + len(ref_allele) > end:
+            continue
+        contigs[name] = end - start
+        region_lines.append(record_line(name, pos - start, f"{svtype}{idx}", svtype, ref_allele, alt_allele))
+    with open(data["regions_vcf"], "w") as fout:
+        fout.write(vcf_header(contigs))
+        fout.writelines(region_lines)
+
+    # A caller that misses 10%, is off by up to 10bp on half and makes 5% false calls
+    from svteaser.utils import vcf_compress
+    slot = sum(lengths.values()) // max(1, opts["num_svs"])
+    calls = []
+    for idx, (chrom, pos, svtype, ref_allele, alt_allele) in enumerate(records):
+        draw = rng.random()
+        if draw < 0.1:
+            continue
+        if draw < 0.55:
+            pos = max(1, pos + int(rng.integers(-10, 11)))
+        calls.append((chrom, pos, record_line(chrom, pos, f"call{idx}", svtype, ref_allele, alt_allele)))
+        if draw > 0.95 and pos + slot // 2 + len(ref_allele) < lengths[chrom]:
+            pos += slot // 2
+            calls.append((chrom, pos, record_line(chrom, pos, f"false{idx}", svtype, ref_allele, alt_allele)))
+    order = {name: idx for idx, name in enumerate(lengths)}
+    calls.sort(key=lambda call: (order[call[0]], call[1]))
+    comp_vcf = data["comp"][:-len(".gz")]
+    with open(comp_vcf, "w") as fout:
+        fout.write(header)
+        fout.writelines(call[2] for call in calls)
+    vcf_compress(comp_vcf)
+    os.remove(comp_vcf)
+    return len(records)
+
+def prepare_data(workspace, genome_size, num_svs, opts):
+    """
+    Make (or reuse) a scale's synthetic reference and catalog.
+    The reference is shared by every scale with the same genome size
+    """
+    ref_dir = os.path.join(workspace, f"genome_{format_size(genome_size)}")
+    data_dir = os.path.join(ref_dir, f"svs_{format_size(num_svs)}")
+    data = {"dir": data_dir, "reference": os.path.join(ref_dir, "reference.fa"),
+            "catalog": os.path.join(data_dir, "catalog.vcf"),
+            "shuffled": os.path.join(data_dir, "shuffled.vcf"),
+            "survivor_vcf": os.path.join(data_dir, "survivor.vcf"),
+            "insertions": os.path.join(data_dir, "survivor.insertions.fa"),
+            "regions_vcf": os.path.join(data_dir, "regions.vcf"),
+            "comp": os.path.join(data_dir, "comp.vcf.gz")}
+    lengths = chrom_lengths(genome_size)
+
+    ref_params = {"version": DATA_VERSION, "genome_size": genome_size, "seed": opts["seed"]}
+    if read_marker(ref_dir) != ref_params:
+        shutil.rmtree(ref_dir, ignore_errors=True)
+        os.makedirs(ref_dir)
+        logging.info(f"Writing {format_size(genome_size)} reference")
+        write_reference(data["reference"], lengths, opts["seed"])
+        write_marker(ref_dir, ref_params)
+
+    data_params = dict(ref_params, num_svs=num_svs, sv_size_min=opts["sv_size_min"],
+                       sv_size_max=opts["sv_size_max"], region_length=opts["region_length"])
+    if read_marker(data_dir) != data_params:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        os.makedirs(data_dir)
+        logging.info(f"Writing catalog of {num_svs} SVs")
+        data_params["num_written"] = write_data(data, lengths, dict(opts, num_svs=num_svs))
+        write_marker(data_dir, data_params)
+    return data
+
+def read_marker(path):
+    """
+    Parameters a workspace directory was made with, if it was completed
+    """
+    try:
+        with open(os.path.join(path, "data.json"), "r") as fh:
+            params = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    params.pop("num_written", None)
+    return params
+
+def write_marker(path, params):
+    """
+    Mark a workspace directory as complete
+    """
+    with open(os.path.join(path, "data.json"), "w") as fout:
+        json.dump(params, fout)
+
+def sim_regions(data, opts, num_regions):
+    """
+    The regions of the generate_random_regions case
+    """
+    from svteaser.surv_sim import generate_random_regions
+    return generate_random_regions(data["reference"], opts["region_length"], num_regions, opts["seed"])
+
+def make_surv_params(out_dir, engine):
+    """
+    A surv_sim parameters file as surv_sim makes it
+    """
+    from svteaser.surv_sim import generate_surv_params, edit_surv_params
+    param_file = os.path.join(out_dir, "surv_params")
+    generate_surv_params(param_file, engine)
+    edit_surv_params(param_file)
+    return param_file
+
+def native_workdir(data, opts):
+    """
+    A surv_sim native workdir to simulate reads from, made on first use
+    """
+    from svteaser.surv_sim import process_regions
+    workdir = os.path.join(data["dir"], "native.svt")
+    if not os.path.exists(os.path.join(workdir, "data.json")):
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        regions = sim_regions(data, opts, opts["num_regions"])
+        process_regions(data["reference"], regions, workdir, make_surv_params(workdir, "native"),
+                        threads=opts["threads"], engine="native", seed=opts["seed"])
+        write_marker(workdir, {})
+    for name in os.listdir(workdir):
+        if name.startswith("sim_reads_"):
+            shutil.rmtree(os.path.join(workdir, name))
+    return workdir
+
+def known_workdir(data, opts):
+    """
+    A known_sv workdir of the catalog, made on first use
+    """
+    from svteaser.known_sv_sim import generate_altered_regions
+    workdir = os.path.join(data["dir"], "known.svt")
+    if not os.path.exists(os.path.join(workdir, "data.json")):
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        generate_altered_regions(data["reference"], data["catalog"], workdir, opts["region_length"],
+                                 opts["sv_size_max"], padding=opts["padding"], threads=opts["threads"])
+        write_marker(workdir, {})
+    return workdir
+
+def bench_params():
+    """
+    svteaser bench's default parameters
+    """
+    return {"refdist": 500, "pctsim": 0.7, "pctsize": 0.7, "pctovl": 0.0, "typeignore": False, "sizemin": 50,
+            "sizefilt": 30, "sizemax": 50000, "passonly": False, "multimatch": False}
+
+def truvari_dir(data, opts):
+    """
+    svteaser bench results of the comp calls against the known_sv workdir, made on first use
+    """
+    from svteaser.bench import bench
+    trudir = os.path.join(data["dir"], "bench_result")
+    if not os.path.exists(os.path.join(trudir, "data.json")):
+        shutil.rmtree(trudir, ignore_errors=True)
+        bench(known_workdir(data, opts), [data["comp"]], [trudir], bench_params())
+        write_marker(trudir, {})
+    return trudir
+
+# Each case prepares its inputs and returns the call to measure as (function, args, kwargs)
+
+def case_generate_random_regions(data, out_dir, opts):
+    from svteaser.surv_sim import generate_random_regions
+    return generate_random_regions, (data["reference"], opts["region_length"], opts["num_regions"], opts["seed"]), {}
+
+def case_process_regions_native(data, out_dir, opts):
+    from svteaser.surv_sim import process_regions
+    regions = sim_regions(data, opts, opts["num_regions"])
+    param_file = make_surv_params(out_dir, "native")
+    return process_regions, (data["reference"], regions, out_dir, param_file), \
+        {"threads": opts["threads"], "engine": "native", "seed": opts["seed"]}
+
+def case_process_regions_survivor(data, out_dir, opts):
+    from svteaser.surv_sim import process_regions
+    regions = sim_regions(data, opts, opts["survivor_regions"])
+    param_file = make_surv_params(out_dir, "survivor")
+    return process_regions, (data["reference"], regions, out_dir, param_file), \
+        {"threads": opts["threads"], "engine": "survivor", "batch_size": opts["batch"], "seed": opts["seed"]}
+
+def case_update_vcf(data, out_dir, opts):
+    from svteaser.vcfeditor import update_vcf
+    pysam.faidx(data["insertions"])
+    return update_vcf, (data["reference"], data["insertions"], data["survivor_vcf"],
+                        os.path.join(out_dir, "updated.vcf")), {}
+
+def case_recalibrate_vcf(data, out_dir, opts):
+    from svteaser.vcfeditor import recalibrate_vcf
+    return recalibrate_vcf, (data["reference"], data["regions_vcf"], os.path.join(out_dir, "recalibrated.vcf")), {}
+
+def case_generate_altered_regions(data, out_dir, opts):
+    from svteaser.known_sv_sim import generate_altered_regions
+    return generate_altered_regions, (data["reference"], data["catalog"], out_dir, opts["region_length"],
+                                      opts["sv_size_max"]), {"padding": opts["padding"], "threads": opts["threads"]}
+
+def case_vcf_compress(data, out_dir, opts):
+    from svteaser.utils import vcf_compress
+    vcf = os.path.join(out_dir, "shuffled.vcf")
+    shutil.copyfile(data["shuffled"], vcf)
+    return vcf_compress, (vcf,), {"threads": opts["threads"]}
+
+def case_bench(data, out_dir, opts):
+    from svteaser.bench import bench
+    os.rmdir(out_dir)
+    return bench, (known_workdir(data, opts), [data["comp"]], [out_dir], bench_params()), {}
+
+def case_liftover_vcf(data, out_dir, opts):
+    from svteaser.liftover import liftover_vcf, REGIONS_BED
+    workdir = known_workdir(data, opts)
+    in_fn = os.path.join(out_dir, "regions.calls.vcf")
+    # The workdir's SVs as calls on its region contigs
+    regions = {}
+    with pysam.TabixFile(os.path.join(workdir, REGIONS_BED)) as bed:
+        for line in bed.fetch():
+            chrom, start, end, name = line.split("\t")[:4]
+            regions.setdefault(chrom, []).append((int(start), int(end), name))
+    truth = pysam.VariantFile(os.path.join(workdir, "svteaser.sim.vcf.gz"))
+    contigs = OrderedDict((name, end - start) for chrom in regions for start, end, name in regions[chrom])
+    with open(in_fn, "w") as fout:
+        fout.write(vcf_header(contigs))
+        for chrom, chrom_regions in regions.items():
+            starts = np.array([start for start, _, _ in chrom_regions])
+            for rec in truth.fetch(chrom):
+                idx = int(np.searchsorted(starts, rec.start, side="right")) - 1
+                start, _, name = chrom_regions[idx]
+                fout.write(record_line(name, rec.pos - start, rec.id, rec.info["SVTYPE"], rec.ref, rec.alts[0]))
+    truth.close()
+    return liftover_vcf, (workdir, in_fn, os.path.join(out_dir, "lifted.vcf.gz")), \
+        {"frame": "ref", "threads": opts["threads"]}
+
+def case_parse_truvari_dir(data, out_dir, opts):
+    from svteaser.utils import parse_truvari_dir
+    return parse_truvari_dir, (truvari_dir(data, opts),), {"threads": opts["threads"], "cache": False}
+
+def case_parse_truvari_dir_cached(data, out_dir, opts):
+    from svteaser.utils import parse_truvari_dir
+    trudir = truvari_dir(data, opts)
+    parse_truvari_dir(trudir, threads=opts["threads"])
+    return parse_truvari_dir, (trudir,), {"threads": opts["threads"]}
+
+def case_sim_reads_native(data, out_dir, opts):
+    from svteaser.read_simulator import sim_reads_native_main
+    return sim_reads_native_main, (native_workdir(data, opts),), \
+        {"coverage": opts["coverage"], "readlen": opts["readlen"], "seed": opts["seed"],
+         "compress_threads": opts["threads"]}
+
+def case_sim_reads_art(data, out_dir, opts):
+    from svteaser.read_simulator import sim_reads_art
+    return sim_reads_art, (native_workdir(data, opts),), \
+        {"coverage": opts["coverage"], "readlen": opts["readlen"], "threads": opts["threads"], "seed": opts["seed"]}
+
+CASES = OrderedDict((name[len("case_"):], func) for name, func in list(globals().items())
+                    if name.startswith("case_"))
+
+def peak_rss():
+    """
+    This process' peak RSS in bytes since the last reset_peak_rss
+    """
+    try:
+        with open("/proc/self/status", "r") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def reset_peak_rss():
+    """
+    Start peak RSS tracking over, where Linux allows it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        pass
+
+def cpu_time(usage):
+    """
+    User plus system seconds
+    """
+    return usage.ru_utime + usage.ru_stime
+
+def measure(call, debug, conn):
+    """
+    Run one prepared call in this (fresh) process and send back its measurements
+    """
+    setup_logging(debug)
+    if not debug:
+        logging.getLogger().setLevel(logging.WARNING)
+    func, args, kwargs = call
+    reset_peak_rss()
+    start_rss = peak_rss()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    try:
+        func(*args, **kwargs)
+    except BaseException as e: # exit() from a failed stage is a SystemExit
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+        return
+    wall = time.perf_counter() - start
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send({"wall": wall,
+               "cpu": cpu_time(end_self) - cpu_time(start_self),
+               "children_cpu": cpu_time(end_children) - cpu_time(start_children),
+               "start_rss": start_rss,
+               "peak_rss": peak_rss(),
+               # Largest of the subprocesses (pools, SURVIVOR, art). KB on Linux
+               "children_peak_rss": end_children.ru_maxrss * (1 if sys.platform == "darwin" else 1024)})
+
+def run_case(name, data, out_dir, opts):
+    """
+    Prepare a case's inputs here and measure it in a fresh process
+    """
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    try:
+        call = CASES[name](data, out_dir, opts)
+    except Exception as e: # Older checkouts may not have everything being benchmarked
+        return {"error": f"{type(e).__name__}: {e}"}
+    ctx = multiprocessing.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=measure, args=(call, opts["debug"], send))
+    proc.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = {"error": "Benchmark process died"}
+    proc.join()
+    return result
+
+def summarize(runs):
+    """
+    Median times and largest peak RSS over repeats
+    """
+    if any("error" in run for run in runs):
+        return {"error": next(run["error"] for run in runs if "error" in run)}
+    summary = {key: statistics.median(run[key] for run in runs) for key in ["wall", "cpu", "children_cpu"]}
+    summary["peak_rss"] = max(run["peak_rss"] for run in runs)
+    summary["children_peak_rss"] = max(run["children_peak_rss"] for run in runs)
+    return summary
+
+def checkout_version():
+    """
+    git describe of the benchmarked checkout
+    """
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=REPO,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args):
+    """
+    Run every case at every scale. Returns the results document
+    """
+    opts = {key: getattr(args, key) for key in ["seed", "threads", "region_length", "survivor_regions", "batch",
+                                                 "padding", "coverage", "readlen", "sv_size_min", "sv_size_max",
+                                                 "repeats", "debug"]}
+    doc = {"version": checkout_version(), "date": datetime.now().isoformat(timespec="seconds"),
+           "host": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpus": os.cpu_count(), "stubs": not args.no_stubs},
+           "options": opts, "results": []}
+    for genome_size in args.genome_size:
+        for num_svs in args.num_svs:
+            scale = f"{format_size(genome_size)} genome, {num_svs} SVs"
+            data = prepare_data(args.workspace, genome_size, num_svs, opts)
+            case_opts = dict(opts, num_regions=args.num_regions or num_svs)
+            for name in args.cases:
+                out_dir = os.path.join(data["dir"], "cases", name)
+                runs = [run_case(name, data, out_dir, case_opts) for _ in range(args.repeats)]
+                result = dict(case=name, genome_size=genome_size, num_svs=num_svs, **summarize(runs), runs=runs)
+                doc["results"].append(result)
+                if "error" in result:
+                    logging.warning(f"{name} ({scale}) failed: {result['error']}")
+                else:
+                    logging.info(f"{name} ({scale}) {result['wall']:.2f}s wall {result['cpu']:.2f}s cpu "
+                                 f"{result['peak_rss'] / 2**20:.0f}MB peak RSS")
+                shutil.rmtree(out_dir, ignore_errors=True)
+    return doc
+
+def compare(baseline, current, tolerance):
+    """
+    Print each case's wall time and peak RSS against the baseline's.
+    Returns the number of cases slower or larger than the baseline by more than the tolerance
+    """
+    key = lambda result: (result["case"], result["genome_size"], result["num_svs"])
+    old = {key(result): result for result in baseline["results"] if "error" not in result}
+    print(f"# {baseline['version']} -> {current['version']}")
+    print("case\tgenome_size\tnum_svs\twall_old\twall_new\twall_ratio\trss_old\trss_new\trss_ratio\tstatus")
+    regressions = 0
+    for result in current["results"]:
+        prev = old.get(key(result))
+        if prev is None or "error" in result:
+            continue
+        wall_ratio = result["wall"] / max(prev["wall"], 1e-9)
+        rss_ratio = result["peak_rss"] / max(prev["peak_rss"], 1)
+        status = "ok"
+        if wall_ratio > 1 + tolerance or rss_ratio > 1 + tolerance:
+            status = "REGRESSION"
+            regressions += 1
+        print(f"{result['case']}\t{format_size(result['genome_size'])}\t{result['num_svs']}\t"
+              f"{prev['wall']:.3f}\t{result['wall']:.3f}\t{wall_ratio:.2f}\t"
+              f"{prev['peak_rss'] / 2**20:.1f}\t{result['peak_rss'] / 2**20:.1f}\t{rss_ratio:.2f}\t{status}")
+    return regressions
+
+def load_results(fn):
+    """
+    Read a results json
+    """
+    with open(fn, "r") as fh:
+        return json.load(fh)
+
+def benchmarks_main(args):
+    """
+    Time and memory-profile SVTeaser's hot paths over synthetic data
+    """
+    args = parseArgs(args)
+    if args.compare:
+        regressions = compare(load_results(args.compare[0]), load_results(args.compare[1]), args.tolerance)
+        exit(1 if regressions else 0)
+    if not args.output:
+        logging.error("An --output results json is needed")
+        exit(1)
+    if not args.no_stubs:
+        os.environ["PATH"] = STUBS + os.pathsep + os.environ["PATH"]
+
+    temp_workspace = args.workspace is None
+    if temp_workspace:
+        args.workspace = tempfile.mkdtemp(prefix="svteaser_benchmarks_")
+    try:
+        doc = run_benchmarks(args)
+    finally:
+        if temp_workspace:
+            shutil.rmtree(args.workspace)
+    with open(args.output, "w") as fout:
+        json.dump(doc, fout, indent=4)
+    logging.info(f"Wrote {args.output}")
+    if args.baseline and compare(load_results(args.baseline), doc, args.tolerance):
+        exit(1)
+
+def parseArgs(args):
+    """
+    Argument parsing
+    """
+    parser = argparse.ArgumentParser(prog="run_benchmarks", description=inspect.getdoc(sys.modules[__name__]),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-o", "--output", type=str,
+                        help="Results json to write")
+    parser.add_argument("--genome-size", type=parse_size, nargs="+", default=[parse_size("10M")],
+                        help="Synthetic reference sizes, e.g. 1M 100M 3G (10M)")
+    parser.add_argument("--num-svs", type=parse_size, nargs="+", default=[1000],
+                        help="SV catalog sizes, e.g. 10 1k 1M (%(default)s)")
+    parser.add_argument("--cases", type=str, nargs="+", default=list(CASES), choices=list(CASES), metavar="CASE",
+                        help="Cases to run, from: %(choices)s (all)")
+    parser.add_argument("--workspace", type=str, default=None,
+                        help="Directory to keep the synthetic data in for reuse across runs (temporary)")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="Times to run each case. Reports the median time (%(default)s)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Threads given to each case (%(default)s)")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="Seed of the synthetic data and simulations (%(default)s)")
+    parser.add_argument("--num-regions", type=int, default=None,
+                        help="Regions for surv_sim's cases (one per SV)")
+    parser.add_argument("--survivor-regions", type=int, default=10,
+                        help="Regions for the SURVIVOR engine case, which runs SURVIVOR per region (%(default)s)")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="Regions per SURVIVOR call (%(default)s)")
+    parser.add_argument("--region-length", type=int, default=10000,
+                        help="Length of the simulated regions (%(default)s)")
+    parser.add_argument("--padding", type=int, default=800,
+                        help="known_sv region padding (%(default)s)")
+    parser.add_argument("--sv-size-min", type=int, default=50,
+                        help="Smallest catalog SV (%(default)s)")
+    parser.add_argument("--sv-size-max", type=int, default=1000,
+                        help="Largest catalog SV (%(default)s)")
+    parser.add_argument("--coverage", type=float, default=1,
+                        help="Read simulation coverage (%(default)s)")
+    parser.add_argument("--readlen", type=int, default=150,
+                        help="Simulated read length (%(default)s)")
+    parser.add_argument("--no-stubs", action="store_true",
+                        help="Use the SURVIVOR and art_illumina in the PATH instead of the stubs")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Results json to compare this run against")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BASELINE", "RESULTS"),
+                        help="Only compare two results jsons")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slowdown or RSS growth over the baseline reported as a regression (%(default)s)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Verbose logging")
+    args = parser.parse_args(args)
+    setup_logging(args.debug)
+    return args
+
+if __name__ == '__main__':
+    benchmarks_main(sys.argv[1:])
@@ -14,11 +14,4 @@ fi
 
 surv_sim_dir=$1
 
-coverage=(10 20 30)
-insert_frag=(400 600)
-
-for cov in ${coverage[@]}; do
-    for insert in ${insert_frag[@]}; do
-        svteaser sim_reads --coverage $cov --mean-frag $insert $surv_sim_dir  
-    done
-done
+svteaser sweep --coverage 10 20 30 --mean-frag 400 600 $surv_sim_dir
@@ -0,0 +1,150 @@
+"""
+Collect every truvari result under a directory tree into one dataset tagged with sweep parameters
+"""
+import os
+import inspect
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from truvari import setup_logging
+
+from svteaser.utils import (TRUVARI_STATES, parse_truvari_dir, save_columns, load_columns, szbintype,
+                            svtype_names, svtypes_from_names)
+from svteaser.downsample import parse_sim_reads_dirname
+from svteaser.metrics import stage, add_metrics_args, start_metrics
+
+SWEEP_PARAMS = ["coverage", "read_len", "mean_frag", "insert_sd", "instrument"]
+
+def find_truvari_dirs(root):
+    """
+    Every directory under root holding a truvari summary.txt and state vcfs
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if "summary.txt" in filenames and all(state + ".vcf.gz" in filenames for state in TRUVARI_STATES):
+            found.append(dirpath)
+    return found
+
+def run_params(root, trudir):
+    """
+    Tags for a truvari directory: its path relative to root, the .svt workdir and the sim_reads
+    parameters of the directories it's under
+    """
+    run = os.path.relpath(trudir, root)
+    # Runs outside of a sim_reads directory get NaN/empty parameters
+    params = {"run": run, "workdir": "", "coverage": np.nan, "read_len": np.nan, "mean_frag": np.nan,
+              "insert_sd": np.nan, "instrument": ""}
+    for part in run.split(os.sep):
+        if part.endswith(".svt"):
+            params["workdir"] = part
+        try:
+            params.update(zip(SWEEP_PARAMS, parse_sim_reads_dirname(part)))
+        except ValueError:
+            pass
+    return params
+
+def load_run(root, trudir):
+    """
+    Load a truvari directory's variants and performance, tagged with its parameters
+    """
+    params = run_params(root, trudir)
+    df, perf = parse_truvari_dir(trudir, threads=1)
+    for param, value in params.items():
+        df[param] = value
+        perf[param] = value
+    return df, perf
+
+def count_table(df):
+    """
+    Number of variants per run x svtype x size bin x state
+    """
+    keys = ["run"] + SWEEP_PARAMS + ["svtype", "szbin", "state"]
+    df = df.assign(svtype=svtype_names(df["svtype"]))
+    return df.groupby(keys, observed=True, dropna=False)["cnt"].sum().reset_index()
+
+def write_dataset(runs, out_dir):
+    """
+    Write one partition of variants per run plus the counts and performance tables
+    """
+    os.makedirs(os.path.join(out_dir, "partitions"))
+    tables = []
+    perfs = []
+    for idx, (df, perf) in enumerate(runs):
+        cols = {}
+        for col in df.columns:
+            values = df[col].to_numpy()
+            if col == "szbin":
+                values = df[col].cat.codes.to_numpy()
+            elif col == "svtype":
+                values = svtype_names(values)
+            elif df[col].dtype.kind not in "biuf":
+                values = values.astype(str).astype(object)
+            cols[col] = values
+        save_columns(os.path.join(out_dir, "partitions", f"part-{idx:05d}.npz"), cols)
+        tables.append(count_table(df))
+        perfs.append(perf)
+    runs_table = pd.concat(perfs, ignore_index=True) if perfs else pd.DataFrame()
+    runs_table.to_csv(os.path.join(out_dir, "performance.tsv"), sep="\t", index=False)
+    counts = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    counts.to_csv(os.path.join(out_dir, "counts.tsv"), sep="\t", index=False)
+
+def load_aggregate(out_dir, runs=None):
+    """
+    Load an aggregate dataset's variants as one DataFrame, optionally only the partitions of the given runs
+    """
+    part_dir = os.path.join(out_dir, "partitions")
+    frames = []
+    for name in sorted(os.listdir(part_dir)):
+        cols = load_columns(os.path.join(part_dir, name))
+        if runs is not None and (not len(cols["run"]) or cols["run"][0] not in runs):
+            continue
+        df = pd.DataFrame(cols)
+        df["svtype"] = svtypes_from_names(cols["svtype"])
+        df["szbin"] = pd.Categorical.from_codes(cols["szbin"].astype(np.int64), dtype=szbintype())
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def aggregate_main(args):
+    """
+    Aggregate truvari results across a sweep
+    """
+    args = parseArgs(args)
+    # Partitions left by an earlier run would be loaded along with this run's
+    if os.path.exists(args.output):
+        logging.error(f"Output directory {args.output} already exists")
+        exit(1)
+    start_metrics(args, "aggregate", args.output)
+    with stage("find"):
+        trudirs = find_truvari_dirs(args.root)
+    if not trudirs:
+        logging.error(f"No truvari results under {args.root}")
+        exit(1)
+    logging.info(f"Loading {len(trudirs)} truvari results")
+    with stage("load"), ProcessPoolExecutor(max(1, args.threads)) as pool:
+        runs = list(pool.map(load_run, [args.root] * len(trudirs), trudirs))
+    with stage("write"):
+        write_dataset(runs, args.output)
+    logging.info(f"Wrote {sum(len(df) for df, _ in runs)} variants to {args.output}")
+    logging.info("Finished")
+
+def parseArgs(args):
+    """
+    Argument parsing
+    """
+    parser = argparse.ArgumentParser(prog="aggregate", description=inspect.getdoc(aggregate_main),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("root", metavar="DIR", type=str,
+                        help="Directory to search for truvari results")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Output directory of the aggregated dataset")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of results to load in parallel (%(default)s)")
+    add_metrics_args(parser)
+    args = parser.parse_args(args)
+    setup_logging()
+    return args
@@ -0,0 +1,494 @@
+"""
+Benchmark SV calls against a workdir's simulated SVs, only looking at calls inside the simulated regions.
+Writes the same tp-base/tp-call/fp/fn vcfs and summary.txt as truvari bench
+"""
+import os
+import json
+import inspect
+import logging
+import argparse
+import multiprocessing
+
+import numpy as np
+import pysam
+from truvari import setup_logging
+
+from svteaser.utils import vcf_compress
+from svteaser.liftover import REGIONS_BED
+from svteaser.metrics import stage, add_metrics_args, start_metrics
+
+try:
+    import edlib
+except ImportError:
+    edlib = None
+
+# INFO fields put on true positives, named as truvari names them
+BENCH_INFO = ['##INFO=<ID=TruScore,Number=1,Type=Float,Description="Truvari score for similarity of match">',
+              '##INFO=<ID=PctSeqSimilarity,Number=1,Type=Float,Description="Pct sequence similarity between this variant and its closest match">',
+              '##INFO=<ID=PctSizeSimilarity,Number=1,Type=Float,Description="Pct size similarity between this variant and its closest match">',
+              '##INFO=<ID=PctRecOverlap,Number=1,Type=Float,Description="Percent reciprocal overlap percent of the two calls\' coordinates">',
+              '##INFO=<ID=StartDistance,Number=1,Type=Integer,Description="Distance of this call\'s start from comparison call\'s start">',
+              '##INFO=<ID=EndDistance,Number=1,Type=Integer,Description="Distance of this call\'s end from comparison call\'s end">',
+              '##INFO=<ID=SizeDiff,Number=1,Type=Float,Description="Difference in size(basecall) and size(evalcall)">',
+              '##INFO=<ID=NumNeighbors,Number=1,Type=Integer,Description="Number of calls in B that were in the neighborhood (REFDIST) of this call">',
+              '##INFO=<ID=NumThresholdNeighbors,Number=1,Type=Integer,Description="Number of calls in B that are within threshold distances of this call">',
+              '##INFO=<ID=MatchId,Number=1,Type=Integer,Description="Truvari uid to help tie tp-base.vcf and tp-call.vcf entries together">']
+
+BENCH_STATES = ["tp-base", "tp-call", "fp", "fn"]
+
+def parse_region_name(name):
+    """
+    (chrom, start, end) of a chrom_start_end region contig, or None if name isn't one
+    """
+    parts = name.rsplit("_", 2)
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return parts[0], int(parts[1]), int(parts[2])
+
+def load_regions(workdir):
+    """
+    The workdir's simulated regions, merged where they overlap. They're read from the region bed, or
+    from the truth vcf's chrom_start_end contigs for workdirs without one.
+    Returns {chrom: (starts, ends)} sorted arrays
+    """
+    by_chrom = {}
+    bed_fn = os.path.join(workdir, REGIONS_BED)
+    if os.path.exists(bed_fn):
+        with pysam.TabixFile(bed_fn) as bed:
+            for line in bed.fetch():
+                chrom, start, end, _ = line.split("\t", 3)
+                by_chrom.setdefault(chrom, []).append((int(start), int(end)))
+    else:
+        with pysam.VariantFile(os.path.join(workdir, "svteaser.sim.vcf.gz")) as vcf:
+            for name in vcf.header.contigs:
+                region = parse_region_name(name)
+                if region is not None:
+                    by_chrom.setdefault(region[0], []).append(region[1:])
+    regions = {}
+    for chrom, spans in by_chrom.items():
+        starts, ends = [], []
+        for start, end in sorted(spans):
+            if starts and start < ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        regions[chrom] = (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+    return regions
+
+def sv_info(rec):
+    """
+    (svtype, start, end, size, sequence) of a record. The sequence is the inserted or deleted bases,
+    None for symbolic alleles
+    """
+    ref = rec.ref
+    alt = rec.alts[0] if rec.alts else ""
+    symbolic = alt.startswith("<") or "[" in alt or "]" in alt
+    if "SVTYPE" in rec.info:
+        svtype = rec.info["SVTYPE"]
+    else:
+        svtype = "INS" if len(alt) > len(ref) else "DEL"
+    if "SVLEN" in rec.info:
+        size = rec.info["SVLEN"]
+        size = abs(size[0] if isinstance(size, tuple) else size)
+    elif symbolic:
+        size = rec.stop - rec.start
+    else:
+        size = abs(len(alt) - len(ref))
+    seq = None
+    if not symbolic:
+        seq = alt[1:] if len(alt) > len(ref) else ref[1:]
+    return svtype, rec.start, rec.stop, size, seq
+
+def is_pass(rec):
+    """
+    Check the record has no FILTER or only PASS
+    """
+    return not rec.filter.keys() or list(rec.filter.keys()) == ["PASS"]
+
+def load_variants(vcf, regions, params, base):
+    """
+    Every variant in the regions as per-chromosome columns, plus the number outside the size range.
+    Variants spanning several regions are only taken once.
+    Base variants are kept at sizemin and up, calls at sizefilt and up, though only those at sizemin and up
+    are counted (calls between sizefilt and sizemin can still match)
+    """
+    min_size = params["sizemin"] if base else params["sizefilt"]
+    indexed = vcf.index is not None
+    variants = {}
+    num_filtered = 0
+
+    def add(rec, cols):
+        nonlocal num_filtered
+        if params["passonly"] and not is_pass(rec):
+            return
+        svtype, start, end, size, seq = sv_info(rec)
+        if size < min_size or size > params["sizemax"]:
+            num_filtered += 1
+            return
+        cols["svtype"].append(svtype)
+        cols["start"].append(start)
+        cols["end"].append(end)
+        cols["size"].append(size)
+        cols["seq"].append(seq)
+        cols["line"].append(str(rec))
+
+    for chrom in regions:
+        variants[chrom] = {"svtype": [], "start": [], "end": [], "size": [], "seq": [], "line": []}
+    if indexed:
+        for chrom, (starts, ends) in regions.items():
+            if chrom not in vcf.index:
+                continue
+            for idx, (start, end) in enumerate(zip(starts, ends)):
+                for rec in vcf.fetch(chrom, int(start), int(end)):
+                    # Only in the first region it overlaps
+                    if np.searchsorted(ends, rec.start, side="right") == idx:
+                        add(rec, variants[chrom])
+    else:
+        for rec in vcf:
+            if rec.chrom not in regions:
+                continue
+            starts, ends = regions[rec.chrom]
+            idx = np.searchsorted(ends, rec.start, side="right")
+            if idx < len(starts) and starts[idx] < rec.stop:
+                add(rec, variants[rec.chrom])
+    for cols in variants.values():
+        for col in ["start", "end", "size"]:
+            cols[col] = np.array(cols[col], dtype=np.int64)
+    return variants, num_filtered
+
+def edit_distance(seq_a, seq_b):
+    """
+    Levenshtein distance of two sequences for when edlib isn't installed.
+    Each row of the table is built with numpy, folding in the insertions with a running minimum
+    """
+    if len(seq_a) > len(seq_b):
+        seq_a, seq_b = seq_b, seq_a
+    codes_b = np.frombuffer(seq_b.encode(), dtype=np.uint8)
+    cols = np.arange(len(seq_b) + 1)
+    row = cols.copy()
+    for idx, base in enumerate(seq_a.encode(), 1):
+        new = np.empty_like(row)
+        new[0] = idx
+        new[1:] = np.minimum(row[1:] + 1, row[:-1] + (codes_b != base))
+        row = np.minimum.accumulate(new - cols) + cols
+    return int(row[-1])
+
+def seq_similarity(seq_a, seq_b):
+    """
+    1 - edit distance / longest length of two sequences
+    """
+    if not seq_a and not seq_b:
+        return 1.0
+    if edlib is not None:
+        distance = edlib.align(seq_a, seq_b)["editDistance"]
+    else:
+        distance = edit_distance(seq_a, seq_b)
+    return 1 - distance / max(len(seq_a), len(seq_b))
+
+def compare(base, b_idx, calls, c_idx, params):
+    """
+    Match stats between a base and call variant, or None if they aren't within the thresholds.
+    Sequence similarity is skipped when either is symbolic
+    """
+    if not params["typeignore"] and base["svtype"][b_idx] != calls["svtype"][c_idx]:
+        return None
+    b_size, c_size = base["size"][b_idx], calls["size"][c_idx]
+    size_sim = min(b_size, c_size) / max(b_size, c_size) if max(b_size, c_size) else 1.0
+    if size_sim < params["pctsize"]:
+        return None
+    b_start, b_end = base["start"][b_idx], base["end"][b_idx]
+    c_start, c_end = calls["start"][c_idx], calls["end"][c_idx]
+    overlap = max(0, min(b_end, c_end) - max(b_start, c_start))
+    rec_overlap = overlap / max(b_end - b_start, c_end - c_start, 1)
+    if rec_overlap < params["pctovl"]:
+        return None
+    seq_sim = np.nan
+    b_seq, c_seq = base["seq"][b_idx], calls["seq"][c_idx]
+    if params["pctsim"] > 0 and b_seq is not None and c_seq is not None:
+        seq_sim = seq_similarity(b_seq, c_seq)
+        if seq_sim < params["pctsim"]:
+            return None
+    score = 100 * np.nanmean([seq_sim, size_sim, rec_overlap])
+    return {"TruScore": score, "PctSeqSimilarity": seq_sim, "PctSizeSimilarity": size_sim,
+            "PctRecOverlap": rec_overlap, "StartDistance": int(b_start - c_start),
+            "EndDistance": int(b_end - c_end), "SizeDiff": int(b_size - c_size)}
+
+def match_chrom(base, calls, params):
+    """
+    Pair up one chromosome's base and call variants within refdist of each other, best TruScore first.
+    Each variant is used once unless multimatch.
+    Returns the matches as (base idx, call idx, stats) and the per variant neighbor counts
+    """
+    refdist = params["refdist"]
+    base_neigh = np.zeros(len(base["start"]), dtype=np.int64)
+    base_thresh = np.zeros(len(base["start"]), dtype=np.int64)
+    call_neigh = np.zeros(len(calls["start"]), dtype=np.int64)
+    call_thresh = np.zeros(len(calls["start"]), dtype=np.int64)
+    candidates = []
+    if len(base["start"]) and len(calls["start"]):
+        order = np.argsort(base["start"], kind="stable")
+        sorted_starts = base["start"][order]
+        max_span = int((base["end"] - base["start"]).max())
+        for c_idx in range(len(calls["start"])):
+            c_start, c_end = calls["start"][c_idx], calls["end"][c_idx]
+            lo = np.searchsorted(sorted_starts, c_start - refdist - max_span, side="left")
+            hi = np.searchsorted(sorted_starts, c_end + refdist, side="right")
+            for b_idx in order[lo:hi]:
+                if base["start"][b_idx] - refdist > c_end or c_start > base["end"][b_idx] + refdist:
+                    continue
+                base_neigh[b_idx] += 1
+                call_neigh[c_idx] += 1
+                stats = compare(base, b_idx, calls, c_idx, params)
+                if stats is None:
+                    continue
+                base_thresh[b_idx] += 1
+                call_thresh[c_idx] += 1
+                candidates.append((-stats["TruScore"], int(b_idx), c_idx, stats))
+    candidates.sort(key=lambda cand: cand[:3])
+    matches = []
+    used_base = set()
+    used_call = set()
+    for _, b_idx, c_idx, stats in candidates:
+        if not params["multimatch"] and (b_idx in used_base or c_idx in used_call):
+            continue
+        if params["multimatch"] and b_idx in used_base and c_idx in used_call:
+            continue
+        used_base.add(b_idx)
+        used_call.add(c_idx)
+        matches.append((b_idx, c_idx, stats))
+    return matches, (base_neigh, base_thresh), (call_neigh, call_thresh)
+
+def annotate(line, values):
+    """
+    Append KEY=value INFO fields to a vcf record line. NaN values are written as missing
+    """
+    fields = line.rstrip("\n").split("\t")
+    items = []
+    for key, value in values.items():
+        if isinstance(value, float):
+            value = "." if np.isnan(value) else "%.6g" % value
+        items.append(f"{key}={value}")
+    fields[7] = ";".join(items) if fields[7] == "." else fields[7] + ";" + ";".join(items)
+    return "\t".join(fields) + "\n"
+
+def bench_header(header):
+    """
+    The vcf header text with the bench INFO fields added
+    """
+    lines = str(header).rstrip("\n").split("\n")
+    present = {line.split(",")[0] for line in lines if line.startswith("##INFO=<ID=")}
+    extra = [line for line in BENCH_INFO if line.split(",")[0] not in present]
+    return "\n".join(lines[:-1] + extra + lines[-1:]) + "\n"
+
+def write_state(out_dir, state, header, lines, threads=1):
+    """
+    Write a state's record lines to a sorted, indexed vcf.gz
+    """
+    out_fn = os.path.join(out_dir, state + ".vcf")
+    with open(out_fn, "w") as fout:
+        fout.write(header)
+        fout.writelines(lines)
+    vcf_compress(out_fn, threads=threads)
+    os.remove(out_fn)
+
+def safe_div(num, denom):
+    """
+    num / denom, or 0 when denom is 0
+    """
+    return num / denom if denom else 0
+
+def bench_vcf(truth, comp_fn, out_dir, params):
+    """
+    Benchmark one caller vcf against the loaded truth, writing its results to out_dir.
+    Returns the summary
+    """
+    regions, base_header, base_vars, base_filtered = truth
+    os.mkdir(out_dir)
+    comp = pysam.VariantFile(comp_fn)
+    call_header = bench_header(comp.header)
+    call_vars, call_filtered = load_variants(comp, regions, params, base=False)
+    comp.close()
+
+    out = {state: [] for state in BENCH_STATES}
+    match_id = 0
+    for chrom in regions:
+        base = base_vars[chrom]
+        calls = call_vars[chrom]
+        matches, (base_neigh, base_thresh), (call_neigh, call_thresh) = match_chrom(base, calls, params)
+        base_matched = set()
+        call_matched = set()
+        for b_idx, c_idx, stats in matches:
+            match_id += 1
+            if b_idx not in base_matched:
+                base_matched.add(b_idx)
+                out["tp-base"].append(annotate(base["line"][b_idx], dict(stats, NumNeighbors=base_neigh[b_idx],
+                                                                         NumThresholdNeighbors=base_thresh[b_idx],
+                                                                         MatchId=match_id)))
+            if c_idx not in call_matched:
+                call_matched.add(c_idx)
+                out["tp-call"].append(annotate(calls["line"][c_idx], dict(stats, NumNeighbors=call_neigh[c_idx],
+                                                                          NumThresholdNeighbors=call_thresh[c_idx],
+                                                                          MatchId=match_id)))
+        for b_idx, line in enumerate(base["line"]):
+            if b_idx not in base_matched:
+                out["fn"].append(line)
+        for c_idx, line in enumerate(calls["line"]):
+            # Unmatched calls under sizemin aren't false positives
+            if c_idx not in call_matched and calls["size"][c_idx] >= params["sizemin"]:
+                out["fp"].append(line)
+
+    for state in BENCH_STATES:
+        header = base_header if state in ("tp-base", "fn") else call_header
+        write_state(out_dir, state, header, out[state])
+
+    tp_base, tp_call, fp, fn = (len(out[state]) for state in BENCH_STATES)
+    precision = safe_div(tp_call, tp_call + fp)
+    recall = safe_div(tp_base, tp_base + fn)
+    summary = {"TP-base": tp_base,
+               "TP-call": tp_call,
+               "FP": fp,
+               "FN": fn,
+               "precision": precision,
+               "recall": recall,
+               "f1": safe_div(2 * precision * recall, precision + recall),
+               "base cnt": tp_base + fn,
+               "call cnt": tp_call + fp,
+               "base size filtered": base_filtered,
+               "call size filtered": call_filtered}
+    with open(os.path.join(out_dir, "summary.txt"), "w") as fout:
+        json.dump(summary, fout, indent=4)
+    with open(os.path.join(out_dir, "params.json"), "w") as fout:
+        json.dump(dict(params, comp=os.path.abspath(comp_fn)), fout, indent=4)
+    return summary
+
+def load_truth(workdir, params):
+    """
+    The workdir's simulated regions, truth vcf header and truth variants
+    """
+    base_fn = os.path.join(workdir, "svteaser.sim.vcf.gz")
+    regions = load_regions(workdir)
+    if not regions:
+        logging.error(f"No simulated regions found in {workdir}")
+        exit(1)
+    base = pysam.VariantFile(base_fn)
+    base_header = bench_header(base.header)
+    base_vars, base_filtered = load_variants(base, regions, params, base=True)
+    base.close()
+    return regions, base_header, base_vars, base_filtered
+
+# Truth shared by the pool's workers
+_TRUTH = {}
+
+def _init_worker(truth, params):
+    """
+    Give each worker the truth index once
+    """
+    _TRUTH["truth"] = truth
+    _TRUTH["params"] = params
+
+def _bench_worker(job):
+    """
+    Pool entry point for bench_vcf. job is the caller vcf and its output directory
+    """
+    return bench_vcf(_TRUTH["truth"], *job, _TRUTH["params"])
+
+def bench(workdir, comps, out_dirs, params, threads=1):
+    """
+    Benchmark each caller vcf into its output directory, up to threads at a time.
+    Returns the summaries
+    """
+    with stage("load_truth"):
+        truth = load_truth(workdir, params)
+    num_regions = sum(len(starts) for starts, _ in truth[0].values())
+    num_base = sum(len(cols["line"]) for cols in truth[2].values())
+    logging.info(f"Loaded {num_base} truth variants in {num_regions} regions")
+    jobs = list(zip(comps, out_dirs))
+    with stage("compare"):
+        if threads > 1 and len(jobs) > 1:
+            with multiprocessing.Pool(min(threads, len(jobs)), initializer=_init_worker,
+                                      initargs=(truth, params)) as pool:
+                return pool.map(_bench_worker, jobs, chunksize=1)
+        return [bench_vcf(truth, comp, out_dir, params) for comp, out_dir in jobs]
+
+def comp_dirnames(comps):
+    """
+    A unique output subdirectory name per caller vcf
+    """
+    names = []
+    for comp in comps:
+        name = os.path.basename(comp)
+        for ext in [".gz", ".vcf"]:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        if name in names:
+            name = f"{name}_{len(names)}"
+        names.append(name)
+    return names
+
+def bench_main(args):
+    """
+    Benchmark SV calls against the SVs simulated in a workdir.
+    Only calls in the simulated regions are compared. With several caller vcfs each gets a subdirectory
+    of the output named after it
+    """
+    args = parseArgs(args)
+    if os.path.exists(args.output):
+        logging.error(f"Output directory {args.output} already exists")
+        exit(1)
+    start_metrics(args, "bench", args.output)
+    if len(args.comp) == 1:
+        out_dirs = [args.output]
+    else:
+        os.mkdir(args.output)
+        out_dirs = [os.path.join(args.output, name) for name in comp_dirnames(args.comp)]
+    params = {"refdist": args.refdist, "pctsim": args.pctsim, "pctsize": args.pctsize, "pctovl": args.pctovl,
+              "typeignore": args.typeignore, "sizemin": args.sizemin, "sizefilt": args.sizefilt,
+              "sizemax": args.sizemax, "passonly": args.passonly, "multimatch": args.multimatch}
+    summaries = bench(args.workdir, args.comp, out_dirs, params, args.threads)
+    for out_dir, summary in zip(out_dirs, summaries):
+        logging.info(f"{out_dir} precision {summary['precision']:.4f} recall {summary['recall']:.4f} "
+                     f"f1 {summary['f1']:.4f}")
+    logging.info("Finished")
+
+def parseArgs(args):
+    """
+    Argument parsing
+    """
+    parser = argparse.ArgumentParser(prog="bench", description=inspect.getdoc(bench_main),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("workdir", metavar="DIR", type=str,
+                        help="SVTeaser working directory")
+    parser.add_argument("-c", "--comp", type=str, nargs="+", required=True,
+                        help="Caller vcfs in reference coordinates. Indexed vcfs are only read in the regions")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Output directory")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of caller vcfs to benchmark in parallel (%(default)s)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Verbose logging")
+    parser.add_argument("-r", "--refdist", type=int, default=500,
+                        help="Max reference location distance (%(default)s)")
+    parser.add_argument("-p", "--pctsim", type=float, default=0.7,
+                        help="Min percent allele sequence similarity. Set to 0 to ignore (%(default)s)")
+    parser.add_argument("-P", "--pctsize", type=float, default=0.7,
+                        help="Min pct allele size similarity (minvarsize/maxvarsize) (%(default)s)")
+    parser.add_argument("-O", "--pctovl", type=float, default=0.0,
+                        help="Min pct reciprocal overlap (%(default)s)")
+    parser.add_argument("-t", "--typeignore", action="store_true",
+                        help="Variant types don't need to match to compare")
+    parser.add_argument("-s", "--sizemin", type=int, default=50,
+                        help="Minimum variant size to consider for comparison (%(default)s)")
+    parser.add_argument("-S", "--sizefilt", type=int, default=30,
+                        help="Minimum variant size to load into the calls for matching (%(default)s)")
+    parser.add_argument("--sizemax", type=int, default=50000,
+                        help="Maximum variant size to consider for comparison (%(default)s)")
+    parser.add_argument("--passonly", action="store_true",
+                        help="Only consider calls with FILTER == PASS")
+    parser.add_argument("--multimatch", action="store_true",
+                        help="Allow a variant to match several others")
+    add_metrics_args(parser)
+    args = parser.parse_args(args)
+    setup_logging(args.debug)
+    return args
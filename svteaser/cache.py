@@ -0,0 +1,188 @@
+"""
+Content-addressed cache of simulation outputs so identical runs are restored instead of recomputed
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+# Bump whenever a stage's outputs change for the same inputs so old entries stop matching
+CACHE_VERSION = 3
+
+# Marks a directory with the key of the run that made it
+CACHE_STAMP = ".svteaser_cache_key"
+
+DIGESTS = "digests.json"
+
+def file_digest(path, chunk_size=4194304):
+    """
+    md5 of a file's contents
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def cached_file_digest(cache_dir, path):
+    """
+    file_digest, remembered in the cache by path/size/mtime so big references are only hashed once
+    """
+    stat = os.stat(path)
+    stat_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    digests_fn = os.path.join(cache_dir, DIGESTS)
+    digests = {}
+    if os.path.exists(digests_fn):
+        try:
+            with open(digests_fn, "r") as fh:
+                digests = json.load(fh)
+        except (OSError, ValueError):
+            digests = {}
+    if stat_key not in digests:
+        digests[stat_key] = file_digest(path)
+        fd, tmp_fn = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as fout:
+            json.dump(digests, fout)
+        os.replace(tmp_fn, digests_fn)
+    return digests[stat_key]
+
+def cache_key(cache_dir, stage, params, files):
+    """
+    Hash of everything that determines a stage's outputs.
+    params is a dict of settings (including any seed). files is a dict of {role: path} of the input files,
+    which are identified by their contents
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    desc = {"version": CACHE_VERSION,
+            "stage": stage,
+            "params": params,
+            "files": {role: cached_file_digest(cache_dir, path) if path else None
+                      for role, path in files.items()}}
+    return hashlib.sha256(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+def link_tree(src, dest):
+    """
+    Recreate src at dest by hard-linking its files, copying when links aren't possible (e.g. across devices)
+    """
+    shutil.copytree(src, dest, copy_function=link_or_copy)
+
+def link_or_copy(src, dest):
+    """
+    Hard-link src to dest, or copy it
+    """
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+def tree_size(path):
+    """
+    Total bytes of the files under path
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def cache_entry(cache_dir, key):
+    """
+    Path of the entry for key
+    """
+    return os.path.join(cache_dir, key[:2], key)
+
+def cache_restore(cache_dir, key, outdir):
+    """
+    Put the cached outputs for key into outdir.
+    Returns False if there is no entry for key
+    """
+    entry = cache_entry(cache_dir, key)
+    if not os.path.isdir(entry):
+        return False
+    link_tree(entry, outdir)
+    # Entries are evicted by their last use
+    os.utime(entry)
+    logging.info(f"Restored {outdir} from cache {entry}")
+    return True
+
+def cache_store(cache_dir, key, outdir, max_bytes):
+    """
+    Add outdir to the cache under key and evict the least recently used entries past max_bytes
+    """
+    entry = cache_entry(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry), suffix=".tmp")
+    os.rmdir(tmp_entry)
+    link_tree(outdir, tmp_entry)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another run stored the same key first
+        shutil.rmtree(tmp_entry)
+    logging.info(f"Stored {outdir} in cache {entry}")
+    cache_evict(cache_dir, max_bytes, keep=entry)
+
+def cache_evict(cache_dir, max_bytes, keep=None):
+    """
+    Remove the least recently used entries (other than keep) until the cache holds at most max_bytes
+    """
+    entries = []
+    for prefix in os.listdir(cache_dir):
+        prefix_dir = os.path.join(cache_dir, prefix)
+        if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            if key.endswith(".tmp"):
+                continue
+            entry = os.path.join(prefix_dir, key)
+            entries.append((os.stat(entry).st_mtime, tree_size(entry), entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        logging.info(f"Evicting {entry} from cache")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        try:
+            os.rmdir(os.path.dirname(entry))
+        except OSError:
+            pass
+
+def cached_run(cache_dir, key, outdir, run, max_bytes):
+    """
+    Produce outdir with run() unless the cache already holds the outputs for key.
+    An outdir already made by a run with the same key is left as is.
+    Returns True if run() was skipped
+    """
+    stamp = os.path.join(outdir, CACHE_STAMP)
+    if os.path.exists(stamp):
+        with open(stamp, "r") as fh:
+            if fh.read().strip() == key:
+                logging.info(f"{outdir} is up to date")
+                return True
+    if os.path.exists(outdir):
+        logging.error(f"Output directory {outdir} already exists")
+        exit(1)
+    if cache_restore(cache_dir, key, outdir):
+        return True
+    run()
+    with open(stamp, "w") as fout:
+        fout.write(key + "\n")
+    cache_store(cache_dir, key, outdir, max_bytes)
+    return False
+
+def add_cache_args(parser):
+    """
+    Add the cache options to a stage's argument parser
+    """
+    parser.add_argument("--cache", type=str, default=os.environ.get("SVTEASER_CACHE"),
+                        help="Directory of cached results to reuse for identical runs. \
+                              Defaults to $SVTEASER_CACHE if set")
+    parser.add_argument("--cache-size", type=float, default=50,
+                        help="Size in GB the cache is pruned to, least recently used first (%(default)s)")
@@ -0,0 +1,105 @@
+"""
+Derive lower coverage reads by subsampling the pairs of an existing sim_reads run
+"""
+import os
+import json
+import struct
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pysam
+
+from svteaser.utils import BgzfWriter
+
+# Written into downsampled directories so they can themselves be downsampled consistently
+DOWNSAMPLE_INFO = "downsample.json"
+
+def parse_sim_reads_dirname(path):
+    """
+    Pull the (coverage, readlen, meanfrag, insertsd, instrument) out of a sim_reads directory name
+    """
+    parts = os.path.basename(os.path.normpath(path)).split("_")
+    if len(parts) != 7 or parts[:2] != ["sim", "reads"]:
+        raise ValueError(f"{path} is not a sim_reads_{{cov}}_{{len}}_{{frag}}_{{sd}}_{{inst}} directory")
+    return int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5]), parts[6]
+
+def pair_fraction(name, key):
+    """
+    Deterministic value in [0, 1) for a read pair's name
+    """
+    digest = hashlib.blake2b(name, digest_size=8, key=key).digest()
+    return struct.unpack("<Q", digest)[0] / 2**64
+
+def read_name(line):
+    """
+    Pair name of a fastq header or sam qname, without the @ and /1 /2 mate suffix
+    """
+    name = line.split(maxsplit=1)[0].lstrip(b"@")
+    if name[-2:] in (b"/1", b"/2"):
+        name = name[:-2]
+    return name
+
+def downsample_fastqs(in_path, out_path, fraction, key, compress_threads=2):
+    """
+    Stream both mates' fq.gz from in_path in lockstep (BGZFile yields lines without their newline),
+    keeping pairs whose name hashes under fraction
+    Returns the number of pairs read and kept
+    """
+    total = kept = 0
+    executor = ThreadPoolExecutor(max(1, compress_threads))
+    with pysam.BGZFile(f"{in_path}1.fq.gz", "rb") as in1, pysam.BGZFile(f"{in_path}2.fq.gz", "rb") as in2, \
+         BgzfWriter(f"{out_path}1.fq.gz", executor=executor) as out1, \
+         BgzfWriter(f"{out_path}2.fq.gz", executor=executor) as out2:
+        for rec1, rec2 in zip(zip(in1, in1, in1, in1), zip(in2, in2, in2, in2)):
+            total += 1
+            if pair_fraction(read_name(rec1[0]), key) < fraction:
+                kept += 1
+                out1.write(b"\n".join(rec1) + b"\n")
+                out2.write(b"\n".join(rec2) + b"\n")
+    executor.shutdown()
+    return total, kept
+
+def downsample_alignments(in_fn, out_fn, fraction, key):
+    """
+    Keep the alignments of the pairs that downsample_fastqs keeps
+    """
+    with pysam.AlignmentFile(in_fn) as fin, \
+         pysam.AlignmentFile(out_fn, "wb" if out_fn.endswith(".bam") else "w", template=fin) as fout:
+        for aln in fin:
+            if pair_fraction(read_name(aln.query_name.encode()), key) < fraction:
+                fout.write(aln)
+
+def downsample_reads(source, outdir, coverage, seed=0, compress_threads=2):
+    """
+    Subsample the reads in source down to coverage, writing them to outdir.
+    A pair is kept when the seeded hash of its name falls under coverage / top coverage, where the top
+    coverage is that of the originally simulated reads. Every rung of a coverage ladder made with the same
+    seed is therefore a subset of the rungs above it, whichever rung it was derived from.
+    """
+    source_coverage = parse_sim_reads_dirname(source)[0]
+    root = {"source": os.path.abspath(source), "coverage": source_coverage, "seed": seed}
+    info_fn = os.path.join(source, DOWNSAMPLE_INFO)
+    if os.path.exists(info_fn):
+        with open(info_fn, "r") as fh:
+            root = json.load(fh)["root"]
+        if root["seed"] != seed:
+            logging.warning(f"{source} was downsampled with seed {root['seed']}. "
+                            f"Using seed {seed} won't give a subset of it")
+    if coverage >= source_coverage:
+        logging.error(f"Can only downsample to below {source}'s coverage of {source_coverage}")
+        exit(1)
+
+    fraction = coverage / root["coverage"]
+    key = str(seed).encode()
+    os.mkdir(outdir)
+    in_path = os.path.join(source, "art_illumina.simReads")
+    out_path = os.path.join(outdir, "art_illumina.simReads")
+    total, kept = downsample_fastqs(in_path, out_path, fraction, key, compress_threads)
+    for ext in [".bam", ".sam"]:
+        if os.path.exists(in_path + ext):
+            downsample_alignments(in_path + ext, out_path + ext, fraction, key)
+    with open(os.path.join(outdir, DOWNSAMPLE_INFO), "w") as fout:
+        json.dump({"root": root, "coverage": coverage, "pairs": kept}, fout, indent=4)
+    logging.info(f"Kept {kept} of {total} read pairs from {source}")
+    return kept
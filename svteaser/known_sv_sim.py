@@ -4,131 +4,169 @@ import inspect
 import logging
 import argparse
 import subprocess
+import multiprocessing
 from collections import OrderedDict
 from random import randint
 import shutil
 
-from acebinf import cmd_exe
 from truvari import setup_logging
-from svteaser.utils import vcf_compress, add_fasta_entry
+from svteaser.utils import vcf_compress, add_fasta_entry, FastaWriter
+from svteaser.cache import add_cache_args, cache_key, cached_run
+from svteaser.metrics import stage, add_metrics_args, start_metrics
+from svteaser.liftover import REGION_EVENTS, format_region, write_region_index
 import pysam
 
 
-def serialize_contigs_to_fa(contigs, fa_path):
-    with open(fa_path, "w+") as fh:
-        for contig, seq in contigs:
-            fh.write(">{}\n".format(contig))
-            fh.write("{}\n".format(seq))
-
-def generate_altered_ref(ref_file, sv_vcf, outdir, copy_unaltered_contigs):
+def generate_altered_ref(ref_file, sv_vcf, outdir, copy_unaltered_contigs, chunk_size=1000000, threads=1):
     """
     Generate altered ref sequence and return. This spikes in all the variants into a single altered seq
     and outputs all altered sequences.
 
-    NOTE: Unused right now.
+    Reference slices and alt alleles are streamed to the fasta at most chunk_size bases at a time,
+    so memory doesn't depend on the size of the genome. Only the records that were spiked in are
+    written to svteaser.sim.vcf.
     """
     reference = pysam.FastaFile(ref_file)
+    indexed_vcf = index_sv_vcf(sv_vcf, outdir, threads)
+    sv = pysam.VariantFile(indexed_vcf)
+    for contig in sv.index:
+        if contig not in reference.references:
+            logging.warning(f"Skipping SVs on {contig} which isn't in the reference")
 
-    sv = pysam.VariantFile(sv_vcf)
-
-    alt_contigs = {}
+    writer = FastaWriter(os.path.join(outdir, "svteaser.altered.fa"))
+    out_vcf_path = os.path.join(outdir, "svteaser.sim.vcf")
+    out_vcf = pysam.VariantFile(out_vcf_path, "w", header=sv.header)
+    regions_fh = open(os.path.join(outdir, REGION_EVENTS), "w")
 
-    contig = None
-    contig_seq = None
-    contig_pos = 0
-    alt_seq = []
+    def copy_ref(contig, start, end):
+        for chunk_start in range(start, end, chunk_size):
+            writer.write(reference.fetch(contig, chunk_start, min(chunk_start + chunk_size, end)))
 
-    for record in sv:
-        if record.chrom != contig:
-            # Store previously finished ref contig
-            if contig is not None:
-                alt_seq.append(contig_seq[contig_pos:])
-                alt_contigs[contig] = "".join(alt_seq)
+    with stage("spike"):
+        for contig in reference.references:
+            if contig not in sv.index:
+                # Grab any non variant contigs in final list from original reference.
+                if copy_unaltered_contigs:
+                    writer.start(contig)
+                    copy_ref(contig, 0, reference.get_reference_length(contig))
+                    regions_fh.write(format_region(contig, contig, 0, reference.get_reference_length(contig), []))
+                continue
 
-            # Reset variables to process new contig
-            contig = record.chrom
-            contig_seq = reference.fetch(contig)
-            contig_pos = 0
             logging.info("Creating alt contig for {}".format(contig))
+            writer.start(contig)
+            contig_pos = 0
+            events = []
+            for record in sv.fetch(contig):
+                assert(len(record.alts) == 1), "Cannot process multi allelic entries in VCF."
 
-        assert(len(record.alts) == 1), "Cannot process multi allelic entries in VCF."
-
-        ref = record.ref
-        alt = record.alts[0]
-        var_pos = record.pos - 1
+                ref = record.ref
+                alt = record.alts[0]
+                var_pos = record.pos - 1
 
-        # For non variant positions, grab sequence from reference contig and increment ref seq pos.
-        if var_pos > contig_pos:
-            alt_seq.append(contig_seq[contig_pos:var_pos])
-            contig_pos = var_pos
+                if var_pos < contig_pos:
+                    logging.warning(f"Skipping {contig}:{record.pos} which overlaps the previous variant")
+                    continue
 
-        # Add alt variant to alt sequence.
-        alt_seq.append(alt)
+                # For non variant positions, grab sequence from reference contig and increment ref seq pos.
+                copy_ref(contig, contig_pos, var_pos)
 
-        # Increment ref contig position by ref sequence.
-        contig_pos += len(ref)
+                # Add alt variant to alt sequence.
+                writer.write(alt)
+                events.append((var_pos, len(ref), len(alt)))
+                out_vcf.write(record)
 
-    if contig is not None:
-        alt_seq.append(contig_seq[contig_pos:])
-        alt_contigs[contig] = "".join(alt_seq)
+                # Increment ref contig position by ref sequence.
+                contig_pos = var_pos + len(ref)
 
-    # Grab any non variant contigs in final list from original reference.
-    final_contigs = []
-    if copy_unaltered_contigs:
-        for contig in reference.references:
-            if contig not in alt_contigs:
-                final_contigs.append((contig, reference.fetch(contig)))
-            else:
-                final_contigs.append((contig, alt_contigs[contig]))
-    else:
-        for contig, seq in alt_contigs.items():
-            final_contigs.append((contig, seq))
+            copy_ref(contig, contig_pos, reference.get_reference_length(contig))
+            regions_fh.write(format_region(contig, contig, 0, reference.get_reference_length(contig), events))
+    writer.close()
+    regions_fh.close()
+    out_vcf.close()
 
-    serialize_contigs_to_fa(final_contigs, os.path.join(outdir, "svteaser.altered.fa"))
     shutil.copyfile(ref_file, os.path.join(outdir, "svteaser.ref.fa"))
-    if ".gz" in sv_vcf:
-        shutil.copyfile(sv_vcf, os.path.join(outdir, "svteaser.sim.vcf.gz"))
-    else:
-        path = shutil.copyfile(sv_vcf, os.path.join(outdir, "svteaser.sim.vcf"))
-        shutil.copyfile(sv_vcf, path)
-        vcf_compress(path)
-
-
-def generate_altered_regions(ref_file, sv_vcf, outdir, region_size, max_sv_size, padding=0):
+    shutil.copyfile(ref_file + ".fai", os.path.join(outdir, "svteaser.ref.fa.fai"))
+    with stage("compress_vcf"):
+        vcf_compress(out_vcf_path, threads=threads)
+    with stage("region_index"):
+        write_region_index(outdir, OrderedDict(zip(reference.references, reference.lengths)))
+    os.remove(os.path.join(outdir, REGION_EVENTS))
+    if indexed_vcf != sv_vcf:
+        os.remove(indexed_vcf)
+        os.remove(indexed_vcf + ".tbi")
+
+def spike_region(reference, chrom, start_pos, end_pos, records, out_ref_fh, out_altered_fh, contigs_fh, records_fh,
+                 regions_fh):
     """
-    Simulate variants from known SVs by spiking them into reference segments.
+    Spike non-overlapping SV records into a reference window and write the window's
+    ref/altered sequences, contig header line, records and region events
     """
-    logging.info(f"Region size = {region_size}, Max SV Size = {max_sv_size}, Padding = {padding}")
+    ref_seq = reference.fetch(chrom, start_pos, end_pos)
+    pieces = []
+    last_pos = 0
+    for record in records:
+        relative_pos = record.pos - 1 - start_pos
+        pieces.append(ref_seq[last_pos:relative_pos])
+        pieces.append(record.alts[0])
+        last_pos = relative_pos + len(record.ref)
+    pieces.append(ref_seq[last_pos:])
+    alt_seq = "".join(pieces)
+    new_contig_name = f"{chrom}_{start_pos}_{end_pos}"
+
+    contigs_fh.write(f"##contig=<ID={new_contig_name},length={len(ref_seq)}>\n")
+
+    add_fasta_entry(new_contig_name, ref_seq, out_ref_fh)
+    add_fasta_entry(new_contig_name, alt_seq, out_altered_fh)
+    regions_fh.write(format_region(new_contig_name, chrom, start_pos, start_pos + len(ref_seq),
+                                   [(record.pos - 1 - start_pos, len(record.ref), len(record.alts[0]))
+                                    for record in records]))
+
+    # NOTE: We don't update variant record to keep variants in original coordinate frame.
+    for record in records:
+        records_fh.write(str(record))
+
+def index_sv_vcf(sv_vcf, outdir, threads=1):
+    """
+    Make sure the SV vcf can be queried by region. Inputs without a tabix/csi index
+    (unsorted or otherwise) get a sorted, indexed copy in outdir.
+    Returns the path to the indexed vcf
+    """
+    if os.path.exists(sv_vcf + ".tbi") or os.path.exists(sv_vcf + ".csi"):
+        return sv_vcf
+    logging.info(f"Sorting and indexing {sv_vcf}")
+    out_path = os.path.join(outdir, "input.sv.vcf.gz")
+    with stage("index_vcf"):
+        vcf_compress(sv_vcf, threads=threads, out_fn=out_path)
+    return out_path
+
+def generate_chrom_regions(ref_file, sv_vcf, chrom, prefix, region_size, max_sv_size, padding=0, pack=False):
+    """
+    Spike the SVs on one chromosome into reference windows.
+    Writes prefix.ref.fa, prefix.altered.fa, prefix.contigs, prefix.records and prefix.regions fragments.
+    Returns the number of windows and reference bases written.
+    """
+    logging.debug("Load new chrom {}".format(chrom))
     reference = pysam.FastaFile(ref_file)
     sv = pysam.VariantFile(sv_vcf)
-    header = sv.header
-
-    out_ref_path = os.path.join(outdir, "svteaser.ref.fa")
-    out_ref_fh = open(out_ref_path, "w+")
-
-    out_altered_path = os.path.join(outdir, "svteaser.altered.fa")
-    out_altered_fh = open(out_altered_path, "w+")
+    chrom_len = reference.get_reference_length(chrom)
 
     # Number bases to flank on either size ov variant
     flank_size = region_size // 2
 
-    if flank_size - max_sv_size < padding:
-        logging.error(f"Max SV size and required padding are not compatible. Increase region size by {2 * (padding + max_sv_size - flank_size)} or decreases max SV size to {flank_size - padding}.")
-        exit(1)
-
-
-    records = []
-
-    last_chrom = ""
-    chrom_seq = ""
+    out_fhs = (open(prefix + ".ref.fa", "w"),
+               open(prefix + ".altered.fa", "w"),
+               open(prefix + ".contigs", "w"),
+               open(prefix + ".records", "w"),
+               open(prefix + ".regions", "w"))
 
-    for record in sv:
-        chrom = record.chrom
-        if last_chrom != chrom:
-            logging.debug("Load new chrom {}".format(chrom))
-            last_chrom = chrom
-            chrom_seq = reference.fetch(chrom)
+    # SVs sharing the current window
+    window = []
+    window_start = 0
+    window_end = 0
+    num_windows = 0
+    num_bases = 0
 
+    for record in sv.fetch(chrom):
         pos = record.pos - 1
         ref = record.ref
         alt = record.alts[0]
@@ -138,41 +176,137 @@ def generate_altered_regions(ref_file, sv_vcf, outdir, region_size, max_sv_size,
             continue
 
         start_pos = max(0, pos - flank_size)
-        end_pos = min(pos + flank_size, len(chrom_seq))
-
-        ref_seq = chrom_seq[start_pos:end_pos]
-        relative_pos = pos - start_pos
-        alt_seq = "".join([ref_seq[:relative_pos], alt, ref_seq[relative_pos + len(ref):]])
-        new_contig_name = f"{chrom}_{start_pos}_{end_pos}"
-
-        header.add_line(f"##contig=<ID={new_contig_name},length={len(ref_seq)}>")
+        end_pos = min(pos + flank_size, chrom_len)
+
+        if pack and window and start_pos < window_end:
+            prev = window[-1]
+            if pos >= prev.pos - 1 + len(prev.ref) + padding:
+                window.append(record)
+                window_end = end_pos
+                continue
+            logging.debug(f"SV at {chrom}:{record.pos} is too close to the previous SV to share its window")
+            spike_region(reference, chrom, start_pos, end_pos, [record], *out_fhs)
+            num_windows += 1
+            num_bases += end_pos - start_pos
+            continue
 
-        add_fasta_entry(new_contig_name, ref_seq, out_ref_fh)
-        add_fasta_entry(new_contig_name, alt_seq, out_altered_fh)
+        if window:
+            spike_region(reference, chrom, window_start, window_end, window, *out_fhs)
+            num_windows += 1
+            num_bases += window_end - window_start
+        window = [record]
+        window_start = start_pos
+        window_end = end_pos
+
+    if window:
+        spike_region(reference, chrom, window_start, window_end, window, *out_fhs)
+        num_windows += 1
+        num_bases += window_end - window_start
+
+    for fh in out_fhs:
+        fh.close()
+    return num_windows, num_bases
+
+def generate_altered_regions(ref_file, sv_vcf, outdir, region_size, max_sv_size, padding=0, pack=False,
+                             threads=1):
+    """
+    Simulate variants from known SVs by spiking them into reference segments.
+    Only the window around each SV is fetched and records are written as they're processed,
+    so memory doesn't depend on chromosome length or the number of SVs.
 
-        # NOTE: We don't update variant record to keep variants in original coordinate frame.
-        # Keeping for now in case needed, but should be removed.
-        #record.chrom = new_contig_name
-        #record.pos = relative_pos + 1
+    With pack, SVs whose windows would overlap share one window spanning all of them, as long as
+    each SV starts at least padding bases after the previous one ends. SVs too close to their
+    neighbor get their own window.
 
-        records.append(record)
+    Each chromosome is processed separately (in parallel with threads > 1) through region queries
+    of the SV vcf, and the fragments are joined in reference contig order.
+    """
+    logging.info(f"Region size = {region_size}, Max SV Size = {max_sv_size}, Padding = {padding}")
 
-    out_altered_fh.close()
-    out_ref_fh.close()
+    # Number bases to flank on either size ov variant
+    flank_size = region_size // 2
 
-    out_vcf_path = os.path.join(outdir, "svteaser.sim.vcf")
-    with pysam.VariantFile(out_vcf_path, "w", header=sv.header) as out_vcf_fh:
-        for rec in records:
-            out_vcf_fh.write(rec)
+    if flank_size - max_sv_size < padding:
+        logging.error(f"Max SV size and required padding are not compatible. Increase region size by {2 * (padding + max_sv_size - flank_size)} or decreases max SV size to {flank_size - padding}.")
+        exit(1)
 
-    vcf_compress(out_vcf_path)
+    indexed_vcf = index_sv_vcf(sv_vcf, outdir, threads)
+    sv = pysam.VariantFile(indexed_vcf)
+    reference = pysam.FastaFile(ref_file)
+    chroms = [chrom for chrom in reference.references if chrom in sv.index]
+    for chrom in sv.index:
+        if chrom not in reference.references:
+            logging.warning(f"Skipping SVs on {chrom} which isn't in the reference")
+
+    prefixes = [os.path.join(outdir, f"frag_{idx}") for idx in range(len(chroms))]
+    jobs = [(ref_file, indexed_vcf, chrom, prefix, region_size, max_sv_size, padding, pack)
+            for chrom, prefix in zip(chroms, prefixes)]
+    with stage("spike"):
+        if threads > 1:
+            with multiprocessing.Pool(threads) as pool:
+                counts = pool.starmap(generate_chrom_regions, jobs, chunksize=1)
+        else:
+            counts = [generate_chrom_regions(*job) for job in jobs]
+    num_windows = sum(count[0] for count in counts)
+    num_bases = sum(count[1] for count in counts)
+    logging.info(f"Wrote {num_windows} regions totaling {num_bases} reference bases")
+
+    def concat(suffix, out_fh):
+        for prefix in prefixes:
+            with open(prefix + suffix, "r") as fh:
+                shutil.copyfileobj(fh, out_fh)
+
+    with stage("concat"):
+        with open(os.path.join(outdir, "svteaser.ref.fa"), "w") as out_ref_fh:
+            concat(".ref.fa", out_ref_fh)
+        with open(os.path.join(outdir, "svteaser.altered.fa"), "w") as out_altered_fh:
+            concat(".altered.fa", out_altered_fh)
+
+        # The region contigs go in the header once, ahead of the records
+        out_vcf_path = os.path.join(outdir, "svteaser.sim.vcf")
+        header = str(sv.header).rstrip("\n").split("\n")
+        with open(out_vcf_path, "w") as out_vcf_fh:
+            out_vcf_fh.write("\n".join(header[:-1]) + "\n")
+            concat(".contigs", out_vcf_fh)
+            out_vcf_fh.write(header[-1] + "\n")
+            concat(".records", out_vcf_fh)
+        with open(os.path.join(outdir, REGION_EVENTS), "w") as out_regions_fh:
+            concat(".regions", out_regions_fh)
+
+    for prefix in prefixes:
+        for suffix in [".ref.fa", ".altered.fa", ".contigs", ".records", ".regions"]:
+            os.remove(prefix + suffix)
+    if indexed_vcf != sv_vcf:
+        os.remove(indexed_vcf)
+        os.remove(indexed_vcf + ".tbi")
+
+    with stage("compress_vcf"):
+        vcf_compress(out_vcf_path, threads=threads)
+    with stage("region_index"):
+        write_region_index(outdir, OrderedDict(zip(reference.references, reference.lengths)))
+    os.remove(os.path.join(outdir, REGION_EVENTS))
 
 def known_sv_sim_main(args):
     """
     Run simulation on reference with known SVs. Output them into a directory.
     """
     args = parseArgs(args)
+    start_metrics(args, "known_sv", args.output)
+
+    if args.cache:
+        params = {"whole_genome": args.whole_genome, "copy_unaltered_contigs": args.copy_unaltered_contigs,
+                  "len_sv_region": args.len_sv_region, "max_sv_size": args.max_sv_size,
+                  "ref_seq_padding": args.ref_seq_padding, "pack": args.pack}
+        key = cache_key(args.cache, "known_sv", params, {"reference": args.reference, "sv_vcf": args.sv_vcf})
+        cached_run(args.cache, key, args.output, lambda: run_known_sv_sim(args), args.cache_size * 1024**3)
+    else:
+        run_known_sv_sim(args)
+    logging.info("Finished")
 
+def run_known_sv_sim(args):
+    """
+    Spike the known SVs into the output directory
+    """
     logging.debug(f"Making outdir {args.output}")
     try:
         os.mkdir(args.output)
@@ -180,14 +314,21 @@ def known_sv_sim_main(args):
         logging.error(f"Output directory {args.output} already exists")
         exit(1)
 
-    generate_altered_regions(args.reference,
+    if args.whole_genome:
+        generate_altered_ref(args.reference,
                              args.sv_vcf,
                              args.output,
-                             args.len_sv_region,
-                             args.max_sv_size,
-                             padding=args.ref_seq_padding)
-
-    logging.info("Finished")
+                             args.copy_unaltered_contigs,
+                             threads=args.threads)
+    else:
+        generate_altered_regions(args.reference,
+                                 args.sv_vcf,
+                                 args.output,
+                                 args.len_sv_region,
+                                 args.max_sv_size,
+                                 padding=args.ref_seq_padding,
+                                 pack=args.pack,
+                                 threads=args.threads)
 
 
 def parseArgs(args):
@@ -200,7 +341,7 @@ def parseArgs(args):
     parser.add_argument("reference", metavar="REF", type=str,
                         help="Reference file overwhich to simulate SVs")
     parser.add_argument("sv_vcf", metavar="SV_VCF", type=str,
-                        help="VCF with known SVs to simulate. MUST BE SORTED.")
+                        help="VCF with known SVs to simulate. Unindexed VCFs are sorted and indexed first.")
     parser.add_argument("output", metavar="OUT", type=str, default="output",
                         help="SVTeaser output basename (%(default)s)")
     parser.add_argument("--debug", action="store_true",
@@ -214,6 +355,17 @@ def parseArgs(args):
     parser.add_argument('--ref_seq_padding', type=int, default=800,
                         help='Padded region around each end of reg where variation are spiked.',
                         required=False)
+    parser.add_argument('--pack', action="store_true",
+                        help='Share one region between nearby SVs instead of making overlapping regions. \
+                              SVs in a region are kept at least --ref_seq_padding apart.')
+    parser.add_argument('--whole-genome', action="store_true",
+                        help='Spike every SV into whole altered chromosomes instead of making regions')
+    parser.add_argument('--copy-unaltered-contigs', action="store_true",
+                        help='With --whole-genome, also output chromosomes without SVs')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of chromosomes to process in parallel (%(default)s)')
+    add_cache_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args(args)
     args.reference = os.path.abspath(args.reference)
     args.output = args.output + ".svt"
@@ -0,0 +1,327 @@
+"""
+Region BED and offset table of a workdir's simulated regions, and lifting caller vcfs from region contig
+coordinates back to the reference
+"""
+import os
+import re
+import gzip
+import inspect
+import logging
+import argparse
+import operator
+import itertools
+
+import numpy as np
+import pysam
+from truvari import setup_logging
+
+from svteaser.utils import BgzfWriter, save_columns, load_columns, vcf_compress
+from svteaser.metrics import stage, add_metrics_args, start_metrics
+
+REGIONS_BED = "svteaser.regions.bed.gz"
+LIFTOVER_TABLE = "svteaser.liftover.npz"
+# One line per region of name, chrom, start, end and its events, written as regions are simulated
+REGION_EVENTS = "svteaser.regions.txt"
+
+def format_region(name, chrom, start, end, events):
+    """
+    REGION_EVENTS line of a region. events are (position in the region, ref length, alt length) of the
+    variants applied to the region's altered sequence, in order
+    """
+    events = ",".join(f"{pos}:{ref_len}:{alt_len}" for pos, ref_len, alt_len in events)
+    return f"{name}\t{chrom}\t{start}\t{end}\t{events}\n"
+
+def record_event(line):
+    """
+    Event of a region coordinate vcf record line
+    """
+    _, pos, _, ref, alt, _ = line.split("\t", 5)
+    return int(pos) - 1, len(ref), len(alt)
+
+def region_segments(events):
+    """
+    Piecewise map of a region's altered sequence onto its reference sequence as (altered start, ref start, clamp)
+    segments. Altered position q in a segment maps to ref start + min(q - altered start, clamp), where a clamp
+    of -1 is unbounded.
+    Bases replaced by a variant map onto the variant's ref allele, so inserted sequence lands on the anchor base
+    """
+    alt_starts = [0]
+    ref_starts = [0]
+    clamps = [-1]
+    shift = 0
+    for pos, ref_len, alt_len in events:
+        alt_starts.append(pos + shift)
+        ref_starts.append(pos)
+        clamps.append(max(ref_len - 1, 0))
+        shift += alt_len - ref_len
+        alt_starts.append(pos + ref_len + shift)
+        ref_starts.append(pos + ref_len)
+        clamps.append(-1)
+    return alt_starts, ref_starts, clamps
+
+def write_region_index(workdir, chrom_lengths):
+    """
+    Turn the workdir's REGION_EVENTS into the sorted, indexed REGIONS_BED and the LIFTOVER_TABLE.
+    The REGION_EVENTS file is left for the caller to remove.
+    chrom_lengths is the reference's {chrom: length}, in reference order
+    """
+    events_fn = os.path.join(workdir, REGION_EVENTS)
+    names, chroms, starts, ends, seg_first, seg_count = [], [], [], [], [], []
+    alt_starts, ref_starts, clamps = [], [], []
+    with open(events_fn, "r") as fh:
+        for line in fh:
+            name, chrom, start, end, events = line.rstrip("\n").split("\t")
+            events = [tuple(map(int, event.split(":"))) for event in events.split(",") if event]
+            seg_alt, seg_ref, seg_clamp = region_segments(events)
+            names.append(name)
+            chroms.append(chrom)
+            starts.append(int(start))
+            ends.append(int(end))
+            seg_first.append(len(alt_starts))
+            seg_count.append(len(seg_alt))
+            alt_starts.extend(seg_alt)
+            ref_starts.extend(seg_ref)
+            clamps.extend(seg_clamp)
+
+    contig_order = {chrom: idx for idx, chrom in enumerate(chrom_lengths)}
+    order = sorted(range(len(names)), key=lambda idx: (contig_order.get(chroms[idx], len(contig_order)),
+                                                       chroms[idx], starts[idx], ends[idx]))
+    bed_fn = os.path.join(workdir, REGIONS_BED)
+    with BgzfWriter(bed_fn) as fout:
+        for idx in order:
+            fout.write(f"{chroms[idx]}\t{starts[idx]}\t{ends[idx]}\t{names[idx]}\n".encode())
+    pysam.tabix_index(bed_fn, preset="bed", force=True)
+
+    cols = {"name": np.array(names, dtype=object),
+            "chrom": np.array(chroms, dtype=object),
+            "start": np.array(starts, dtype=np.int64),
+            "end": np.array(ends, dtype=np.int64),
+            "seg_first": np.array(seg_first, dtype=np.int64),
+            "seg_count": np.array(seg_count, dtype=np.int64),
+            "alt_start": np.array(alt_starts, dtype=np.int64),
+            "ref_start": np.array(ref_starts, dtype=np.int64),
+            "clamp": np.array(clamps, dtype=np.int64),
+            "contig": np.array(list(chrom_lengths), dtype=object),
+            "contig_length": np.array(list(chrom_lengths.values()), dtype=np.int64)}
+    save_columns(os.path.join(workdir, LIFTOVER_TABLE), cols)
+    logging.info(f"Indexed {len(names)} regions")
+
+class RegionLifter():
+    """
+    Lifts positions on region contigs to the reference with a workdir's LIFTOVER_TABLE.
+    With frame="ref" positions are on the unaltered svteaser.ref.fa contigs, otherwise on svteaser.altered.fa's
+    """
+    def __init__(self, workdir, frame="altered"):
+        cols = load_columns(os.path.join(workdir, LIFTOVER_TABLE))
+        self.frame = frame
+        self.contigs = dict(zip(cols["contig"].tolist(), cols["contig_length"].tolist()))
+        self.regions = {name: idx for idx, name in enumerate(cols["name"].tolist())}
+        self.cols = cols
+        self._cache = {}
+
+    def region(self, name):
+        """
+        (chrom, start, altered starts, ref starts, clamps) of a region contig, or None if name isn't a region.
+        Made when the region is first used
+        """
+        if name not in self._cache:
+            idx = self.regions.get(name)
+            if idx is None:
+                self._cache[name] = None
+            else:
+                cols = self.cols
+                span = slice(cols["seg_first"][idx], cols["seg_first"][idx] + cols["seg_count"][idx])
+                if self.frame == "altered":
+                    segments = (cols["alt_start"][span], cols["ref_start"][span], cols["clamp"][span])
+                else:
+                    segments = (np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                                np.full(1, -1, dtype=np.int64))
+                self._cache[name] = (str(cols["chrom"][idx]), int(cols["start"][idx])) + segments
+        return self._cache[name]
+
+    def lift(self, name, pos):
+        """
+        (chrom, position) on the reference of a 0-based position on a region contig.
+        Returns None if name isn't a region
+        """
+        region = self.region(name)
+        if region is None:
+            return None
+        return region[0], int(lift_positions(region, np.array([pos]))[0])
+
+def lift_positions(region, positions):
+    """
+    Reference positions of an array of 0-based positions on a region contig
+    """
+    _, start, alt_starts, ref_starts, clamps = region
+    seg = np.searchsorted(alt_starts, positions, side="right") - 1
+    offsets = positions - alt_starts[seg]
+    clamp = clamps[seg]
+    offsets = np.where((clamp >= 0) & (offsets > clamp), clamp, offsets)
+    return start + ref_starts[seg] + offsets
+
+# INFO END, not SVEND or the like
+INFO_END = re.compile(r"(?<=[\t;])END=(\d+)")
+
+def lift_header(lines, lifter):
+    """
+    Swap a vcf header's region contig lines for the reference's contigs.
+    Returns the new header lines and its contig order
+    """
+    out = []
+    present = []
+    added = False
+    for line in lines:
+        if line.startswith("##contig=<ID="):
+            name = line[len("##contig=<ID="):].split(",")[0].split(">")[0]
+            if name in lifter.regions or name in lifter.contigs:
+                if not added:
+                    out.extend(f"##contig=<ID={chrom},length={length}>\n" for chrom, length in lifter.contigs.items())
+                    present.extend(lifter.contigs)
+                    added = True
+                continue
+            present.append(name)
+        elif line.startswith("#CHROM") and not added:
+            out.extend(f"##contig=<ID={chrom},length={length}>\n" for chrom, length in lifter.contigs.items())
+            present.extend(lifter.contigs)
+            added = True
+        out.append(line)
+    return out, {chrom: idx for idx, chrom in enumerate(present)}
+
+def lift_records(parts, region):
+    """
+    Lift a run of vcf records on one region contig, given as their [chrom, pos, rest of line] splits.
+    Returns the lines and their 1-based positions
+    """
+    positions = lift_positions(region, np.array([part[1] for part in parts]).astype(np.int64) - 1) + 1
+    rests = [part[2] for part in parts]
+    ends = [(idx, match) for idx, match in enumerate(map(INFO_END.search, rests)) if match is not None]
+    if ends:
+        lifted_ends = lift_positions(region, np.array([match.group(1) for _, match in ends]).astype(np.int64) - 1) + 1
+        for (idx, match), end in zip(ends, lifted_ends.tolist()):
+            rests[idx] = f"{rests[idx][:match.start(1)]}{end}{rests[idx][match.end(1):]}"
+    chrom = region[0]
+    return [f"{chrom}\t{pos}\t{rest}" for pos, rest in zip(positions.tolist(), rests)], positions
+
+def lift_batch(lines, lifter, contig_order, is_sorted, last):
+    """
+    Lift a batch of vcf record lines, one run of records on the same contig at a time.
+    Records on other contigs are left as is. Tracks whether the output is still sorted from the last
+    (contig order, position) of the previous batch.
+    Returns the lines, the number lifted and the updated is_sorted and last
+    """
+    out = []
+    num_lifted = 0
+    parts = [line.split("\t", 2) for line in lines]
+    for name, run in itertools.groupby(parts, key=operator.itemgetter(0)):
+        run = list(run)
+        region = lifter.region(name)
+        if region is None:
+            out.extend("\t".join(part) for part in run)
+            chrom = name
+            positions = np.array([part[1] for part in run]).astype(np.int64)
+        else:
+            run_lines, positions = lift_records(run, region)
+            out.extend(run_lines)
+            num_lifted += len(run)
+            chrom = region[0]
+        order = contig_order.get(chrom, len(contig_order))
+        if is_sorted and ((order, int(positions[0])) < last or (np.diff(positions) < 0).any()):
+            is_sorted = False
+        last = (order, int(positions[-1]))
+    return out, num_lifted, is_sorted, last
+
+def liftover_vcf(workdir, in_fn, out_fn, frame="altered", threads=1, batch_size=10000):
+    """
+    Stream a vcf on the workdir's region contigs into reference coordinates.
+    Records on other contigs are passed through. A .gz output is bgzipped and indexed, sorting it first
+    only when lifting put records out of order.
+    Returns the number of records lifted and passed through
+    """
+    lifter = RegionLifter(workdir, frame)
+    fin = gzip.open(in_fn, "rt") if in_fn.endswith(".gz") else open(in_fn, "r")
+    compressed = out_fn.endswith(".gz")
+    fout = BgzfWriter(out_fn, threads=threads) if compressed else open(out_fn, "w")
+
+    def write(lines):
+        data = "".join(lines)
+        fout.write(data.encode() if compressed else data)
+
+    header = []
+    for line in fin:
+        header.append(line)
+        if line.startswith("#CHROM"):
+            break
+    header, contig_order = lift_header(header, lifter)
+    write(header)
+
+    lifted = passed = 0
+    is_sorted = True
+    last = (-1, -1)
+    batch = []
+    for line in fin:
+        batch.append(line)
+        if len(batch) < batch_size:
+            continue
+        batch, num_lifted, is_sorted, last = lift_batch(batch, lifter, contig_order, is_sorted, last)
+        lifted += num_lifted
+        passed += len(batch) - num_lifted
+        write(batch)
+        batch = []
+    batch, num_lifted, is_sorted, last = lift_batch(batch, lifter, contig_order, is_sorted, last)
+    lifted += num_lifted
+    passed += len(batch) - num_lifted
+    write(batch)
+    fin.close()
+    fout.close()
+
+    if compressed:
+        with stage("index"):
+            if is_sorted:
+                pysam.tabix_index(out_fn, preset="vcf", force=True)
+            else:
+                logging.info("Sorting lifted records")
+                tmp_fn = out_fn + ".tmp.vcf.gz"
+                vcf_compress(out_fn, threads=threads, out_fn=tmp_fn)
+                os.replace(tmp_fn, out_fn)
+                os.replace(tmp_fn + ".tbi", out_fn + ".tbi")
+    elif not is_sorted:
+        logging.warning(f"Lifted records in {out_fn} are out of order. Use a .vcf.gz output to have them sorted")
+    return lifted, passed
+
+def liftover_main(args):
+    """
+    Lift a caller vcf from the workdir's region contigs to reference coordinates
+    """
+    args = parseArgs(args)
+    start_metrics(args, "liftover", args.workdir)
+    if not os.path.exists(os.path.join(args.workdir, LIFTOVER_TABLE)):
+        logging.error(f"{args.workdir} has no {LIFTOVER_TABLE}. Was it made by an older svteaser?")
+        exit(1)
+    lifted, passed = liftover_vcf(args.workdir, args.input, args.output, args.frame, args.threads)
+    logging.info(f"Lifted {lifted} records. {passed} records weren't on region contigs")
+    logging.info("Finished")
+
+def parseArgs(args):
+    """
+    Argument parsing
+    """
+    parser = argparse.ArgumentParser(prog="liftover", description=inspect.getdoc(liftover_main),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("workdir", metavar="DIR", type=str,
+                        help="SVTeaser working directory")
+    parser.add_argument("input", metavar="VCF", type=str,
+                        help="VCF to lift")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Lifted VCF. Compressed and indexed if it ends with .gz")
+    parser.add_argument("--frame", type=str, default="altered", choices=["altered", "ref"],
+                        help="Contigs the VCF is on, svteaser.altered.fa's or svteaser.ref.fa's (%(default)s)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of compression threads (%(default)s)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Verbose logging")
+    add_metrics_args(parser)
+    args = parser.parse_args(args)
+    setup_logging(args.debug)
+    return args
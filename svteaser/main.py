@@ -1,11 +1,7 @@
 #!/usr/bin/env python
 import sys
 import argparse
-
-from svteaser.vcfeditor import surv_vcf_fmt_main
-from svteaser.surv_sim import surv_sim_main
-from svteaser.read_simulator import sim_reads_main
-from svteaser.known_sv_sim import known_sv_sim_main
+import importlib
 
 VERSION="0.1"
 
@@ -17,9 +13,14 @@ def version(args):
     """Print the version"""
     print("svteaser v%s" % VERSION)
 
-TOOLS = {'surv_sim': surv_sim_main,
-         'known_sv': known_sv_sim_main,
-         'sim_reads': sim_reads_main,
+# Command -> (module, entry point). A command's module, and the libraries it needs, are only imported when it's run
+TOOLS = {'surv_sim': ("svteaser.surv_sim", "surv_sim_main"),
+         'known_sv': ("svteaser.known_sv_sim", "known_sv_sim_main"),
+         'sim_reads': ("svteaser.read_simulator", "sim_reads_main"),
+         'sweep': ("svteaser.sweep", "sweep_main"),
+         'aggregate': ("svteaser.aggregate", "aggregate_main"),
+         'bench': ("svteaser.bench", "bench_main"),
+         'liftover': ("svteaser.liftover", "liftover_main"),
         }
 
 USAGE = """\
@@ -29,8 +30,19 @@ SVTeaser v%s - SV read simulation for rapid benchmarking
         known_sv        Create genome regions from a VCF of known SVs
         surv_sim        Simulate random SVs with SURVIVOR
         sim_reads       Run read simulators
+        sweep           Run read simulators over a grid of parameters
+        aggregate       Collect truvari results across a sweep into one dataset
+        bench           Benchmark SV calls in the simulated regions
+        liftover        Lift calls on the region contigs to reference coordinates
 """ % VERSION
 
+def load_tool(cmd):
+    """
+    Import a command's module and return its entry point
+    """
+    module, func = TOOLS[cmd]
+    return getattr(importlib.import_module(module), func)
+
 def parseArgs():
     """
     Argument parsing
@@ -48,8 +60,19 @@ def parseArgs():
         sys.exit(1)
 
     args = parser.parse_args()
-
-    TOOLS[args.cmd](args.options)
+    tool = load_tool(args.cmd)
+
+    # Subcommands started with --metrics write them however they end
+    from svteaser.metrics import finish_metrics
+    try:
+        tool(args.options)
+    except SystemExit as e:
+        finish_metrics(e.code)
+        raise
+    except BaseException:
+        finish_metrics(1)
+        raise
+    finish_metrics(0)
 
 if __name__ == '__main__':
     parseArgs()
@@ -0,0 +1,313 @@
+"""
+Per-stage and per-command accounting of wall/CPU time, peak RSS, I/O and subprocess launches.
+With --metrics a command writes it as svteaser.<command>.metrics.json and .csv in its workdir
+"""
+import os
+import csv
+import json
+import time
+import shutil
+import logging
+import datetime
+import resource
+import tempfile
+import subprocess
+from collections import OrderedDict, namedtuple
+
+# Directory that processes other than the one writing the metrics append their records to
+METRICS_ENV = "SVTEASER_METRICS_SPOOL"
+
+FIELDS = ["calls", "wall", "cpu", "peak_rss", "children_peak_rss", "read_bytes", "write_bytes", "subprocesses",
+          "failures"]
+
+# Seconds between --progress log lines
+PROGRESS_INTERVAL = 10
+
+# Same fields as acebinf's result
+cmd_result = namedtuple("cmd_result", "ret_code stdout stderr run_time")
+
+# What this process has recorded. Forked workers inherit it and send their records to the spool
+_STATE = {"spool": None, "main_pid": None, "path": None, "command": None,
+          "started": None, "stack": [], "stages": OrderedDict(), "commands": OrderedDict(),
+          "launches": OrderedDict(), "progress": False, "progress_marks": {}}
+# Spawned subprocesses find the spool through the environment
+if os.path.isdir(os.environ.get(METRICS_ENV, "")):
+    _STATE["spool"] = os.environ[METRICS_ENV]
+
+def add_metrics_args(parser):
+    """
+    Add the --metrics/--progress arguments to a subcommand's parser
+    """
+    parser.add_argument("--metrics", metavar="JSON", type=str, nargs="?", const="", default=None,
+                        help="Write per-stage timing, memory, I/O and subprocess metrics as JSON and CSV. \
+                              Default is svteaser.<command>.metrics.json in the workdir")
+    parser.add_argument("--progress", action="store_true",
+                        help="Log progress with its rate and ETA")
+
+def enabled():
+    """
+    Whether anything is being recorded
+    """
+    return _STATE["spool"] is not None
+
+def is_main():
+    """
+    Whether this is the process that writes the metrics
+    """
+    return _STATE["main_pid"] == os.getpid()
+
+def start_metrics(args, command, workdir):
+    """
+    Start recording a subcommand as its root stage if --metrics was given
+    """
+    _STATE["progress"] = args.progress
+    if args.metrics is None:
+        return
+    _STATE["path"] = args.metrics or os.path.join(workdir, f"svteaser.{command}.metrics.json")
+    _STATE["command"] = command
+    _STATE["started"] = datetime.datetime.now().isoformat(timespec="seconds")
+    _STATE["main_pid"] = os.getpid()
+    _STATE["spool"] = tempfile.mkdtemp(prefix="svteaser_metrics_")
+    os.environ[METRICS_ENV] = _STATE["spool"]
+    _STATE["stack"] = []
+    _STATE["root"] = stage(command)
+    _STATE["root"].__enter__()
+
+def usage():
+    """
+    Snapshot of elapsed time, CPU seconds and bytes read/written by this process and its finished subprocesses
+    """
+    self_use = resource.getrusage(resource.RUSAGE_SELF)
+    child_use = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = self_use.ru_utime + self_use.ru_stime + child_use.ru_utime + child_use.ru_stime
+    try:
+        # Includes the I/O of reaped children
+        with open("/proc/self/io", "r") as fh:
+            io = dict(line.split(": ") for line in fh.read().splitlines())
+        read_bytes, write_bytes = int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        read_bytes = (self_use.ru_inblock + child_use.ru_inblock) * 512
+        write_bytes = (self_use.ru_oublock + child_use.ru_oublock) * 512
+    return time.perf_counter(), cpu, read_bytes, write_bytes
+
+def maxrss_bytes(rusage):
+    """
+    ru_maxrss in bytes
+    """
+    return rusage.ru_maxrss * 1024
+
+def peak_rss():
+    """
+    Peak RSS of this process since the last reset_peak_rss
+    """
+    try:
+        with open("/proc/self/status", "r") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF))
+
+def reset_peak_rss():
+    """
+    Restart peak RSS tracking where Linux allows it. Otherwise peaks are the process' so far
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        pass
+
+def note_peak():
+    """
+    Fold the peak RSS since the last reset into the innermost open stage
+    """
+    peak = peak_rss()
+    if _STATE["stack"]:
+        frame = _STATE["stack"][-1]
+        frame["peak"] = max(frame["peak"], peak)
+    reset_peak_rss()
+    return peak
+
+def send(kind, name, values):
+    """
+    Add a stage's or command's record to this process' totals, or spool it for the main process
+    """
+    if not is_main():
+        try:
+            with open(os.path.join(_STATE["spool"], f"{os.getpid()}.jsonl"), "a") as fout:
+                fout.write(json.dumps({"kind": kind, "name": name, "values": values}) + "\n")
+        except OSError: # the main process already finished
+            pass
+        return
+    table = _STATE[kind]
+    if name not in table:
+        table[name] = dict.fromkeys(FIELDS, 0)
+    totals = table[name]
+    for key, value in values.items():
+        if key in ("peak_rss", "children_peak_rss"):
+            totals[key] = max(totals[key], value)
+        else:
+            totals[key] += value
+
+class stage:
+    """
+    Context manager accounting the enclosed work to a named stage. Nested stages are named parent/child.
+    Wall/CPU/I/O add up over calls and processes. peak_rss is the largest seen
+    """
+    def __init__(self, name):
+        self.name = name
+        self.frame = None
+
+    def __enter__(self):
+        if not enabled():
+            return self
+        stack = _STATE["stack"]
+        name = f"{stack[-1]['name']}/{self.name}" if stack else self.name
+        note_peak()
+        self.frame = {"name": name, "start": usage(), "peak": 0}
+        stack.append(self.frame)
+        return self
+
+    def __exit__(self, *exc):
+        if self.frame is None:
+            return False
+        frame = self.frame
+        self.frame = None
+        peak = note_peak()
+        _STATE["stack"].remove(frame)
+        if _STATE["stack"]:
+            parent = _STATE["stack"][-1]
+            parent["peak"] = max(parent["peak"], frame["peak"], peak)
+        end = usage()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        send("stages", frame["name"], {"calls": 1, "wall": end[0] - frame["start"][0],
+                                       "cpu": end[1] - frame["start"][1],
+                                       "peak_rss": max(frame["peak"], peak),
+                                       "children_peak_rss": maxrss_bytes(children),
+                                       "read_bytes": end[2] - frame["start"][2],
+                                       "write_bytes": end[3] - frame["start"][3],
+                                       "failures": int(exc[0] is not None)})
+        return False
+
+def cmd_exe(cmd, timeout=-1):
+    """
+    acebinf.cmd_exe that, when metrics are on, accounts the command to its program and the current stage.
+    The program's own CPU and peak RSS come from wait4. I/O is the process' while the command ran
+    """
+    if not enabled() or timeout > 0:
+        import acebinf # pulls in pysam, so only loaded by commands that run programs
+        return acebinf.cmd_exe(cmd, timeout)
+    start = usage()
+    with tempfile.TemporaryFile() as out_fh, tempfile.TemporaryFile() as err_fh:
+        proc = subprocess.Popen(cmd, shell=True, stdout=out_fh, stderr=err_fh, close_fds=True,
+                                preexec_fn=os.setsid)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        end = usage()
+        out_fh.seek(0)
+        err_fh.seek(0)
+        ret = cmd_result(proc.returncode, out_fh.read().decode(), err_fh.read(),
+                         datetime.timedelta(seconds=int(end[0] - start[0])))
+    words = cmd.split()
+    program = os.path.basename(words[0]) if words else ""
+    send("commands", program, {"calls": 1, "wall": end[0] - start[0],
+                               "cpu": rusage.ru_utime + rusage.ru_stime,
+                               "peak_rss": maxrss_bytes(rusage),
+                               "read_bytes": end[2] - start[2], "write_bytes": end[3] - start[3],
+                               "failures": int(ret.ret_code != 0)})
+    stack = _STATE["stack"]
+    send("launches", stack[-1]["name"] if stack else "", {"calls": 1})
+    return ret
+
+def report_progress(label, done, total, every=50):
+    """
+    Log that done of total label are processed. Normally every `every` items, with --progress every
+    PROGRESS_INTERVAL seconds along with the rate and ETA
+    """
+    if not _STATE["progress"]:
+        if done % every == 0:
+            logging.info(f"Processed {done}/{total} {label}...")
+        return
+    now = time.time()
+    marks = _STATE["progress_marks"]
+    if label not in marks:
+        # The rate is measured from the first report so resumed runs aren't credited for earlier work
+        marks[label] = {"start": now, "first": done, "last": now}
+        return
+    mark = marks[label]
+    if now - mark["last"] < PROGRESS_INTERVAL and done < total:
+        return
+    mark["last"] = now
+    rate = (done - mark["first"]) / max(now - mark["start"], 1e-9)
+    eta = datetime.timedelta(seconds=round((total - done) / rate)) if rate > 0 else "?"
+    logging.info(f"Processed {done}/{total} {label} ({rate:.2f}/s, ETA {eta})")
+
+def merge_spool():
+    """
+    Add the records other processes spooled
+    """
+    for name in sorted(os.listdir(_STATE["spool"])):
+        with open(os.path.join(_STATE["spool"], name), "r") as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError: # a worker killed mid-write
+                    continue
+                send(record["kind"], record["name"], record["values"])
+
+def metrics_rows():
+    """
+    Stage then command rows with every field
+    """
+    launches = _STATE["launches"]
+    rows = []
+    for name, totals in _STATE["stages"].items():
+        totals["subprocesses"] = sum(count["calls"] for launch, count in launches.items()
+                                     if launch == name or launch.startswith(name + "/"))
+        rows.append(OrderedDict([("kind", "stage"), ("name", name)] + list(totals.items())))
+    for name, totals in _STATE["commands"].items():
+        totals["subprocesses"] = totals["calls"]
+        rows.append(OrderedDict([("kind", "command"), ("name", name)] + list(totals.items())))
+    return rows
+
+def write_atomic(path, write):
+    """
+    Write a file through a temporary so hard links (e.g. into the cache) are never modified
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w", newline="") as fout:
+        write(fout)
+    os.replace(tmp_path, path)
+
+def finish_metrics(status=0):
+    """
+    Close the root stage and write the metrics. Does nothing outside of the process that started them
+    """
+    if not is_main() or _STATE["path"] is None:
+        return
+    _STATE["root"].__exit__(SystemExit if status else None, None, None)
+    merge_spool()
+    shutil.rmtree(_STATE["spool"], ignore_errors=True)
+    os.environ.pop(METRICS_ENV, None)
+    _STATE["spool"] = None
+    _STATE["main_pid"] = None
+
+    rows = metrics_rows()
+    doc = {"command": _STATE["command"], "started": _STATE["started"], "status": status,
+           "stages": [row for row in rows if row["kind"] == "stage"],
+           "commands": [row for row in rows if row["kind"] == "command"]}
+    json_path = _STATE["path"]
+    csv_path = (json_path[:-len(".json")] if json_path.endswith(".json") else json_path) + ".csv"
+    try:
+        write_atomic(json_path, lambda fout: json.dump(doc, fout, indent=4))
+        def write_csv(fout):
+            writer = csv.DictWriter(fout, fieldnames=["kind", "name"] + FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        write_atomic(csv_path, write_csv)
+    except OSError as e:
+        logging.warning(f"Unable to write metrics to {json_path} ({e})")
+        return
+    logging.info(f"Wrote metrics to {json_path} and {csv_path}")
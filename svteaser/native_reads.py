@@ -0,0 +1,156 @@
+"""
+Vectorized paired-end read simulation that replaces art_illumina
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pysam
+
+from svteaser.utils import BgzfWriter
+
+# Sequences are handled as codes 0-3 for ACGT and 4 for anything else
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    ENCODE[_base] = _code
+    ENCODE[ord(chr(_base).lower())] = _code
+DECODE = np.frombuffer(b"ACGTN", dtype=np.uint8)
+COMPLEMENT = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+def encode_seq(seq):
+    """
+    Turn a sequence string into an array of base codes
+    """
+    return ENCODE[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+def cycle_error_rates(readlen, sub_start, sub_end):
+    """
+    Per-cycle substitution rates rising linearly along the read
+    """
+    return np.linspace(sub_start, sub_end, readlen)
+
+def cycle_qualities(rates):
+    """
+    Phred+33 quality line matching the per-cycle error rates
+    """
+    quals = np.clip(np.round(-10 * np.log10(rates)), 2, 41).astype(np.uint8) + 33
+    return quals
+
+def add_errors(rng, ext_reads, rates, indel_rate):
+    """
+    Apply the error model to reads extracted with one extra trailing base.
+    Each read gets at most one indel (with probability indel_rate) and per-cycle substitutions.
+    Returns the (n, readlen) read codes
+    """
+    num, ext_len = ext_reads.shape
+    readlen = ext_len - 1
+    reads = ext_reads[:, :readlen].copy()
+
+    # Only the few reads with an indel are rebuilt. A deletion skips the base at the indel
+    # position and an insertion puts a random base there
+    rows = np.flatnonzero(rng.random(num) < indel_rate)
+    if len(rows):
+        cols = np.arange(readlen)[None, :]
+        is_del = (rng.random(len(rows)) < 0.5)[:, None]
+        indel_pos = rng.integers(0, readlen, len(rows))[:, None]
+        src = cols + (is_del & (cols >= indel_pos)) - (~is_del & (cols > indel_pos))
+        indel_reads = np.take_along_axis(ext_reads[rows], src, axis=1)
+        inserted = ~is_del & (cols == indel_pos)
+        indel_reads[inserted] = rng.integers(0, 4, int(inserted.sum()))
+        reads[rows] = indel_reads
+
+    # Draw how many substitutions land in each cycle, then which reads get them.
+    # Substitutions always change the base
+    counts = rng.binomial(num, rates)
+    sub_rows = rng.integers(0, num, int(counts.sum()))
+    sub_cols = np.repeat(np.arange(readlen), counts)
+    bases = reads[sub_rows, sub_cols]
+    called = bases < 4
+    shift = rng.integers(1, 4, len(bases)).astype(np.uint8)
+    reads[sub_rows[called], sub_cols[called]] = (bases[called] + shift[called]) % 4
+    return reads
+
+def format_fastq(name, first, reads, qual, mate):
+    """
+    Build the fastq bytes for a batch of reads named @name-<number>/mate, numbered from first + 1.
+    Reads whose numbers have the same number of digits are laid out as fixed-width records in one buffer
+    """
+    num, readlen = reads.shape
+    head = np.frombuffer(f"@{name}-".encode(), dtype=np.uint8)
+    tail = np.frombuffer(f"/{mate}\n".encode(), dtype=np.uint8)
+    chunks = []
+    start = 0
+    while start < num:
+        digits = len(str(first + start + 1))
+        stop = min(num, 10 ** digits - 1 - first)
+        ids = np.arange(first + start + 1, first + stop + 1)
+        seq_at = len(head) + digits + len(tail)
+        body = np.empty((stop - start, seq_at + 2 * readlen + 4), dtype=np.uint8)
+        body[:, :len(head)] = head
+        for col in range(digits):
+            body[:, len(head) + col] = ids // 10 ** (digits - 1 - col) % 10 + ord("0")
+        body[:, len(head) + digits:seq_at] = tail
+        body[:, seq_at:seq_at + readlen] = DECODE[reads[start:stop]]
+        body[:, seq_at + readlen:seq_at + readlen + 3] = np.frombuffer(b"\n+\n", dtype=np.uint8)
+        body[:, seq_at + readlen + 3:-1] = qual
+        body[:, -1] = ord("\n")
+        chunks.append(body.tobytes())
+        start = stop
+    return b"".join(chunks)
+
+def simulate_pairs(rng, seq, num_pairs, readlen, meanfrag, insertsd, rates, indel_rate):
+    """
+    Simulate read pairs over an encoded sequence.
+    Returns read1 and read2 codes as (num_pairs, readlen) arrays
+    """
+    seq_len = len(seq)
+    frags = np.rint(rng.normal(meanfrag, insertsd, num_pairs)).astype(np.int64)
+    frags = np.clip(frags, readlen + 1, seq_len)
+    starts = (rng.random(num_pairs) * (seq_len - frags + 1)).astype(np.int64)
+    ends = starts + frags
+
+    windows = np.lib.stride_tricks.sliding_window_view(seq, readlen + 1)
+    # Forward mate reads from the fragment start, reverse mate back from the fragment end
+    fwd = windows[starts]
+    rev = COMPLEMENT[windows[ends - readlen - 1]][:, ::-1]
+    fwd = add_errors(rng, fwd, rates, indel_rate)
+    rev = add_errors(rng, rev, rates, indel_rate)
+
+    # Half of the fragments come from the reverse strand
+    flip = rng.random(num_pairs) < 0.5
+    read1 = np.where(flip[:, None], rev, fwd)
+    read2 = np.where(flip[:, None], fwd, rev)
+    return read1, read2
+
+def sim_reads_native(alt_ref, out_path, coverage=30, readlen=150, meanfrag=400, insertsd=50, seed=None,
+                     sub_start=0.001, sub_end=0.01, indel_rate=0.001, batch_size=200000, compress_threads=2):
+    """
+    Simulate paired-end reads over every sequence in alt_ref, writing out_path1.fq.gz and out_path2.fq.gz (bgzf)
+    Coverage follows art's definition of pairs = coverage * length / (2 * readlen)
+    """
+    rng = np.random.default_rng(seed)
+    rates = cycle_error_rates(readlen, sub_start, sub_end)
+    qual = cycle_qualities(rates)
+    fasta = pysam.FastaFile(alt_ref)
+    executor = ThreadPoolExecutor(max(1, compress_threads))
+    out1 = BgzfWriter(f"{out_path}1.fq.gz", executor=executor)
+    out2 = BgzfWriter(f"{out_path}2.fq.gz", executor=executor)
+    total = 0
+    for name in fasta.references:
+        length = fasta.get_reference_length(name)
+        if length <= readlen:
+            logging.warning(f"Skipping {name} which is shorter than the read length")
+            continue
+        seq = encode_seq(fasta.fetch(name))
+        num_pairs = int(coverage * length / (2 * readlen))
+        for first in range(0, num_pairs, batch_size):
+            num = min(batch_size, num_pairs - first)
+            read1, read2 = simulate_pairs(rng, seq, num, readlen, meanfrag, insertsd, rates, indel_rate)
+            out1.write(format_fastq(name, first, read1, qual, 1))
+            out2.write(format_fastq(name, first, read2, qual, 2))
+        total += num_pairs
+    out1.close()
+    out2.close()
+    executor.shutdown()
+    logging.info(f"Simulated {total} read pairs")
+    return total
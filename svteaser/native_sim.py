@@ -0,0 +1,130 @@
+"""
+In-process INS/DEL simulation that replaces per-region SURVIVOR simSV calls
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+# SURVIVOR simSV's default parameter file, used when SURVIVOR isn't available
+DEFAULT_SURV_PARAMS = OrderedDict([("PARAMETER FILE", "DO JUST MODIFY THE VALUES AND KEEP THE SPACES!"),
+                                   ("DUPLICATION_minimum_length", 100),
+                                   ("DUPLICATION_maximum_length", 10000),
+                                   ("DUPLICATION_number", 3),
+                                   ("INDEL_minimum_length", 20),
+                                   ("INDEL_maximum_length", 500),
+                                   ("INDEL_number", 1),
+                                   ("TRANSLOCATION_minimum_length", 1000),
+                                   ("TRANSLOCATION_maximum_length", 3000),
+                                   ("TRANSLOCATION_number", 2),
+                                   ("INVERSION_minimum_length", 600),
+                                   ("INVERSION_maximum_length", 800),
+                                   ("INVERSION_number", 4),
+                                   ("INV_del_minimum_length", 600),
+                                   ("INV_del_maximum_length", 800),
+                                   ("INV_del_number", 2),
+                                   ("INV_dup_minimum_length", 600),
+                                   ("INV_dup_maximum_length", 800),
+                                   ("INV_dup_number", 2)])
+
+# SV types in the params file that the native engine does not simulate
+UNSUPPORTED_TYPES = ["DUPLICATION", "TRANSLOCATION", "INVERSION", "INV_del", "INV_dup"]
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+VCF_HEADER = """\
+##fileformat=VCFv4.2
+##source=SVTeaser
+{contigs}
+##FILTER=<ID=PASS,Description="All filters passed">
+##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">
+##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length of structural variant">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE
+"""
+
+def check_params(params):
+    """
+    Warn about any SV types requested in the params that won't be simulated
+    """
+    for svtype in UNSUPPORTED_TYPES:
+        if params.get(f"{svtype}_number", 0):
+            logging.warning("Native engine only simulates INS/DEL. Ignoring %s_number", svtype)
+
+def random_seq(rng, length):
+    """
+    Make a random nucleotide sequence
+    """
+    return BASES[rng.integers(0, 4, length)].tobytes().decode()
+
+def place_events(rng, seq_len, footprints, padding=0):
+    """
+    Choose anchor positions for non-overlapping events with the given footprints
+    (number of reference bases each event spans) so none fall in the padding.
+    Returns the 0-based anchor of each event, or None if they cannot fit.
+    """
+    slack = seq_len - 2 * padding - int(footprints.sum())
+    if slack < 0:
+        return None
+    offsets = np.sort(rng.integers(0, slack + 1, len(footprints)))
+    before = np.concatenate(([0], np.cumsum(footprints)[:-1]))
+    return padding + offsets + before
+
+def simulate_indels(seq, params, padding=0, rng=None):
+    """
+    Spike random insertions and deletions into seq according to the surv_params
+    INDEL_number/INDEL_minimum_length/INDEL_maximum_length fields.
+    Returns the altered sequence and a list of (pos, svtype, svlen, ref, alt) with 0-based positions
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    num = params["INDEL_number"]
+    lengths = rng.integers(params["INDEL_minimum_length"], params["INDEL_maximum_length"] + 1, num)
+    is_del = rng.integers(0, 2, num).astype(bool)
+
+    # An INS spans its anchor base. A DEL spans its anchor plus the deleted bases
+    footprints = np.where(is_del, lengths + 1, 1)
+    anchors = place_events(rng, len(seq), footprints, padding)
+    while anchors is None:
+        if num == 0:
+            logging.warning("Region too short to simulate INDELs")
+            return seq, []
+        num -= 1
+        logging.warning("Region too short for requested INDELs. Simulating %d", num)
+        lengths, is_del, footprints = lengths[:num], is_del[:num], footprints[:num]
+        anchors = place_events(rng, len(seq), footprints, padding)
+
+    pieces = []
+    events = []
+    last = 0
+    for anchor, length, deletion in sorted(zip(anchors.tolist(), lengths.tolist(), is_del.tolist())):
+        if deletion:
+            ref = seq[anchor:anchor + length + 1]
+            alt = seq[anchor]
+            events.append((anchor, "DEL", length, ref, alt))
+        else:
+            ref = seq[anchor]
+            alt = ref + random_seq(rng, length)
+            events.append((anchor, "INS", length, ref, alt))
+        pieces.append(seq[last:anchor])
+        pieces.append(alt)
+        last = anchor + len(ref)
+    pieces.append(seq[last:])
+    return "".join(pieces), events
+
+def make_vcf_header(contigs):
+    """
+    Build the VCF header text for the given [(name, length)] contigs
+    """
+    contig_lines = "\n".join(f"##contig=<ID={name},length={length}>" for name, length in contigs)
+    return VCF_HEADER.format(contigs=contig_lines)
+
+def format_records(chrom, events):
+    """
+    Turn simulate_indels events into VCF record lines
+    """
+    records = []
+    for i, (pos, svtype, svlen, ref, alt) in enumerate(events):
+        records.append(f"{chrom}\t{pos + 1}\t{svtype}{i:03d}SVT\t{ref}\t{alt}\t.\tPASS\t"
+                       f"SVTYPE={svtype};SVLEN={svlen}\tGT\t1/1\n")
+    return records
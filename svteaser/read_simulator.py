@@ -1,51 +1,152 @@
 import os
+import heapq
+import random
+import shutil
 import inspect
 import logging
 import argparse
+import multiprocessing
+
+import pysam
 
 from truvari import setup_logging
-from acebinf import cmd_exe
 
-from svteaser.utils import check_gzip, check_samtools
+from svteaser.utils import check_samtools, add_fasta_entry, FifoCompressor, concat_bgzf
+from svteaser.native_reads import sim_reads_native
+from svteaser.downsample import downsample_reads, parse_sim_reads_dirname, DOWNSAMPLE_INFO
+from svteaser.cache import add_cache_args, cache_key, cached_run
+from svteaser.metrics import cmd_exe, stage, add_metrics_args, start_metrics
+
+def sim_reads_dirname(coverage, readlen, meanfrag, insertsd, instrument):
+    """
+    Name of the directory in the workdir holding a set of simulated reads
+    """
+    return "sim_reads_{}_{}_{}_{}_{}".format(coverage, readlen, meanfrag, insertsd, instrument)
+
+def run_art(alt_ref, out_path, coverage, readlen, meanfrag, insertsd, instrument, seed=None):
+    """
+    Run a single art_illumina process
+    """
+    seed_opt = f" -rs {seed}" if seed is not None else ""
+    return cmd_exe((f"art_illumina -ss {instrument} -sam -na -i {alt_ref} -p "
+                    f"-l {readlen} -m {meanfrag} -s {insertsd} -f {coverage} -o {out_path}{seed_opt}"))
+
+def check_art(ret):
+    """
+    Exit if art_illumina failed
+    """
+    if ret.ret_code != 0:
+        logging.error("Problem running art_illumina")
+        logging.error(ret.stderr)
+        logging.error(ret.stdout)
+        exit(ret.ret_code)
+
+def shard_fasta(fasta, num_shards, prefix):
+    """
+    Split a multi-fasta into shards with balanced total bases by assigning the longest
+    sequences first to the least loaded shard.
+    Returns the paths of the (non-empty) shard fastas
+    """
+    fa = pysam.FastaFile(fasta)
+    loads = [(0, idx) for idx in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for length, name in sorted(zip(fa.lengths, fa.references), reverse=True):
+        load, idx = heapq.heappop(loads)
+        shards[idx].append(name)
+        heapq.heappush(loads, (load + length, idx))
+
+    paths = []
+    order = {name: idx for idx, name in enumerate(fa.references)}
+    for idx, names in enumerate(shards):
+        if not names:
+            continue
+        path = f"{prefix}{idx}.fa"
+        with open(path, "w") as fh:
+            for name in sorted(names, key=order.get):
+                add_fasta_entry(name, fa.fetch(name), fh)
+        paths.append(path)
+    return paths
 
-def sim_reads_art(workdir, coverage=30, readlen=150, meanfrag=400, insertsd=50, instrument="HS25", keep_bam=False):
+def merge_sams(sam_paths, out_sam):
+    """
+    Concatenate art's per-shard sams, combining their @SQ header lines
+    """
+    # @HD first, then every shard's @SQ, then the rest of the first shard's header
+    other_header = []
+    with open(out_sam, "w") as fout:
+        for idx, path in enumerate(sam_paths):
+            with open(path, "r") as fh:
+                for line in fh:
+                    if not line.startswith("@"):
+                        break
+                    if line.startswith("@SQ") or (idx == 0 and line.startswith("@HD")):
+                        fout.write(line)
+                    elif idx == 0:
+                        other_header.append(line)
+        fout.write("".join(other_header))
+        for path in sam_paths:
+            with open(path, "r") as fh:
+                for line in fh:
+                    if not line.startswith("@"):
+                        fout.write(line)
+
+def sim_reads_art(workdir, coverage=30, readlen=150, meanfrag=400, insertsd=50, instrument="HS25", keep_bam=False,
+                  threads=1, seed=None, compress_threads=2):
     """
     Run art_illumina read simulator
+    With threads > 1, the altered reference is split into base-balanced shards that each get their own
+    art_illumina process and seed. The shards' reads are concatenated into the usual outputs.
+    Reads are bgzf compressed on compress_threads threads while art runs.
     """
     ret = cmd_exe("which art_illumina")
     if ret.ret_code != 0:
         logging.error("Cannot find art_illumina executable in the environment")
         exit(ret.ret_code)
-    try:
-        os.chdir(workdir)
-    except OSError:
-        logging.error(f"Cannot change into {workdir} directory")
+    if not os.path.isdir(workdir):
+        logging.error(f"Cannot find {workdir} directory")
         exit(1)
-    alt_ref = 'svteaser.altered.fa'
+    alt_ref = os.path.join(workdir, 'svteaser.altered.fa')
 
-    outdir = "sim_reads_{}_{}_{}_{}_{}".format(coverage, readlen, meanfrag, insertsd, instrument)
+    outdir = os.path.join(workdir, sim_reads_dirname(coverage, readlen, meanfrag, insertsd, instrument))
     os.mkdir(outdir)
     # Useful when running on same altered reference but different parameters
     out_path = os.path.join(outdir, "art_illumina.simReads")
-    ret = cmd_exe((f"art_illumina -ss {instrument} -sam -na -i {alt_ref} -p "
-                   f"-l {readlen} -m {meanfrag} -s {insertsd} -f {coverage} -o {out_path}"))
-    if ret.ret_code != 0:
-        logging.error("Problem running art_illumina")
-        logging.error(ret.stderr)
-        logging.error(ret.stdout)
-        exit(ret.ret_code)
+    # art writes its fastqs into named pipes that are bgzf compressed as the reads are produced
+    if threads <= 1:
+        with stage("art"), FifoCompressor([out_path + "1.fq", out_path + "2.fq"], threads=compress_threads):
+            ret = run_art(alt_ref, out_path, coverage, readlen, meanfrag, insertsd, instrument, seed)
+        check_art(ret)
+    else:
+        if seed is None:
+            seed = random.randint(0, 2**31 - 1)
+            logging.info(f"Using seed {seed}")
+        with stage("shard"):
+            shard_refs = shard_fasta(alt_ref, threads, os.path.join(outdir, "shard"))
+        shard_outs = [shard_ref[:-len(".fa")] + ".simReads" for shard_ref in shard_refs]
+        jobs = [(shard_ref, shard_out, coverage, readlen, meanfrag, insertsd, instrument, seed + idx)
+                for idx, (shard_ref, shard_out) in enumerate(zip(shard_refs, shard_outs))]
+        # The pool's workers are forked before the compression threads start
+        with stage("art"), multiprocessing.Pool(threads) as pool:
+            fifos = [shard_out + mate for shard_out in shard_outs for mate in ["1.fq", "2.fq"]]
+            with FifoCompressor(fifos, threads=compress_threads):
+                rets = pool.starmap(run_art, jobs, chunksize=1)
+        for ret in rets:
+            check_art(ret)
+
+        with stage("merge_shards"):
+            for mate in ["1.fq", "2.fq"]:
+                concat_bgzf([shard_out + mate + ".gz" for shard_out in shard_outs], out_path + mate + ".gz")
+            merge_sams([shard_out + ".sam" for shard_out in shard_outs], out_path + ".sam")
+        for shard_ref, shard_out in zip(shard_refs, shard_outs):
+            for path in [shard_ref, shard_ref + ".fai", shard_out + "1.fq.gz", shard_out + "2.fq.gz",
+                         shard_out + ".sam"]:
+                if os.path.exists(path):
+                    os.remove(path)
 
-    # Optionally compress fq
-    if check_gzip():
-        ret = cmd_exe((f"gzip {out_path}1.fq"))
-        if ret.ret_code != 0:
-            logging.info(f"Could not compress {out_path}1.fq")
-        ret = cmd_exe((f"gzip {out_path}2.fq"))
-        if ret.ret_code != 0:
-            logging.info(f"Could not compress {out_path}2.fq")
     if keep_bam:
         if check_samtools():
-            ret = cmd_exe((f"samtools view -S -b {out_path}.sam > {out_path}.bam"))
+            with stage("bam"):
+                ret = cmd_exe((f"samtools view -S -b {out_path}.sam > {out_path}.bam"))
             if ret.ret_code != 0:
                 logging.info(f"Could not compress {out_path}.sam")
             else:
@@ -53,19 +154,113 @@ def sim_reads_art(workdir, coverage=30, readlen=150, meanfrag=400, insertsd=50,
     else:
         os.remove(f"{out_path}.sam")
 
+def sim_reads_native_main(workdir, coverage=30, readlen=150, meanfrag=400, insertsd=50, seed=None, compress_threads=2):
+    """
+    Run the built-in read simulator into the same directory layout as art
+    """
+    alt_ref = os.path.join(workdir, 'svteaser.altered.fa')
+    outdir = os.path.join(workdir, sim_reads_dirname(coverage, readlen, meanfrag, insertsd, "native"))
+    os.mkdir(outdir)
+    out_path = os.path.join(outdir, "art_illumina.simReads")
+    with stage("native_reads"):
+        sim_reads_native(alt_ref, out_path, coverage=coverage, readlen=readlen, meanfrag=meanfrag,
+                         insertsd=insertsd, seed=seed, compress_threads=compress_threads)
+
+def resolve_downsample_source(workdir, source):
+    """
+    Find the sim_reads directory to downsample, which may be given relative to the workdir
+    Returns the source path and its (coverage, readlen, meanfrag, insertsd, instrument)
+    """
+    if not os.path.isdir(source) and os.path.isdir(os.path.join(workdir, source)):
+        source = os.path.join(workdir, source)
+    try:
+        return source, parse_sim_reads_dirname(source)
+    except ValueError as e:
+        logging.error(str(e))
+        exit(1)
+
+def sim_reads_downsample_main(workdir, source, coverage, seed=0, compress_threads=2):
+    """
+    Subsample an existing sim_reads directory's pairs down to coverage
+    """
+    source, (_, readlen, meanfrag, insertsd, instrument) = resolve_downsample_source(workdir, source)
+    outdir = os.path.join(workdir, sim_reads_dirname(coverage, readlen, meanfrag, insertsd, instrument))
+    with stage("downsample"):
+        downsample_reads(source, outdir, coverage, seed=seed, compress_threads=compress_threads)
+
+def sim_reads_cache_inputs(args):
+    """
+    The output directory of a sim_reads run and the params/files that determine it
+    """
+    if args.downsample_from:
+        source, (_, readlen, meanfrag, insertsd, instrument) = resolve_downsample_source(args.workdir,
+                                                                                        args.downsample_from)
+        outdir = sim_reads_dirname(args.coverage, readlen, meanfrag, insertsd, instrument)
+        params = {"coverage": args.coverage, "seed": 0 if args.seed is None else args.seed}
+        files = {name: os.path.join(source, name) for name in ["art_illumina.simReads1.fq.gz",
+                                                               "art_illumina.simReads2.fq.gz",
+                                                               "art_illumina.simReads.bam",
+                                                               "art_illumina.simReads.sam",
+                                                               DOWNSAMPLE_INFO]
+                 if os.path.exists(os.path.join(source, name))}
+        return os.path.join(args.workdir, outdir), params, files
+
+    instrument = "native" if args.engine == "native" else args.seq_inst
+    outdir = sim_reads_dirname(args.coverage, args.read_len, args.mean_frag, args.insert_sd, instrument)
+    params = {"engine": args.engine, "coverage": args.coverage, "read_len": args.read_len,
+              "mean_frag": args.mean_frag, "insert_sd": args.insert_sd, "seed": args.seed}
+    files = {"altered": os.path.join(args.workdir, "svteaser.altered.fa")}
+    if args.engine == "art":
+        # Sharding changes which reads art makes, as does a different art build
+        params.update({"keep_bam": args.keep_bam, "shards": max(1, args.threads)})
+        files["art"] = shutil.which("art_illumina")
+    return os.path.join(args.workdir, outdir), params, files
+
+def run_sim_reads(args):
+    """
+    Simulate (or downsample) the reads
+    """
+    if args.downsample_from:
+        sim_reads_downsample_main(args.workdir, args.downsample_from, args.coverage,
+                                  seed=0 if args.seed is None else args.seed,
+                                  compress_threads=args.compress_threads)
+    elif args.engine == "native":
+        sim_reads_native_main(args.workdir,
+                              coverage=args.coverage,
+                              readlen=args.read_len,
+                              meanfrag=args.mean_frag,
+                              insertsd=args.insert_sd,
+                              seed=args.seed,
+                              compress_threads=args.compress_threads)
+    else:
+        sim_reads_art(args.workdir,
+                      coverage=args.coverage,
+                      readlen=args.read_len,
+                      meanfrag=args.mean_frag,
+                      insertsd=args.insert_sd,
+                      instrument=args.seq_inst,
+                      keep_bam=args.keep_bam,
+                      threads=args.threads,
+                      seed=args.seed,
+                      compress_threads=args.compress_threads)
+
 def sim_reads_main(args):
     """
     Run read simulators
     """
     args = parseArgs(args)
+    if args.seed is None and not args.downsample_from:
+        # Chosen before the cache key so unseeded runs don't all share one cache entry
+        args.seed = random.randint(0, 2**31 - 1)
+        logging.info(f"Using seed {args.seed}")
+    outdir, params, files = sim_reads_cache_inputs(args)
+    start_metrics(args, "sim_reads", outdir)
     # Run the commands
-    sim_reads_art(args.workdir,
-                  coverage=args.coverage,
-                  readlen=args.read_len,
-                  meanfrag=args.mean_frag,
-                  insertsd=args.insert_sd,
-                  instrument=args.seq_inst,
-                  keep_bam=args.keep_bam)
+    if args.cache:
+        key = cache_key(args.cache, "sim_reads", params, files)
+        cached_run(args.cache, key, outdir, lambda: run_sim_reads(args), args.cache_size * 1024**3)
+    else:
+        run_sim_reads(args)
     logging.info("Finished")
 
 def parseArgs(args):
@@ -89,9 +284,20 @@ def parseArgs(args):
                         help="Sequencing instrument (%(default)s)")
     parser.add_argument("--keep-bam", action="store_true",
                         help="Keep the simulated reads' sam/bam file")
-    parser.add_argument("--out-dir", type=str, required=False,
-                        help="Output directory to save the results to. If unspecified, \
-                              will save the results at DIR")
+    parser.add_argument("--engine", type=str, default="art", choices=["art", "native"],
+                        help="Read simulator. native is built-in and writes no sam/bam (%(default)s)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of art_illumina processes to run on shards of the altered reference (%(default)s)")
+    parser.add_argument("--compress-threads", type=int, default=2,
+                        help="Number of threads compressing the fastqs (%(default)s)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Read simulator random seed. Shards use seed + shard number. A random seed is picked \
+                              and logged if unset. With --downsample-from, seeds the read name hash (0)")
+    parser.add_argument("--downsample-from", metavar="SIM_DIR", type=str, default=None,
+                        help="Subsample an existing higher coverage sim_reads directory to --coverage \
+                              instead of simulating")
+    add_cache_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args(args)
     setup_logging()
     return args
@@ -0,0 +1,158 @@
+"""
+Reference sidecar cache (ref.fa.svtidx) holding contig lengths, N-gap intervals and
+valid window bitmaps so repeated runs don't re-scan the reference
+"""
+import os
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pysam
+
+INDEX_VERSION = 1
+
+def ref_index_path(ref_file):
+    """
+    Path of the reference's sidecar cache
+    """
+    return ref_file + ".svtidx"
+
+def ref_fingerprint(ref_file):
+    """
+    Identify the reference by its .fai contents and the FASTA's size/mtime
+    """
+    md5 = hashlib.md5()
+    with open(ref_file + ".fai", 'rb') as fh:
+        md5.update(fh.read())
+    stat = os.stat(ref_file)
+    return f"v{INDEX_VERSION}:{md5.hexdigest()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def scan_gaps(ref, chrom, chunk_size=10000000):
+    """
+    Find the [start, end) intervals of N runs in a chromosome
+    Returns a numpy array of shape (n, 2)
+    """
+    starts = []
+    ends = []
+    length = ref.get_reference_length(chrom)
+    for chunk_start in range(0, length, chunk_size):
+        seq = ref.fetch(chrom, chunk_start, min(chunk_start + chunk_size, length)).encode()
+        bases = np.frombuffer(seq, dtype=np.uint8)
+        is_gap = np.concatenate(([0], (bases == ord("N")) | (bases == ord("n")), [0])).astype(np.int8)
+        edges = np.diff(is_gap)
+        starts.append(np.flatnonzero(edges == 1) + chunk_start)
+        ends.append(np.flatnonzero(edges == -1) + chunk_start)
+    if not starts:
+        return np.zeros((0, 2), dtype=np.int64)
+    gaps = np.stack([np.concatenate(starts), np.concatenate(ends)], axis=1)
+    # Merge runs that were split by a chunk boundary
+    if len(gaps) > 1:
+        keep = np.concatenate(([True], gaps[1:, 0] != gaps[:-1, 1]))
+        merged_starts = gaps[keep, 0]
+        merged_ends = gaps[np.concatenate((keep[1:], [True])), 1]
+        gaps = np.stack([merged_starts, merged_ends], axis=1)
+    return gaps
+
+def window_mask(length, gaps, window):
+    """
+    Boolean mask of the non-overlapping windows in a chromosome that don't touch a gap
+    """
+    num_windows = length // window
+    cover = np.zeros(num_windows + 1, dtype=np.int64)
+    first = gaps[:, 0] // window
+    last = np.minimum((gaps[:, 1] - 1) // window + 1, num_windows)
+    inside = first < num_windows
+    np.add.at(cover, first[inside], 1)
+    np.add.at(cover, last[inside], -1)
+    return np.cumsum(cover[:-1]) == 0
+
+def build_ref_index(ref_file):
+    """
+    Scan the reference for contig lengths and gaps
+    """
+    logging.info("Building reference index %s", ref_index_path(ref_file))
+    ref = pysam.FastaFile(ref_file)
+    lengths = OrderedDict((chrom, ref.get_reference_length(chrom)) for chrom in ref.references)
+    gaps = OrderedDict((chrom, scan_gaps(ref, chrom)) for chrom in ref.references)
+    return {"fingerprint": ref_fingerprint(ref_file), "lengths": lengths, "gaps": gaps, "windows": {}}
+
+def save_ref_index(ref_file, index):
+    """
+    Write the index next to the reference. Skipped with a warning if the directory isn't writable
+    """
+    chroms = list(index["lengths"].keys())
+    gap_counts = [len(index["gaps"][chrom]) for chrom in chroms]
+    data = {"fingerprint": np.array(index["fingerprint"]),
+            "contigs": np.array(chroms),
+            "lengths": np.array([index["lengths"][chrom] for chrom in chroms], dtype=np.int64),
+            "gap_offsets": np.concatenate(([0], np.cumsum(gap_counts))).astype(np.int64),
+            "gaps": (np.concatenate([index["gaps"][chrom] for chrom in chroms])
+                     if chroms else np.zeros((0, 2), dtype=np.int64))}
+    for window, masks in index["windows"].items():
+        data[f"windows_{window}"] = np.packbits(np.concatenate([masks[chrom] for chrom in chroms]))
+
+    out_path = ref_index_path(ref_file)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path), suffix=".svtidx.tmp")
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez_compressed(fh, **data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    except OSError as e:
+        logging.warning("Unable to write reference index %s (%s)", out_path, e)
+
+def load_ref_index(ref_file):
+    """
+    Load the reference's sidecar cache, (re)building it if missing or stale
+    """
+    # Opening the reference makes sure the .fai exists
+    pysam.FastaFile(ref_file).close()
+    path = ref_index_path(ref_file)
+    fingerprint = ref_fingerprint(ref_file)
+    if os.path.exists(path):
+        try:
+            # Arrays read out of the npz are copies, so they outlive the handle
+            with np.load(path) as data:
+                if str(data["fingerprint"]) == fingerprint:
+                    chroms = [str(chrom) for chrom in data["contigs"]]
+                    lengths = OrderedDict(zip(chroms, data["lengths"].tolist()))
+                    offsets = data["gap_offsets"]
+                    all_gaps = data["gaps"]
+                    gaps = OrderedDict((chrom, all_gaps[offsets[i]:offsets[i + 1]])
+                                       for i, chrom in enumerate(chroms))
+                    windows = {}
+                    for key in data.files:
+                        if not key.startswith("windows_"):
+                            continue
+                        window = int(key[len("windows_"):])
+                        bits = np.unpackbits(data[key]).astype(bool)
+                        masks = OrderedDict()
+                        pos = 0
+                        for chrom in chroms:
+                            num_windows = lengths[chrom] // window
+                            masks[chrom] = bits[pos:pos + num_windows]
+                            pos += num_windows
+                        windows[window] = masks
+                    logging.debug("Loaded reference index %s", path)
+                    return {"fingerprint": fingerprint, "lengths": lengths, "gaps": gaps, "windows": windows}
+            logging.info("Reference changed since %s was built", path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Unable to read reference index %s (%s)", path, e)
+
+    index = build_ref_index(ref_file)
+    save_ref_index(ref_file, index)
+    return index
+
+def valid_windows(ref_file, window):
+    """
+    Find every non-overlapping window of `window` bases in the reference that doesn't contain an N.
+    Returns an OrderedDict of {chrom: numpy array of valid window indices}
+    """
+    index = load_ref_index(ref_file)
+    if window not in index["windows"]:
+        index["windows"][window] = OrderedDict((chrom, window_mask(length, index["gaps"][chrom], window))
+                                               for chrom, length in index["lengths"].items())
+        save_ref_index(ref_file, index)
+    return OrderedDict((chrom, np.flatnonzero(mask)) for chrom, mask in index["windows"][window].items())
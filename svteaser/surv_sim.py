@@ -1,23 +1,31 @@
 import os
-import math
+import glob
+import json
+import random
 import shutil
 import inspect
+import itertools
 import logging
 import argparse
 import subprocess
+import multiprocessing
 from collections import OrderedDict
-from random import randint
 
-from acebinf import cmd_exe
 from truvari import setup_logging
-from svteaser.vcfeditor import update_vcf, recalibrate_vcf
+from svteaser.vcfeditor import update_vcf, lift_record
 from svteaser.utils import vcf_compress, add_fasta_entry
-import pandas as pd
+from svteaser.ref_index import valid_windows
+from svteaser.cache import add_cache_args, cache_key, cached_run
+from svteaser.metrics import cmd_exe, stage, add_metrics_args, start_metrics, report_progress
+from svteaser.liftover import REGION_EVENTS, format_region, record_event, write_region_index
+from svteaser.native_sim import (DEFAULT_SURV_PARAMS, check_params, simulate_indels,
+                                 make_vcf_header, format_records)
+import numpy as np
 import pysam
 
-def edit_surv_params(fn):
+def read_surv_params(fn):
     """
-    Edit the SURVIVOR simSV parameters file
+    Parse a SURVIVOR simSV parameters file
     """
     params = OrderedDict()
     with open(fn, 'r') as fh:
@@ -29,7 +37,22 @@ def edit_surv_params(fn):
             except ValueError:
                 val = data[1].strip()
             params[name] = val
-    
+    return params
+
+def write_surv_params(params, fn):
+    """
+    Write a SURVIVOR simSV parameters file
+    """
+    with open(fn, 'w') as fout:
+        for key, val in params.items():
+            fout.write(f"{key}: {val}\n")
+
+def edit_surv_params(fn):
+    """
+    Edit the SURVIVOR simSV parameters file
+    """
+    params = read_surv_params(fn)
+
     # We can control things here. 
     # might make sense to expose all of these to command line?
     params["TRANSLOCATION_number"] = 0
@@ -40,21 +63,44 @@ def edit_surv_params(fn):
     params["INDEL_minimum_length"] = 50
     params["INDEL_maximum_length"] = 1000
     params["DUPLICATION_maximum_length"] = 1000
-    with open(fn, 'w') as fout:
-        for key, val in params.items():
-            fout.write(f"{key}: {val}\n")
+    write_surv_params(params, fn)
 
-def generate_surv_params(param_file):
+class SurvivorError(Exception):
+    """
+    SURVIVOR exited non-zero. Raised instead of exiting so that pool workers hand it back to the parent
+    """
+    def __init__(self, ret_code, stderr):
+        super().__init__(ret_code, stderr)
+        self.ret_code = ret_code
+        self.stderr = stderr
+
+def check_survivor(ret):
+    """
+    Raise a SurvivorError if SURVIVOR failed
+    """
+    if ret.ret_code != 0:
+        raise SurvivorError(ret.ret_code, ret.stderr)
+
+def survivor_failed(e):
+    """
+    Log a SurvivorError and exit with SURVIVOR's return code
+    """
+    logging.error("Problem running SURVIVOR")
+    logging.error(e.stderr)
+    exit(e.ret_code)
+
+def generate_surv_params(param_file, engine="survivor"):
+    if engine == "native":
+        write_surv_params(DEFAULT_SURV_PARAMS, param_file)
+        return
     logging.debug(f"Running SURVIVOR")
     ret = cmd_exe("SURVIVOR simSV {}".format(param_file))
     logging.debug(ret.stderr)
     logging.debug(ret.stdout)
-    if ret.ret_code != 0:
-        logging.error("Problem running SURVIVOR")
-        logging.error(ret.stderr)
-        exit(ret.ret_code)
+    check_survivor(ret)
 
 def generate_regions_from_file(regions_file):
+    import pandas as pd
     regions = pd.read_csv(regions_file, sep=", ")
     region_list = []
     for index, row in regions.iterrows():
@@ -65,11 +111,8 @@ def generate_regions_from_file(regions_file):
         region_list.append((chrm, start, end))
     return region_list
 
-def verify_requested_regions(ref, num_regions, length):
-    total_regions = 0
-    for chrom in ref.references:
-        chrom_length = ref.get_reference_length(chrom)
-        total_regions = total_regions + math.floor(chrom_length/length)
+def verify_requested_regions(region_index, num_regions):
+    total_regions = sum(len(windows) for windows in region_index.values())
 
     if total_regions < num_regions:
         logging.critical("Unable to generate %d non-overlapping regions. Reference too short?", num_regions)
@@ -78,48 +121,36 @@ def verify_requested_regions(ref, num_regions, length):
     else:
         return num_regions
 
-def generate_random_regions(ref_file, region_length, num_regions):
-    def generate_region(ref, length):
-        chridx = randint(0, len(ref.references)-1)
-        chrom = ref.references[chridx]
-        chrom_length = ref.get_reference_length(chrom)
-        num_non_overlap_regions = math.floor(chrom_length/length)
-        randidx = randint(0,num_non_overlap_regions)
+def generate_random_regions(ref_file, region_length, num_regions, seed=None):
+    """
+    Sample N-free, non-overlapping regions uniformly over all valid windows of the reference,
+    which weights each chromosome by its length.
+    """
+    rand = random.Random(seed)
+    region_index = valid_windows(ref_file, region_length)
+    num_regions = verify_requested_regions(region_index, num_regions)
+    if num_regions == 0:
+        logging.error("No N-free regions of length %d in reference. Exiting", region_length)
+        exit(1)
 
-        start = randidx*length
-        end = start + length
-        return randidx, chrom, start, end
+    chroms = list(region_index.keys())
+    bounds = np.cumsum([len(region_index[chrom]) for chrom in chroms])
+    total_regions = int(bounds[-1])
 
-    ref = pysam.Fastafile(ref_file)
+    # Floyd's algorithm: num_regions draws without replacement
+    chosen = set()
+    for upper in range(total_regions - num_regions, total_regions):
+        pick = rand.randint(0, upper)
+        chosen.add(upper if pick in chosen else pick)
 
+    picks = np.array(sorted(chosen))
+    chrom_idx = np.searchsorted(bounds, picks, side="right")
+    offsets = picks - np.concatenate(([0], bounds[:-1]))[chrom_idx]
     region_list = []
-    chrom_randidx = {}
-
-    num_regions = verify_requested_regions(ref, num_regions, region_length)
-
-    # We let the while loop run for num_tries before exiting. 
-    num_tries = 2*num_regions
-    loop_count = 0
-    while len(region_list) != num_regions:
-        loop_count = loop_count + 1
-        randidx, chrom, start, end = generate_region(ref, region_length) 
-
-        # If the region contains "N", then discard this turn.
-        reg_string = ref.fetch(chrom, start, end)
-        if "N" in reg_string:
-            continue
-
-        if chrom in chrom_randidx:
-            if randidx not in chrom_randidx[chrom]:
-                region_list.append((chrom, start, end))
-                chrom_randidx[chrom].append(randidx)
-            if loop_count == num_tries:
-                logging.critical("Unable to generate %d non-overlapping regions. Tried %d times", (num_regions, num_tries))
-                logging.error("Exiting")
-                exit(1)
-        else:
-            region_list.append((chrom, start, end))
-            chrom_randidx[chrom] = [randidx]
+    for cidx, offset in zip(chrom_idx.tolist(), offsets.tolist()):
+        chrom = chroms[cidx]
+        start = int(region_index[chrom][offset]) * region_length
+        region_list.append((chrom, start, start + region_length))
 
     return region_list
 
@@ -129,105 +160,357 @@ def update_altered_fa(ref_seq, altered_ref_seq, padding):
     return begin_seq + altered_ref_seq + end_seq
 
 
-def process_regions(ref_file, regions, out_dir, param_file):
-    out_vcf_path = os.path.join(out_dir, "svteaser.sim.vcf")
-    out_ref_fa_path = os.path.join(out_dir, "svteaser.ref.fa")
-    out_altered_fa_path = os.path.join(out_dir, "svteaser.altered.fa")
-    from io import StringIO
-    out_vcf_fh = StringIO()
+def simulate_region(ref, chrom, start, end, scratch_dir, param_file, padding=800):
+    """
+    Simulate SVs over a single region with SURVIVOR.
+    Returns the region name, ref sequence, altered sequence, vcf header and vcf records (as strings)
+    """
+    logging.debug("%s %d %s", chrom, start, end)
+    # Temporary dir.
+    temp_dir = os.path.join(scratch_dir, "temp")
+    os.mkdir(temp_dir)
+
+    # Extract ref sequence.
+    name = "{}_{}_{}".format(chrom, start, end)
+    ref_seq = ref.fetch(chrom, start, end)
+
+    # Remove some buffer from beginning and ending,
+    # so that the tails do not contain SVs. These will be added
+    # back later on.
+    ref_seq_surv = ref_seq[padding:len(ref_seq)-padding]
+    # Write ref sequence to temporary fa file.
+    temp_ref_fa = os.path.join(temp_dir, "temp_ref.fa")
+    with open(temp_ref_fa, "w") as fh:
+        add_fasta_entry(name, ref_seq_surv, fh)
+
+    # Run SURVIVOR.
+    prefix = os.path.join(temp_dir, "simulated")
+    survivor_cmd = " ".join(["SURVIVOR",
+                             "simSV",
+                             temp_ref_fa,
+                             param_file,
+                             "0.0",
+                             "0",
+                             prefix])
+    with stage("survivor"):
+        ret = cmd_exe(survivor_cmd)
+    check_survivor(ret)
+
+    # Read output of SURVIVOR
+    altered_fa_path = "{}.fasta".format(prefix)
+    insertions_fa_path = "{}.insertions.fa".format(prefix)
+    sim_vcf = "{}.vcf".format(prefix)
+    # Update VCF
+    temp_vcf = os.path.join(temp_dir, "temp.vcf")
+    with stage("update_vcf"):
+        update_vcf(temp_ref_fa, insertions_fa_path, sim_vcf, temp_vcf, pos_padding=padding)
 
-    header = None
-    out_ref_fa_fh = open(out_ref_fa_path, "w+")
-    out_altered_fa_fh = open(out_altered_fa_path, "w+")
-    chr_header = None
-    ref = pysam.FastaFile(ref_file)
+    # Add the initial and last 800bp back to the altered fasta
+    altered_seq = pysam.FastaFile(altered_fa_path).fetch(name)
+    altered_seq = update_altered_fa(ref_seq, altered_seq, padding)
 
-    # Define padding in reference region where SVs are not to be inserted.
-    padding = 800
-    logging.debug("Processing regions")
-    for i, (chrom, start, end) in enumerate(regions):
-        logging.debug("%s %d %s", chrom, start, end)
-        # Track status.
-        if (i + 1) % 50 == 0:
-            logging.info("Processed {}/{} regions...".format(i + 1, len(regions)))
+    vcf_reader = pysam.VariantFile(temp_vcf)
+    header = str(vcf_reader.header)
+    records = [str(record) for record in vcf_reader]
+    vcf_reader.close()
+
+    # Remove temporary files.
+    shutil.rmtree(temp_dir)
+    return name, ref_seq, altered_seq, header, records
 
-        # Temporary dir.
-        temp_dir = os.path.join(out_dir, "temp")
-        os.mkdir(temp_dir)
+def region_rng(seed, idx):
+    """
+    Independent random generator for the idx-th region of a run, derived from the run's seed
+    """
+    return np.random.default_rng([seed, idx])
 
-        # Extract ref sequence.
+def simulate_region_native(ref, chrom, start, end, params, padding=800, rng=None):
+    """
+    Simulate SVs over a single region in-process. Same return as simulate_region
+    """
+    logging.debug("%s %d %s", chrom, start, end)
+    name = "{}_{}_{}".format(chrom, start, end)
+    ref_seq = ref.fetch(chrom, start, end)
+    altered_seq, events = simulate_indels(ref_seq, params, padding, rng)
+    header = make_vcf_header([(name, len(ref_seq))])
+    return name, ref_seq, altered_seq, header, format_records(name, events)
+
+def simulate_region_batch(ref, regions, scratch_dir, param_file, padding=800):
+    """
+    Simulate SVs over many regions with a single SURVIVOR command and a single update_vcf.
+    SURVIVOR spreads INDEL_number over every sequence it's given, so each region still gets its own simSV
+    and keeps simulate_region's per-region event counts.
+    Returns a list of simulate_region results, one per region
+    """
+    logging.debug("Batch of %d regions starting %s %d %s", len(regions), *regions[0])
+    temp_dir = os.path.join(scratch_dir, "temp")
+    os.mkdir(temp_dir)
+
+    names = []
+    ref_seqs = {}
+    survivor_cmds = []
+    for idx, (chrom, start, end) in enumerate(regions):
         name = "{}_{}_{}".format(chrom, start, end)
         ref_seq = ref.fetch(chrom, start, end)
+        names.append(name)
+        ref_seqs[name] = ref_seq
+        with open(os.path.join(temp_dir, "region_{}.fa".format(idx)), "w") as fh:
+            add_fasta_entry(name, ref_seq[padding:len(ref_seq)-padding], fh)
+        survivor_cmds.append(" ".join(["SURVIVOR", "simSV", os.path.join(temp_dir, "region_{}.fa".format(idx)),
+                                       param_file, "0.0", "0", os.path.join(temp_dir, "simulated_{}".format(idx))]))
+
+    with stage("survivor"):
+        ret = cmd_exe(" && ".join(survivor_cmds))
+    check_survivor(ret)
+
+    # Concatenate the per-region outputs so update_vcf runs once over the batch
+    temp_ref_fa = os.path.join(temp_dir, "temp_ref.fa")
+    prefix = os.path.join(temp_dir, "simulated")
+    outputs = [(temp_ref_fa, "region_{}.fa"), ("{}.fasta".format(prefix), "simulated_{}.fasta"),
+               ("{}.insertions.fa".format(prefix), "simulated_{}.insertions.fa")]
+    for out_fn, region_fn in outputs:
+        with open(out_fn, "w") as fout:
+            for idx in range(len(regions)):
+                with open(os.path.join(temp_dir, region_fn.format(idx)), "r") as fh:
+                    shutil.copyfileobj(fh, fout)
+
+    # The first region's header with every region's contig, then all the records
+    header_lines, records = [], []
+    for idx in range(len(regions)):
+        with open(os.path.join(temp_dir, "simulated_{}.vcf".format(idx)), "r") as fh:
+            for line in fh:
+                if not line.startswith("#"):
+                    records.append(line)
+                elif idx == 0 and not line.startswith("##contig="):
+                    header_lines.append(line)
+    contig_lines = ["##contig=<ID={},length={}>\n".format(name, len(ref_seqs[name]) - 2 * padding)
+                    for name in names]
+    with open("{}.vcf".format(prefix), "w") as fout:
+        fout.writelines(header_lines[:-1] + contig_lines + header_lines[-1:] + records)
+
+    temp_vcf = os.path.join(temp_dir, "temp.vcf")
+    with stage("update_vcf"):
+        update_vcf(temp_ref_fa, "{}.insertions.fa".format(prefix), "{}.vcf".format(prefix), temp_vcf,
+                   pos_padding=padding)
+
+    # Demultiplex the combined outputs back to their regions
+    altered_fa = pysam.FastaFile("{}.fasta".format(prefix))
+    vcf_reader = pysam.VariantFile(temp_vcf)
+    header_lines = str(vcf_reader.header).split('\n')
+    region_records = {name: [] for name in names}
+    for record in vcf_reader:
+        region_records[record.chrom].append(str(record))
+    vcf_reader.close()
+
+    results = []
+    for name in names:
+        altered_seq = update_altered_fa(ref_seqs[name], altered_fa.fetch(name), padding)
+        # Each region's header only keeps its own contig
+        header = "\n".join(line for line in header_lines
+                           if not line.startswith("##contig=") or line.startswith(f"##contig=<ID={name},"))
+        results.append((name, ref_seqs[name], altered_seq, header, region_records[name]))
+    altered_fa.close()
+
+    shutil.rmtree(temp_dir)
+    return results
+
+# Run settings and per-region checkpoints kept in the output directory for --resume
+JOURNAL = "surv_sim.journal.json"
+PROGRESS = "surv_sim.progress"
+
+# Per-worker state for parallel region simulation
+_WORKER = {}
+
+def _init_worker(ref_file, out_dir, param_file, padding, engine, seed):
+    """
+    Give each worker its own reference handle and scratch directory
+    """
+    _WORKER["ref"] = pysam.FastaFile(ref_file)
+    _WORKER["param_file"] = param_file
+    _WORKER["padding"] = padding
+    _WORKER["engine"] = engine
+    _WORKER["seed"] = seed
+    if engine == "native":
+        _WORKER["params"] = read_surv_params(param_file)
+    else:
+        scratch_dir = os.path.join(out_dir, "scratch_{}".format(os.getpid()))
+        os.mkdir(scratch_dir)
+        _WORKER["scratch_dir"] = scratch_dir
 
-        # Remove some buffer from beginning and ending,
-        # so that the tails do not contain SVs. These will be added
-        # back later on.
-        ref_seq_surv = ref_seq[padding:len(ref_seq)-padding]
-        # Write ref sequence to temporary fa file.
-        temp_ref_fa = os.path.join(temp_dir, "temp_ref.fa")
-        with open(temp_ref_fa, "w") as fh:
-            add_fasta_entry(name, ref_seq_surv, fh)
-
-        # Run SURVIVOR.
-        prefix = os.path.join(temp_dir, "simulated")
-        ret = cmd_exe("SURVIVOR -h")
-        survivor_cmd = " ".join(["SURVIVOR",
-                                 "simSV",
-                                 temp_ref_fa,
-                                 param_file,
-                                 "0.0",
-                                 "0",
-                                 prefix])
-        for i in range(100):
-            ret = cmd_exe(survivor_cmd)
-        ret = cmd_exe(survivor_cmd)
-        # should be checking here
-
-        # Read output of SURVIVOR
-        altered_fa_path = "{}.fasta".format(prefix)
-        insertions_fa_path = "{}.insertions.fa".format(prefix)
-        sim_vcf = "{}.vcf".format(prefix)
-        # Update VCF
-        temp_vcf = os.path.join(temp_dir, "temp.vcf")
-        update_vcf(temp_ref_fa, insertions_fa_path, sim_vcf, temp_vcf, pos_padding=padding)
+def _simulate_batch_worker(batch):
+    """
+    Pool entry point for simulate_region_batch
+    """
+    return simulate_region_batch(_WORKER["ref"], batch, _WORKER["scratch_dir"],
+                                 _WORKER["param_file"], _WORKER["padding"])
 
-        # Merge seqs and variants entries into single FA/VCF files
-        # Add the initial and last 800bp back to the altered fasta
-        altered_seq = pysam.FastaFile(altered_fa_path).fetch(name)
-        altered_seq = update_altered_fa(ref_seq, altered_seq, padding)
-        add_fasta_entry(name, altered_seq, out_altered_fa_fh)
+def _simulate_region_worker(job):
+    """
+    Pool entry point for simulate_region. job is the region's index and (chrom, start, end)
+    """
+    idx, (chrom, start, end) = job
+    if _WORKER["engine"] == "native":
+        return simulate_region_native(_WORKER["ref"], chrom, start, end, _WORKER["params"], _WORKER["padding"],
+                                      region_rng(_WORKER["seed"], idx))
+    return simulate_region(_WORKER["ref"], chrom, start, end, _WORKER["scratch_dir"],
+                           _WORKER["param_file"], _WORKER["padding"])
+
+def sim_vcf_header(region_header, ref, regions):
+    """
+    Build the output vcf header from a simulated region's header. Contigs are the simulated regions
+    followed by the reference's chromosomes
+    """
+    lines = region_header.strip().split('\n')
+    header = [line for line in lines[:-1] if not line.startswith("##contig=")]
+    for chrom, start, end in regions:
+        length = min(end, ref.get_reference_length(chrom)) - start
+        header.append(f"##contig=<ID={chrom}_{start}_{end},length={length}>")
+    for chrom in ref.references:
+        header.append(f"##contig=<ID={chrom},length={ref.get_reference_length(chrom)}>")
+    header.append(lines[-1])
+    return "\n".join(header) + "\n"
 
-        add_fasta_entry(name, ref_seq, out_ref_fa_fh)
+def read_progress(out_dir):
+    """
+    Last complete checkpoint of the progress journal.
+    Returns whether the run finished, the number of regions done and the [altered, ref, vcf, regions] byte
+    offsets the output files had at that point (None if nothing was checkpointed)
+    """
+    done, offsets = 0, None
+    path = os.path.join(out_dir, PROGRESS)
+    if not os.path.exists(path):
+        return False, done, offsets
+    with open(path, "r") as fh:
+        for line in fh:
+            if line == "finished\n":
+                return True, done, offsets
+            fields = line.split("\t")
+            # Anything after a torn write is ignored
+            if not line.endswith("\n") or len(fields) != 5:
+                break
+            done, offsets = int(fields[0]), [int(field) for field in fields[1:]]
+    return False, done, offsets
+
+def process_regions(ref_file, regions, out_dir, param_file, threads=1, engine="survivor", batch_size=1,
+                    seed=None, resume=False):
+    """
+    Simulate every region and write the combined ref/altered fastas and the sorted, indexed vcf.
+    Each finished region is checkpointed in the progress journal so that with resume a crashed run picks
+    up after the last checkpoint.
+    """
+    out_vcf_path = os.path.join(out_dir, "svteaser.sim.vcf")
+    out_ref_fa_path = os.path.join(out_dir, "svteaser.ref.fa")
+    out_altered_fa_path = os.path.join(out_dir, "svteaser.altered.fa")
+    out_regions_path = os.path.join(out_dir, REGION_EVENTS)
+    progress_path = os.path.join(out_dir, PROGRESS)
+
+    first = 0
+    offsets = None
+    if resume:
+        _, first, offsets = read_progress(out_dir)
+        # Clear out anything a crashed run left behind
+        for scratch_dir in glob.glob(os.path.join(out_dir, "scratch_*")) + glob.glob(os.path.join(out_dir, "temp")):
+            shutil.rmtree(scratch_dir)
+        logging.info("Resuming after %d/%d regions", first, len(regions))
+    if offsets is None:
+        offsets = [0, 0, 0, 0]
+        first = 0
+    # Drop whatever was written after the last checkpoint and append from there
+    out_paths = [out_altered_fa_path, out_ref_fa_path, out_vcf_path, out_regions_path]
+    for path, offset in zip(out_paths, offsets):
+        with open(path, "a") as fh:
+            fh.truncate(offset)
+    out_altered_fa_fh = open(out_altered_fa_path, "a")
+    out_ref_fa_fh = open(out_ref_fa_path, "a")
+    out_vcf_fh = open(out_vcf_path, "a")
+    out_regions_fh = open(out_regions_path, "a")
+    out_fhs = [out_altered_fa_fh, out_ref_fa_fh, out_vcf_fh, out_regions_fh]
+    with open(progress_path, "w") as fout:
+        if first:
+            fout.write("\t".join(map(str, [first] + offsets)) + "\n")
+    progress_fh = open(progress_path, "a")
+    ref = pysam.FastaFile(ref_file)
 
-        vcf_reader = pysam.VariantFile(temp_vcf)
-        if not header:
-            header = str(vcf_reader.header).split('\n')
-            chr_header = header[-2]
-            header = header[:-2]
+    # Define padding in reference region where SVs are not to be inserted.
+    padding = 800
+    logging.debug("Processing regions")
+    with stage("simulate"):
+        pool = None
+        batches = None
+        todo = regions[first:]
+        if engine == "survivor" and batch_size > 1:
+            batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        if threads > 1:
+            # Results come back in region order, so output matches a serial run
+            pool = multiprocessing.Pool(threads, initializer=_init_worker,
+                                        initargs=(ref_file, out_dir, param_file, padding, engine, seed))
+            if batches:
+                results = itertools.chain.from_iterable(pool.imap(_simulate_batch_worker, batches))
+            else:
+                results = pool.imap(_simulate_region_worker, enumerate(todo, first))
+        elif batches:
+            results = itertools.chain.from_iterable(simulate_region_batch(ref, batch, out_dir, param_file, padding)
+                                                    for batch in batches)
+        elif engine == "native":
+            params = read_surv_params(param_file)
+            results = (simulate_region_native(ref, chrom, start, end, params, padding, region_rng(seed, idx))
+                       for idx, (chrom, start, end) in enumerate(todo, first))
         else:
-            for name, ctg in vcf_reader.header.contigs.items():
-                header.append(f"##contig=<ID={name},length={ctg.length}>")
-
-        for record in vcf_reader:
-            out_vcf_fh.write(str(record))
-
+            results = (simulate_region(ref, chrom, start, end, out_dir, param_file, padding)
+                       for chrom, start, end in todo)
+
+        try:
+            for i, (name, ref_seq, altered_seq, region_header, records) in enumerate(results, first):
+                # Track status.
+                report_progress("regions", i + 1, len(regions))
+
+                # Merge seqs and variants entries into single FA/VCF files
+                add_fasta_entry(name, altered_seq, out_altered_fa_fh)
+                add_fasta_entry(name, ref_seq, out_ref_fa_fh)
+
+                if i == 0:
+                    out_vcf_fh.write(sim_vcf_header(region_header, ref, regions))
+
+                # Lift the variant positions into the reference coordinate frame as they're written
+                chrom, start, _ = regions[i]
+                for record in records:
+                    out_vcf_fh.write(lift_record(record, chrom, start))
+                # Keep how the variants shift the altered sequence for the liftover table
+                out_regions_fh.write(format_region(name, chrom, start, start + len(ref_seq),
+                                                   sorted(record_event(record) for record in records)))
+
+                # Checkpoint once the region is completely written
+                for fh in out_fhs:
+                    fh.flush()
+                progress_fh.write("\t".join(map(str, [i + 1] + [fh.tell() for fh in out_fhs])) + "\n")
+                progress_fh.flush()
+        except SurvivorError as e:
+            # Workers raise rather than exit, which would leave imap waiting on them forever
+            if pool is not None:
+                pool.terminate()
+            survivor_failed(e)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            for scratch_dir in glob.glob(os.path.join(out_dir, "scratch_*")):
+                shutil.rmtree(scratch_dir)
 
-        # Remove temporary files.
-        shutil.rmtree(temp_dir)
-
-    temp_combined_vcf = os.path.join(out_dir, "temp_combined.vcf")
-    with open(temp_combined_vcf, 'w') as fout:
-        fout.write("\n".join(header) + '\n' + chr_header + '\n')
-        out_vcf_fh.seek(0)
-        fout.write(out_vcf_fh.read())
     out_altered_fa_fh.close()
     out_ref_fa_fh.close()
+    out_regions_fh.close()
+    if not regions:
+        logging.error("No regions were simulated")
+        exit(1)
     out_vcf_fh.close()
-
-    # Re-calibrate the variant positions to be in reference coordinate frame.
-    recalibrate_vcf(ref_file, temp_combined_vcf, out_vcf_path)
-    os.remove(temp_combined_vcf)
-    vcf_compress(out_vcf_path)
+    with stage("compress_vcf"):
+        vcf_compress(out_vcf_path, threads=threads)
+    with stage("region_index"):
+        write_region_index(out_dir, OrderedDict((chrom, ref.get_reference_length(chrom))
+                                                for chrom in ref.references))
+    progress_fh.write("finished\n")
+    progress_fh.close()
+    os.remove(out_regions_path)
 
 def find_survivor():
     ret = cmd_exe("SURVIVOR -h")
@@ -240,8 +523,53 @@ def surv_sim_main(args):
     Run survivor simSV commands. Output them into a directory
     """
     args = parseArgs(args)
-    # check the SURVIVOR is in the environment
-    find_survivor()
+    start_metrics(args, "surv_sim", args.output)
+    # check the SURVIVOR is in the environment. A resumed run checks once it knows the journaled engine
+    if args.engine == "survivor" and not args.resume:
+        find_survivor()
+
+    if not args.resume:
+        # Chosen before the cache key so unseeded runs don't all share one cache entry
+        if args.seed is None:
+            args.seed = random.randint(0, 2**31 - 1)
+        logging.info(f"Using seed {args.seed}")
+
+    if args.cache and not args.resume:
+        params = {"engine": args.engine, "len_sv_region": args.len_sv_region, "batch": args.batch,
+                  "num_sv_regions": None if args.sv_regions else args.num_sv_regions, "seed": args.seed}
+        files = {"reference": args.reference, "sv_regions": args.sv_regions}
+        if args.engine == "survivor":
+            # A different SURVIVOR build makes different SVs
+            files["survivor"] = shutil.which("SURVIVOR")
+        key = cache_key(args.cache, "surv_sim", params, files)
+        cached_run(args.cache, key, args.output, lambda: run_surv_sim(args), args.cache_size * 1024**3)
+    else:
+        run_surv_sim(args)
+    logging.info("Finished")
+
+def run_surv_sim(args):
+    """
+    Simulate the SVs into the output directory
+    """
+    param_file = os.path.join(args.output, "surv_params")
+    journal_path = os.path.join(args.output, JOURNAL)
+    if args.resume:
+        if not os.path.exists(journal_path):
+            logging.error(f"No {JOURNAL} in {args.output} to resume from")
+            exit(1)
+        if read_progress(args.output)[0]:
+            logging.info(f"{args.output} is already complete")
+            return
+        with open(journal_path, "r") as fh:
+            journal = json.load(fh)
+        # The journaled run's settings win over the command line's
+        seed, engine, batch = journal["seed"], journal["engine"], journal["batch"]
+        if engine == "survivor":
+            find_survivor()
+        regions = [tuple(region) for region in journal["regions"]]
+        process_regions(args.reference, regions, args.output, param_file,
+                        threads=args.threads, engine=engine, batch_size=batch, seed=seed, resume=True)
+        return
 
     try:
         os.mkdir(args.output)
@@ -249,26 +577,39 @@ def surv_sim_main(args):
         logging.error(f"Output directory {args.output} already exists")
         exit(1)
 
+    seed = args.seed
+    if args.engine == "survivor":
+        logging.info("SURVIVOR can't be seeded. The seed only sets the regions")
+
     # Generate SURVIVOR param file
-    param_file = os.path.join(args.output, "surv_params")
-    generate_surv_params(param_file)
-    edit_surv_params(param_file)
+    with stage("surv_params"):
+        try:
+            generate_surv_params(param_file, args.engine)
+        except SurvivorError as e:
+            survivor_failed(e)
+        edit_surv_params(param_file)
+    if args.engine == "native":
+        check_params(read_surv_params(param_file))
 
     regions = None
-    if args.sv_regions:
-        # Read sv_regions file, if provided
-        regions = generate_regions_from_file(args.sv_regions)
-    elif args.num_sv_regions:
-        #Choose a random chromosome, a random region of 10kb within the chromosome
-        regions = generate_random_regions(args.reference,
-                                          args.len_sv_region,
-                                          args.num_sv_regions)
+    with stage("choose_regions"):
+        if args.sv_regions:
+            # Read sv_regions file, if provided
+            regions = generate_regions_from_file(args.sv_regions)
+        elif args.num_sv_regions:
+            #Choose a random chromosome, a random region of 10kb within the chromosome
+            regions = generate_random_regions(args.reference,
+                                              args.len_sv_region,
+                                              args.num_sv_regions,
+                                              seed)
 
     assert(regions is not None), "No regions to process. Please provide at least 1 region."
 
-    process_regions(args.reference, regions, args.output, param_file)
-
-    logging.info("Finished")
+    with open(journal_path, "w") as fout:
+        json.dump({"seed": seed, "engine": args.engine, "batch": args.batch,
+                   "regions": [[chrom, int(start), int(end)] for chrom, start, end in regions]}, fout)
+    process_regions(args.reference, regions, args.output, param_file,
+                    threads=args.threads, engine=args.engine, batch_size=args.batch, seed=seed)
 
 
 def parseArgs(args):
@@ -300,6 +641,21 @@ def parseArgs(args):
     parser.add_argument('--len_sv_region', type=int, default=10000,
                         help='The length of regions to create.',
                         required=False)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of regions to simulate in parallel (%(default)s)')
+    parser.add_argument('--engine', type=str, default="survivor", choices=["survivor", "native"],
+                        help='SV simulation engine. native simulates INS/DEL in-process (%(default)s)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Number of regions to simulate per SURVIVOR command and update_vcf. Each region still \
+                              gets INDEL_number events (%(default)s)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for choosing regions and for the native engine. Each region gets its \
+                              own seed derived from it. A random seed is picked and logged if unset')
+    parser.add_argument('--resume', action="store_true",
+                        help='Continue an interrupted run in OUT after its last completed region, \
+                              using the seed and regions it journaled')
+    add_cache_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args(args)
     args.reference = os.path.abspath(args.reference)
     args.output = args.output + ".svt"
@@ -0,0 +1,247 @@
+"""
+Run sim_reads over a grid of parameters on a pool of processes
+"""
+import os
+import json
+import time
+import shutil
+import inspect
+import logging
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from truvari import setup_logging
+
+from svteaser.read_simulator import (sim_reads_art, sim_reads_native_main, sim_reads_downsample_main,
+                                     sim_reads_dirname)
+from svteaser.metrics import stage, add_metrics_args, start_metrics
+
+MANIFEST = "sweep_manifest.json"
+# The mates every sim_reads directory holds
+MATES = ["art_illumina.simReads1.fq.gz", "art_illumina.simReads2.fq.gz"]
+
+def available_memory():
+    """
+    Bytes of memory available for new processes, or None if it can't be determined
+    """
+    try:
+        with open("/proc/meminfo", "r") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+def sweep_concurrency(max_jobs, threads, mem_per_job):
+    """
+    How many runs to schedule at once given the cpus each run uses and the memory each needs (in GB)
+    """
+    jobs = max(1, (os.cpu_count() or 1) // max(1, threads))
+    if max_jobs:
+        jobs = min(jobs, max_jobs)
+    mem = available_memory()
+    if mem is not None and mem_per_job > 0:
+        jobs = min(jobs, max(1, int(mem // (mem_per_job * 1024**3))))
+    return jobs
+
+def sweep_grid(coverages, read_lens, mean_frags, insert_sds, instruments, engine):
+    """
+    Every combination of the parameters as a list of dicts.
+    The native engine has no instrument so those points collapse into one
+    """
+    if engine == "native":
+        instruments = ["native"]
+    grid = []
+    for coverage, readlen, meanfrag, insertsd, instrument in itertools.product(coverages, read_lens, mean_frags,
+                                                                               insert_sds, instruments):
+        grid.append({"coverage": coverage, "read_len": readlen, "mean_frag": meanfrag,
+                     "insert_sd": insertsd, "instrument": instrument})
+    return grid
+
+def running_marker(workdir, outdir):
+    """
+    File a sweep writes beside a grid point's directory while it's making the reads.
+    The mates alone don't say a directory is complete since they're created as soon as the simulator starts
+    """
+    return os.path.join(workdir, ".{}.running".format(outdir))
+
+def reads_done(outdir):
+    """
+    Check a sim_reads directory holds both mates
+    """
+    return all(os.path.exists(os.path.join(outdir, mate)) for mate in MATES)
+
+def run_point(workdir, point, engine, threads, seed, compress_threads):
+    """
+    Simulate reads for one grid point, or subsample them from the point's "source" directory if it has one.
+    The point is marked running until its reads are complete. Returns the number of seconds taken
+    """
+    start = time.time()
+    marker = running_marker(workdir, point_dirname(point))
+    with open(marker, "w") as fout:
+        json.dump({key: point.get(key) for key in ["coverage", "read_len", "mean_frag", "insert_sd", "instrument",
+                                                   "source"]}, fout, indent=4)
+    if point.get("source"):
+        sim_reads_downsample_main(workdir, point["source"], point["coverage"], seed=0 if seed is None else seed,
+                                  compress_threads=compress_threads)
+    elif engine == "native":
+        sim_reads_native_main(workdir, coverage=point["coverage"], readlen=point["read_len"],
+                              meanfrag=point["mean_frag"], insertsd=point["insert_sd"], seed=seed,
+                              compress_threads=compress_threads)
+    else:
+        sim_reads_art(workdir, coverage=point["coverage"], readlen=point["read_len"], meanfrag=point["mean_frag"],
+                      insertsd=point["insert_sd"], instrument=point["instrument"], threads=threads, seed=seed,
+                      compress_threads=compress_threads)
+    os.remove(marker)
+    return time.time() - start
+
+def write_manifest(path, manifest):
+    """
+    Atomically (re)write the sweep manifest
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(manifest, fout, indent=4)
+    os.replace(tmp_path, path)
+
+def point_dirname(point):
+    """
+    The sim_reads directory of a grid point
+    """
+    return sim_reads_dirname(point["coverage"], point["read_len"], point["mean_frag"],
+                             point["insert_sd"], point["instrument"])
+
+def run_points(pool, workdir, entries, manifest, manifest_path, engine, threads, seed, compress_threads):
+    """
+    Run the entries on the pool, recording each one's result in the manifest as it finishes
+    """
+    futures = {pool.submit(run_point, workdir, entry, engine, threads, seed, compress_threads): entry
+               for entry in entries}
+    for num, future in enumerate(as_completed(futures), 1):
+        entry = futures[future]
+        try:
+            entry["seconds"] = round(future.result(), 3)
+            entry["status"] = "done"
+        except (Exception, SystemExit) as e:
+            logging.error(f"Failed {entry['directory']} ({e!r})")
+            entry["status"] = "failed"
+        write_manifest(manifest_path, manifest)
+        logging.info(f"Finished {num}/{len(entries)} grid points")
+
+def sweep(workdir, grid, engine="art", jobs=0, threads=1, mem_per_job=1.0, seed=None, compress_threads=2,
+          downsample=False):
+    """
+    Run sim_reads for every grid point that doesn't already have reads in the workdir.
+    Directories an earlier sweep left running are removed and rerun; any other existing directory is kept.
+    With downsample, only the highest coverage of each read length/fragment/instrument combination
+    is simulated and the lower coverages are subsampled from it.
+    Returns the manifest of every grid point's result
+    """
+    manifest_path = os.path.join(workdir, MANIFEST)
+    manifest = {"workdir": os.path.abspath(workdir), "engine": engine, "seed": seed, "runs": []}
+    tops = {}
+    if downsample:
+        for point in grid:
+            group = (point["read_len"], point["mean_frag"], point["insert_sd"], point["instrument"])
+            if group not in tops or point["coverage"] > tops[group]["coverage"]:
+                tops[group] = point
+
+    simulate = []
+    derive = []
+    for point in grid:
+        outdir = point_dirname(point)
+        entry = dict(point, directory=outdir, status="skipped", seconds=None)
+        manifest["runs"].append(entry)
+        if os.path.exists(running_marker(workdir, outdir)):
+            if os.path.exists(os.path.join(workdir, outdir)):
+                logging.warning(f"Removing {outdir} which an earlier sweep didn't finish")
+                shutil.rmtree(os.path.join(workdir, outdir))
+        elif os.path.exists(os.path.join(workdir, outdir)):
+            if reads_done(os.path.join(workdir, outdir)):
+                logging.info(f"Skipping {outdir} which already has reads")
+            else:
+                logging.warning(f"Skipping {outdir} which exists but is missing mates. Remove it to rerun")
+            continue
+        entry["status"] = "pending"
+        top = tops.get((point["read_len"], point["mean_frag"], point["insert_sd"], point["instrument"]))
+        if top is not None and top["coverage"] > point["coverage"]:
+            entry["source"] = point_dirname(top)
+            derive.append(entry)
+        else:
+            simulate.append(entry)
+
+    num_todo = len(simulate) + len(derive)
+    concurrency = min(sweep_concurrency(jobs, threads, mem_per_job), max(1, num_todo))
+    logging.info(f"Running {num_todo} of {len(grid)} grid points, {concurrency} at a time")
+    write_manifest(manifest_path, manifest)
+    with ProcessPoolExecutor(concurrency) as pool:
+        with stage("simulate"):
+            run_points(pool, workdir, simulate, manifest, manifest_path, engine, threads, seed, compress_threads)
+        failed = {entry["directory"] for entry in simulate if entry["status"] == "failed"}
+        for entry in derive:
+            if entry["source"] in failed:
+                logging.error(f"Failed {entry['directory']} because {entry['source']} failed")
+                entry["status"] = "failed"
+        derive = [entry for entry in derive if entry["status"] == "pending"]
+        with stage("downsample"):
+            run_points(pool, workdir, derive, manifest, manifest_path, engine, threads, seed, compress_threads)
+    write_manifest(manifest_path, manifest)
+    return manifest
+
+def sweep_main(args):
+    """
+    Simulate reads over a grid of parameters
+    """
+    args = parseArgs(args)
+    start_metrics(args, "sweep", args.workdir)
+    grid = sweep_grid(args.coverage, args.read_len, args.mean_frag, args.insert_sd, args.seq_inst, args.engine)
+    manifest = sweep(args.workdir, grid, engine=args.engine, jobs=args.jobs, threads=args.threads,
+                     mem_per_job=args.mem_per_job, seed=args.seed, compress_threads=args.compress_threads,
+                     downsample=args.downsample)
+    if any(entry["status"] == "failed" for entry in manifest["runs"]):
+        logging.error("Some grid points failed. See %s", os.path.join(args.workdir, MANIFEST))
+        exit(1)
+    logging.info("Finished")
+
+def parseArgs(args):
+    """
+    Argument parsing
+    """
+    parser = argparse.ArgumentParser(prog="sweep", description=inspect.getdoc(sweep_main),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("workdir", metavar="DIR", type=str,
+                        help="SVTeaser working directory")
+    parser.add_argument("--coverage", type=int, nargs="+", default=[10, 20, 30],
+                        help="Depths of coverage to simulate (%(default)s)")
+    parser.add_argument("--read-len", type=int, nargs="+", default=[150],
+                        help="Simulated read lengths (%(default)s)")
+    parser.add_argument("--mean-frag", type=int, nargs="+", default=[400, 600],
+                        help="Mean insert fragment lengths (%(default)s)")
+    parser.add_argument("--insert-sd", type=int, nargs="+", default=[50],
+                        help="Insert fragment length standard deviations (%(default)s)")
+    parser.add_argument("--seq-inst", type=str, nargs="+", default=["HS25"],
+                        help="Sequencing instruments (%(default)s)")
+    parser.add_argument("--engine", type=str, default="art", choices=["art", "native"],
+                        help="Read simulator (%(default)s)")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="Maximum number of grid points to run at once. Default is as many as the cpus and memory allow")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of art_illumina processes per grid point (%(default)s)")
+    parser.add_argument("--mem-per-job", type=float, default=1.0,
+                        help="Memory in GB to reserve per grid point when picking concurrency (%(default)s)")
+    parser.add_argument("--compress-threads", type=int, default=2,
+                        help="Number of threads compressing each grid point's fastqs (%(default)s)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed used for every grid point")
+    parser.add_argument("--downsample", action="store_true",
+                        help="Only simulate the highest coverage of each combination and subsample the rest from it")
+    add_metrics_args(parser)
+    args = parser.parse_args(args)
+    setup_logging()
+    return args
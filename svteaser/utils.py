@@ -3,74 +3,269 @@ Misc tools
 """
 import os
 import json
+import zlib
+import heapq
+import struct
+import logging
+import functools
+import tempfile
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import numpy as np
 import pysam
-import pandas as pd
 import truvari
 
-from acebinf import cmd_exe
+from svteaser.metrics import cmd_exe
 
-from pandas.api.types import CategoricalDtype
-SZBINTYPE = CategoricalDtype(categories=truvari.SZBINS, ordered=True)
+# pandas is imported where it's used. It's slow to import and most commands never need it
+@functools.lru_cache(maxsize=None)
+def szbintype():
+    """
+    Ordered pandas categorical of truvari's size bins
+    """
+    from pandas.api.types import CategoricalDtype
+    return CategoricalDtype(categories=truvari.SZBINS, ordered=True)
+
+def __getattr__(name):
+    """
+    SZBINTYPE is built on first access so importing this module doesn't import pandas
+    """
+    if name == "SZBINTYPE":
+        return szbintype()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def vcf_compress(fn, threads=1, max_records=500000, out_fn=None):
+    """
+    Sort/compress/index a vcf file to fn.gz and fn.gz.tbi (or out_fn and out_fn.tbi)
+    Records are sorted by header contig order then position, holding at most max_records in memory.
+    Contigs missing from the header come after those in it, in the order they first appear.
+    Larger files are sorted in chunks that are spilled to disk and merged.
+    """
+    if out_fn is None:
+        out_fn = f"{fn}.gz"
+    vcf = pysam.VariantFile(fn)
+    header = vcf.header
+    contig_order = {name: idx for idx, name in enumerate(header.contigs)}
+
+    def sort_key(rec):
+        # Contigs without a ##contig line are ordered after the header's, as they're first seen
+        return (contig_order.setdefault(rec.chrom, len(contig_order)), rec.pos)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_fn))) as temp_dir:
+        chunks = []
+        buffer = []
+        for rec in vcf:
+            buffer.append(rec)
+            if len(buffer) >= max_records:
+                buffer.sort(key=sort_key)
+                chunk_fn = os.path.join(temp_dir, f"chunk{len(chunks)}.vcf")
+                with pysam.VariantFile(chunk_fn, 'w', header=header) as fout:
+                    for chunk_rec in buffer:
+                        fout.write(chunk_rec)
+                chunks.append(chunk_fn)
+                buffer = []
+        buffer.sort(key=sort_key)
+
+        if chunks:
+            readers = [pysam.VariantFile(chunk_fn) for chunk_fn in chunks]
+            records = heapq.merge(*readers, buffer, key=sort_key)
+        else:
+            records = buffer
+
+        with pysam.VariantFile(out_fn, 'wz', header=header, threads=threads) as fout:
+            for rec in records:
+                fout.write(rec)
+    vcf.close()
+    pysam.tabix_index(out_fn, preset="vcf", force=True)
+
+
+TRUVARI_STATES = ['fp', 'fn', 'tp-base', 'tp-call']
+
+# (column, INFO field) annotations truvari only puts on true positives
+TRUVARI_TP_FIELDS = [("truscore", "TruScore"),
+                     ("seq_sim", "PctSeqSimilarity"),
+                     ("size_sim", "PctSizeSimilarity"),
+                     ("rec_overlap", "PctRecOverlap"),
+                     ("start_dist", "StartDistance"),
+                     ("end_dist", "EndDistance"),
+                     ("size_diff", "SizeDiff"),
+                     ("num_neigh", "NumNeighbors"),
+                     ("num_thresh_neigh", "NumThresholdNeighbors")]
+
+# Columnar copy of a truvari directory's variants, kept next to its summary.txt
+TRUVARI_CACHE = "svteaser.truvari.npz"
+TRUVARI_CACHE_VERSION = 1
+
+def load_truvari_state(trudir, state):
+    """
+    Read one of the truvari state vcfs into typed column arrays.
+    Non-tp states have NaN for the tp annotations. svtype holds the names of truvari's variant types
+    """
+    is_tp = 'tp' in state
+    tp_cols = {col: array('d') for col, _ in TRUVARI_TP_FIELDS}
+    svtypes = []
+    starts = array('q')
+    ends = array('q')
+    sizes = array('q')
+    nan = float('nan')
+    v = pysam.VariantFile(os.path.join(trudir, state + '.vcf.gz'))
+    for entry in v:
+        if is_tp:
+            info = entry.info
+            for col, key in TRUVARI_TP_FIELDS:
+                value = info[key]
+                tp_cols[col].append(nan if value is None else value)
+        svtype = truvari.entry_variant_type(entry)
+        svtypes.append(getattr(svtype, "name", svtype))
+        start, end = truvari.entry_boundaries(entry)
+        starts.append(start)
+        ends.append(end)
+        sizes.append(truvari.entry_size(entry))
+    v.close()
+
+    num = len(svtypes)
+    cols = {col: np.frombuffer(values, dtype=np.float64) if is_tp else np.full(num, np.nan)
+            for col, values in tp_cols.items()}
+    cols["svtype"] = svtypes
+    cols["start"] = np.frombuffer(starts, dtype=np.int64)
+    cols["end"] = np.frombuffer(ends, dtype=np.int64)
+    cols["svlen"] = np.frombuffer(sizes, dtype=np.int64)
+    return cols
+
+def svtypes_from_names(names):
+    """
+    truvari's variant type for each name stored by load_truvari_state, looking each distinct name up once
+    """
+    categories, codes = np.unique(names.astype(str), return_inverse=True)
+    members = getattr(truvari, "SV", None)
+    members = members.__members__ if members is not None else {}
+    values = np.empty(len(categories), dtype=object)
+    values[:] = [members.get(name, name) for name in categories]
+    return values[codes]
+
+def svtype_names(svtypes):
+    """
+    Names of an array of truvari variant types. The types don't sort, so tables and files use the names
+    """
+    import pandas as pd
+    codes, uniques = pd.factorize(np.asarray(svtypes, dtype=object))
+    names = np.empty(len(uniques), dtype=object)
+    names[:] = [getattr(svtype, "name", svtype) for svtype in uniques]
+    return names[codes]
+
+def sizebins(svlen):
+    """
+    truvari.get_sizebin over an array of sizes, calling it once per distinct size
+    """
+    import pandas as pd
+    dtype = szbintype()
+    sizes, inverse = np.unique(np.abs(svlen), return_inverse=True)
+    codes = dtype.categories.get_indexer([truvari.get_sizebin(int(size)) for size in sizes])
+    return pd.Categorical.from_codes(codes[inverse] if len(sizes) else np.zeros(0, dtype=int), dtype=dtype)
+
+def truvari_fingerprint(trudir):
+    """
+    Identify a truvari directory's outputs by their sizes and mtimes
+    """
+    parts = [str(TRUVARI_CACHE_VERSION)]
+    for name in [state + '.vcf.gz' for state in TRUVARI_STATES] + ["summary.txt"]:
+        stat = os.stat(os.path.join(trudir, name))
+        parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return ";".join(parts)
+
+def save_columns(path, cols, **extra):
+    """
+    Atomically write a dict of column arrays (plus extra scalar fields) to a compressed npz.
+    String columns are stored as codes into their sorted distinct values
+    """
+    data = {key: np.array(value) for key, value in extra.items()}
+    for col, values in cols.items():
+        if values.dtype == object:
+            categories, codes = np.unique(values.astype(str), return_inverse=True)
+            data[col + ".codes"] = codes.astype(np.int32)
+            data[col + ".categories"] = categories
+        else:
+            data[col] = values
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".npz.tmp")
+    with os.fdopen(fd, 'wb') as fh:
+        np.savez_compressed(fh, **data)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+def load_columns(path, skip=()):
+    """
+    Read the columns written by save_columns, leaving out the fields in skip
+    """
+    data = np.load(path, allow_pickle=False)
+    cols = {}
+    for col in data.files:
+        if col in skip or col.endswith(".categories"):
+            continue
+        if col.endswith(".codes"):
+            name = col[:-len(".codes")]
+            cols[name] = data[name + ".categories"].astype(object)[data[col]]
+        else:
+            cols[col] = data[col]
+    return cols
 
-def vcf_compress(fn):
+def load_truvari_cache(trudir):
     """
-    Run vcftools to sort/compress/index a vcf file
+    Columns from the directory's cache, or None if it's missing or stale
     """
-    ret = cmd_exe(f"vcf-sort {fn} | bgzip > {fn}.gz && tabix {fn}.gz")
+    path = os.path.join(trudir, TRUVARI_CACHE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data["fingerprint"]) != truvari_fingerprint(trudir):
+                return None
+        return load_columns(path, skip=("fingerprint",))
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Unable to read truvari cache %s (%s)", path, e)
+        return None
 
+def save_truvari_cache(trudir, cols):
+    """
+    Write the columns next to summary.txt. Skipped with a warning if the directory isn't writable
+    """
+    path = os.path.join(trudir, TRUVARI_CACHE)
+    try:
+        save_columns(path, cols, fingerprint=truvari_fingerprint(trudir))
+    except OSError as e:
+        logging.warning("Unable to write truvari cache %s (%s)", path, e)
 
-def parse_truvari_dir(trudir):
+def parse_truvari_dir(trudir, threads=4, cache=True):
     """
     creates a dataframe from all the vcfs in the Truvari directory
     loads the performance vcf
     returns vcf_dataframe, perf_dataframe
+    The state vcfs are read in parallel and the columns cached in svteaser.truvari.npz for quick reloads
     """
-    rows = []
-    for state in ['fp', 'fn', 'tp-base', 'tp-call']:
-        file = os.path.join(trudir, state + '.vcf.gz')
-        v = pysam.VariantFile(file)
-        for entry in v:  
-            truscore = entry.info['TruScore'] if 'tp' in state else ''
-            seq_sim = entry.info['PctSeqSimilarity'] if 'tp' in state else ''
-            size_sim = entry.info['PctSizeSimilarity'] if 'tp' in state else ''
-            rec_overlap = entry.info['PctRecOverlap'] if 'tp' in state else ''
-            start_dist = entry.info['StartDistance'] if 'tp' in state else ''
-            end_dist = entry.info['EndDistance'] if 'tp' in state else ''
-            size_diff = entry.info['SizeDiff'] if 'tp' in state else ''
-            num_neigh = entry.info['NumNeighbors'] if 'tp' in state else ''
-            num_thresh_neigh = entry.info['NumThresholdNeighbors'] if 'tp' in state else ''
-            rows.append([state,
-                         truscore,
-                         seq_sim,
-                         size_sim,
-                         rec_overlap,
-                         start_dist,
-                         end_dist,
-                         size_diff,
-                         num_neigh,
-                         num_thresh_neigh,
-                         truvari.entry_variant_type(entry),  
-                         truvari.entry_boundaries(entry)[0],
-                         truvari.entry_boundaries(entry)[1],
-                         truvari.entry_size(entry)])
-    df = pd.DataFrame(rows, columns=["state",
-                                     "truscore",
-                                     "seq_sim",
-                                     "size_sim",
-                                     "rec_overlap",
-                                     "start_dist",
-                                     "end_dist",
-                                     "size_diff",
-                                     "num_neigh",
-                                     "num_thresh_neigh",
-                                     "svtype",
-                                     "start", 
-                                     "end", 
-                                     "svlen"])
-    df['szbin'] = df['svlen'].apply(truvari.get_sizebin)
-    df['szbin'] = df['szbin'].astype(SZBINTYPE)
-    df["cnt"] = 1   
+    cols = load_truvari_cache(trudir) if cache else None
+    if cols is None:
+        if threads > 1:
+            with ProcessPoolExecutor(min(threads, len(TRUVARI_STATES))) as pool:
+                parts = list(pool.map(load_truvari_state, [trudir] * len(TRUVARI_STATES), TRUVARI_STATES))
+        else:
+            parts = [load_truvari_state(trudir, state) for state in TRUVARI_STATES]
+        cols = {"state": np.repeat(np.array(TRUVARI_STATES, dtype=object), [len(part["svtype"]) for part in parts])}
+        for col in parts[0]:
+            if col == "svtype":
+                cols[col] = np.array([svtype for part in parts for svtype in part[col]], dtype=object)
+            else:
+                cols[col] = np.concatenate([part[col] for part in parts])
+        if cache:
+            save_truvari_cache(trudir, cols)
+
+    import pandas as pd
+    cols["svtype"] = svtypes_from_names(cols["svtype"])
+    df = pd.DataFrame({col: cols[col] for col in ["state"] + [col for col, _ in TRUVARI_TP_FIELDS] +
+                       ["svtype", "start", "end", "svlen"]})
+    df['szbin'] = sizebins(df['svlen'].values)
+    df["cnt"] = 1
     perf = pd.DataFrame.from_dict(json.load(open(os.path.join(trudir, "summary.txt"))), orient='index')
     return df, perf.T
 
@@ -96,3 +291,221 @@ def add_fasta_entry(name, seq, fasta_fh):
     fasta_fh.write("{}\n".format(seq))
     fasta_fh.flush()
 
+
+class FastaWriter():
+    """
+    Streams line-wrapped sequences to a fasta file a chunk at a time and writes its .fai
+    index alongside as each sequence is finished.
+    """
+    def __init__(self, fn, line_width=60):
+        self.fasta_fh = open(fn, "w")
+        self.fai_fh = open(fn + ".fai", "w")
+        self.line_width = line_width
+        self.name = None
+        self.offset = 0
+        self.seq_offset = 0
+        self.length = 0
+        self.column = 0
+
+    def start(self, name):
+        """
+        Begin a new sequence, finishing the current one
+        """
+        self.finish()
+        header = ">{}\n".format(name)
+        self.fasta_fh.write(header)
+        self.offset += len(header)
+        self.name = name
+        self.seq_offset = self.offset
+        self.length = 0
+        self.column = 0
+
+    def write(self, seq):
+        """
+        Append bases to the current sequence
+        """
+        pos = 0
+        lines = []
+        # Top off the partially written line
+        if self.column:
+            pos = min(self.line_width - self.column, len(seq))
+            lines.append(seq[:pos])
+            self.column += pos
+            if self.column == self.line_width:
+                lines.append("\n")
+                self.column = 0
+        # Whole lines, then whatever is left over
+        if pos < len(seq):
+            full_end = pos + (len(seq) - pos) // self.line_width * self.line_width
+            for start in range(pos, full_end, self.line_width):
+                lines.append(seq[start:start + self.line_width])
+                lines.append("\n")
+            lines.append(seq[full_end:])
+            self.column = len(seq) - full_end
+        data = "".join(lines)
+        self.fasta_fh.write(data)
+        self.offset += len(data)
+        self.length += len(seq)
+
+    def finish(self):
+        """
+        End the current sequence and add it to the index
+        """
+        if self.name is None:
+            return
+        if self.column:
+            self.fasta_fh.write("\n")
+            self.offset += 1
+        self.fai_fh.write("{}\t{}\t{}\t{}\t{}\n".format(self.name, self.length, self.seq_offset,
+                                                        self.line_width, self.line_width + 1))
+        self.name = None
+
+    def close(self):
+        """
+        Finish the current sequence and close the files
+        """
+        self.finish()
+        self.fasta_fh.close()
+        self.fai_fh.close()
+
+# BGZF blocks hold at most 64KiB of compressed data, so input is cut a little short of that
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+def bgzf_block(data, level=6):
+    """
+    Compress data into a single BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2,
+                         len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+class BgzfWriter():
+    """
+    Writes a BGZF file, compressing its blocks on a thread pool while keeping them in order.
+    zlib releases the GIL so blocks compress in parallel. Pass a shared `executor` to let
+    several writers (e.g. both read mates) use the same threads.
+    """
+    def __init__(self, fn, threads=1, executor=None, level=6, max_pending=64):
+        self.fh = open(fn, "wb")
+        self.level = level
+        self.own_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max(1, threads))
+        self.max_pending = max(max_pending, 4 * threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        """
+        Add bytes to the file. Whole blocks are sliced out of data without copying
+        """
+        view = memoryview(data if isinstance(data, bytes) else bytes(data))
+        if self.buffer:
+            fill = BGZF_BLOCK_SIZE - len(self.buffer)
+            self.buffer += view[:fill]
+            view = view[fill:]
+            if len(self.buffer) < BGZF_BLOCK_SIZE:
+                return
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        end = len(view) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE
+        for start in range(0, end, BGZF_BLOCK_SIZE):
+            self._submit(view[start:start + BGZF_BLOCK_SIZE])
+        self.buffer += view[end:]
+
+    def _submit(self, block):
+        """
+        Queue a block for compression and write out the finished blocks at the front.
+        A full queue is drained to half so the writer waits once per several blocks
+        """
+        self.pending.append(self.executor.submit(bgzf_block, block, self.level))
+        if len(self.pending) > self.max_pending:
+            while len(self.pending) > self.max_pending // 2:
+                self.fh.write(self.pending.popleft().result())
+        while self.pending and self.pending[0].done():
+            self.fh.write(self.pending.popleft().result())
+
+    def close(self):
+        """
+        Flush the remaining blocks and write the EOF marker
+        """
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fh.write(self.pending.popleft().result())
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+        if self.own_executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def compress_fifo(fifo, out_fn, executor, chunk_size=4194304):
+    """
+    Read a named pipe until its writer closes it, compressing everything to out_fn (bgzf)
+    """
+    with open(fifo, "rb") as fh, BgzfWriter(out_fn, executor=executor) as fout:
+        while True:
+            data = fh.read(chunk_size)
+            if not data:
+                break
+            fout.write(data)
+
+class FifoCompressor():
+    """
+    Stands in named pipes at the given paths whose contents are bgzf compressed to path + ".gz"
+    while a program writes to them, so the uncompressed data never lands on disk.
+    """
+    def __init__(self, paths, threads=2):
+        self.paths = paths
+        self.executor = ThreadPoolExecutor(max(2, threads))
+        self.readers = []
+        for path in paths:
+            os.mkfifo(path)
+            reader = threading.Thread(target=compress_fifo, args=(path, path + ".gz", self.executor), daemon=True)
+            reader.start()
+            self.readers.append(reader)
+
+    def close(self):
+        """
+        Wait for the compression to finish and remove the pipes
+        """
+        for path, reader in zip(self.paths, self.readers):
+            # A reader still waiting for its writer to open the pipe (e.g. the program failed) gets EOF
+            if reader.is_alive():
+                try:
+                    os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            reader.join()
+            os.remove(path)
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def concat_bgzf(in_fns, out_fn, chunk_size=4194304):
+    """
+    Concatenate bgzf files, keeping only the final EOF marker
+    """
+    with open(out_fn, "wb") as fout:
+        for in_fn in in_fns:
+            with open(in_fn, "rb") as fh:
+                fh.seek(-len(BGZF_EOF), os.SEEK_END)
+                remaining = fh.tell() if fh.read() == BGZF_EOF else os.path.getsize(in_fn)
+                fh.seek(0)
+                while remaining:
+                    data = fh.read(min(chunk_size, remaining))
+                    fout.write(data)
+                    remaining -= len(data)
+        fout.write(BGZF_EOF)
@@ -38,6 +38,22 @@ def recalibrate_vcf(ref_path, orig_vcf_path, out_vcf_path):
             rec.pos = global_pos
             writer.write(rec)
 
+def lift_record(record, chrom, start):
+    """
+    Re-calibrate a VCF record line from region coordinates (contig chrom_start_end) to be
+    relative to original reference.
+    """
+    _, pos, rest = record.split("\t", 2)
+    if "END=" in rest:
+        fields = rest.split("\t")
+        info = fields[5].split(";")
+        for idx, item in enumerate(info):
+            if item.startswith("END="):
+                info[idx] = "END={}".format(start + int(item[4:]))
+        fields[5] = ";".join(info)
+        rest = "\t".join(fields)
+    return "{}\t{}\t{}".format(chrom, start + int(pos), rest)
+
 def correct_survivor_vcf(in_vcf):
     """
     Correct survivor vcf mistakes so it's parsable by pysam.VariantFile
@@ -103,16 +119,18 @@ def update_vcf(ref, insertions, survivor_vcf, out_vcf, pos_padding=0):
         chrom = record.chrom
         vcf_pos = record.pos # Position here is the VCF position, which is without padding.
         ref_pos = record.pos + pos_padding # Reference pos is VCF pos shifted by padding.
+        # ref is the sequence SURVIVOR was given, so it's fetched at the unpadded position.
+        # The event starts after the anchor base at vcf_pos (0-based vcf_pos - 1)
         if record.id.startswith("INS"):
             # Handle an INSERTION entry
-            record.ref = ref.fetch(chrom, ref_pos, ref_pos + 1)
+            record.ref = ref.fetch(chrom, vcf_pos - 1, vcf_pos)
             survivor_insertion_key = "{}_{}".format(chrom, vcf_pos)
             record.alts = ["{}{}".format(record.ref, insertions.fetch(survivor_insertion_key))]
         elif record.id.startswith("DEL"):
             # Handle a DELETION entry
             svlen = record.info['SVLEN']
-            record.ref = ref.fetch(chrom, ref_pos - 1, (ref_pos - 1) + svlen + 1)
-            record.alts = [ref.fetch(chrom, ref_pos - 1, ref_pos)]
+            record.ref = ref.fetch(chrom, vcf_pos - 1, vcf_pos + svlen)
+            record.alts = [ref.fetch(chrom, vcf_pos - 1, vcf_pos)]
         else: # just in case inversions or something get through
             continue
         # Update the VCF position to reflect padded sequence
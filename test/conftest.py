@@ -0,0 +1,28 @@
+"""
+Shared fixtures for the unit tests. Run from the repository root with `python -m pytest test`
+"""
+import os
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(TEST_DIR)
+sys.path.insert(0, REPO)
+
+# Stand-ins for SURVIVOR and art_illumina so the tests run without either installed
+STUBS = os.path.join(REPO, "benchmarks", "stubs")
+
+@pytest.fixture
+def chrm_fa():
+    """
+    The 16.5kb chrM reference in test/
+    """
+    return os.path.join(TEST_DIR, "chrM.fa")
+
+@pytest.fixture
+def stubs(monkeypatch):
+    """
+    Put the SURVIVOR and art_illumina stubs first in the PATH
+    """
+    monkeypatch.setenv("PATH", STUBS + os.pathsep + os.environ["PATH"])
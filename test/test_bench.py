@@ -0,0 +1,80 @@
+import random
+
+import numpy as np
+import pytest
+
+from svteaser import bench
+from svteaser.bench import seq_similarity, match_chrom
+
+PARAMS = {"refdist": 500, "pctsim": 0.7, "pctsize": 0.7, "pctovl": 0.0, "typeignore": False, "multimatch": False}
+
+def mutate(rng, seq, num):
+    """
+    seq with num random substitutions, insertions or deletions
+    """
+    seq = list(seq)
+    for _ in range(num):
+        pos = rng.randrange(len(seq))
+        op = rng.choice("sid")
+        if op == "s":
+            seq[pos] = rng.choice("ACGT")
+        elif op == "i":
+            seq.insert(pos, rng.choice("ACGT"))
+        elif len(seq) > 1:
+            del seq[pos]
+    return "".join(seq)
+
+def test_seq_similarity_fallback_matches_edlib(monkeypatch):
+    pytest.importorskip("edlib")
+    rng = random.Random(5)
+    pairs = [("ACGT", "ACGT"), ("", "ACG"), ("A", "T"), ("ACGTACGT", "TGCA")]
+    for _ in range(50):
+        seq = "".join(rng.choices("ACGT", k=rng.randint(1, 300)))
+        pairs.append((seq, mutate(rng, seq, rng.randint(0, 60))))
+    with_edlib = [seq_similarity(a, b) for a, b in pairs]
+    monkeypatch.setattr(bench, "edlib", None)
+    assert [seq_similarity(a, b) for a, b in pairs] == with_edlib
+
+def test_seq_similarity_without_edlib(monkeypatch):
+    monkeypatch.setattr(bench, "edlib", None)
+    assert seq_similarity("", "") == 1.0
+    assert seq_similarity("ACGTACGTAC", "ACGTACGTAC") == 1.0
+    assert seq_similarity("ACGTACGTAC", "ACGAACGTAC") == pytest.approx(0.9)
+    assert seq_similarity("ACGTACGTAC", "ACGTCGTAC") == pytest.approx(0.9)
+    assert seq_similarity("AAAA", "") == 0.0
+
+def variants(*rows):
+    """
+    Per-chromosome columns from (svtype, start, end, size, seq) rows
+    """
+    cols = {"svtype": [], "start": [], "end": [], "size": [], "seq": []}
+    for row in rows:
+        for col, value in zip(cols, row):
+            cols[col].append(value)
+    for col in ["start", "end", "size"]:
+        cols[col] = np.array(cols[col], dtype=np.int64)
+    return cols
+
+def test_match_chrom_best_score_first():
+    ins = "ACGT" * 25
+    base = variants(("INS", 1000, 1001, 100, ins), ("DEL", 5000, 5200, 200, None))
+    calls = variants(("INS", 1010, 1011, 100, ins[:-2] + "TT"),  # close in sequence
+                     ("INS", 1005, 1006, 100, ins),              # exact, so matched first
+                     ("DEL", 5050, 5250, 200, None),             # symbolic, no sequence to compare
+                     ("INS", 5000, 5001, 200, "A" * 200))        # wrong type
+    matches, (base_neigh, base_thresh), (call_neigh, call_thresh) = match_chrom(base, calls, PARAMS)
+    stats = {(b_idx, c_idx): stat for b_idx, c_idx, stat in matches}
+    assert sorted(stats) == [(0, 1), (1, 2)]
+    assert stats[(0, 1)]["PctSeqSimilarity"] == 1.0 and stats[(0, 1)]["StartDistance"] == -5
+    assert np.isnan(stats[(1, 2)]["PctSeqSimilarity"])
+    assert base_neigh.tolist() == [2, 2] and base_thresh.tolist() == [2, 1]
+    assert call_neigh.tolist() == [1, 1, 1, 1] and call_thresh.tolist() == [1, 1, 1, 0]
+
+def test_match_chrom_multimatch():
+    ins = "ACGT" * 25
+    base = variants(("INS", 1000, 1001, 100, ins))
+    calls = variants(("INS", 1005, 1006, 100, ins), ("INS", 1010, 1011, 100, ins))
+    matches, _, _ = match_chrom(base, calls, PARAMS)
+    assert [(b_idx, c_idx) for b_idx, c_idx, _ in matches] == [(0, 0)]
+    matches, _, _ = match_chrom(base, calls, dict(PARAMS, multimatch=True))
+    assert [(b_idx, c_idx) for b_idx, c_idx, _ in matches] == [(0, 0), (0, 1)]
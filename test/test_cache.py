@@ -0,0 +1,112 @@
+import os
+import shutil
+
+import pytest
+
+from svteaser.cache import cache_key, cached_run, cache_entry, CACHE_STAMP
+from svteaser.read_simulator import sim_reads_main
+from svteaser.surv_sim import surv_sim_main
+
+def write(path, text):
+    with open(path, "w") as fout:
+        fout.write(text)
+    return str(path)
+
+def make_output(outdir, text):
+    """
+    A run() that makes outdir holding a single file
+    """
+    def run():
+        os.mkdir(outdir)
+        write(os.path.join(outdir, "out.txt"), text)
+        runs.append(outdir)
+    runs = []
+    return run, runs
+
+def test_cache_key_inputs(tmp_path):
+    cache = str(tmp_path / "cache")
+    ref_a = write(tmp_path / "a.fa", ">chr\nACGT\n")
+    ref_b = write(tmp_path / "b.fa", ">chr\nACGT\n")
+    key = cache_key(cache, "stage", {"seed": 1}, {"ref": ref_a, "tool": None})
+    # Files are identified by their contents, not their paths
+    assert key == cache_key(cache, "stage", {"seed": 1}, {"ref": ref_b, "tool": None})
+    assert key != cache_key(cache, "stage", {"seed": 2}, {"ref": ref_a, "tool": None})
+    assert key != cache_key(cache, "other", {"seed": 1}, {"ref": ref_a, "tool": None})
+    assert key != cache_key(cache, "stage", {"seed": 1}, {"ref": ref_a, "tool": ref_b})
+    write(tmp_path / "b.fa", ">chr\nACGA\n")
+    assert key != cache_key(cache, "stage", {"seed": 1}, {"ref": ref_b, "tool": None})
+
+def test_cached_run_restores(tmp_path):
+    cache = str(tmp_path / "cache")
+    first = str(tmp_path / "first")
+    run, runs = make_output(first, "made")
+    assert not cached_run(cache, "ab" * 32, first, run, 2**30)
+    assert os.path.isdir(cache_entry(cache, "ab" * 32))
+    # The same outdir is up to date and another is restored, neither running again
+    assert cached_run(cache, "ab" * 32, first, run, 2**30)
+    second = str(tmp_path / "second")
+    assert cached_run(cache, "ab" * 32, second, make_output(second, "again")[0], 2**30)
+    assert runs == [first]
+    with open(os.path.join(second, "out.txt"), "r") as fh:
+        assert fh.read() == "made"
+    # A directory made by something else isn't overwritten
+    with pytest.raises(SystemExit):
+        cached_run(cache, "cd" * 32, first, make_output(first, "other")[0], 2**30)
+
+def test_cache_evicts_least_recent(tmp_path):
+    cache = str(tmp_path / "cache")
+    for idx, key in enumerate(["aa" * 32, "bb" * 32, "cc" * 32]):
+        outdir = str(tmp_path / f"out{idx}")
+        cached_run(cache, key, outdir, make_output(outdir, "x" * 1000)[0], 2500)
+    assert not os.path.exists(cache_entry(cache, "aa" * 32))
+    assert os.path.isdir(cache_entry(cache, "bb" * 32)) and os.path.isdir(cache_entry(cache, "cc" * 32))
+
+def make_workdir(path, chrm_fa):
+    os.mkdir(path)
+    shutil.copy(chrm_fa, os.path.join(path, "svteaser.altered.fa"))
+    return str(path)
+
+def read_stamp(workdir):
+    with open(os.path.join(workdir, "sim_reads_2_100_300_30_native", CACHE_STAMP), "r") as fh:
+        return fh.read()
+
+def test_sim_reads_cache(tmp_path, chrm_fa):
+    cache = str(tmp_path / "cache")
+    opts = ["--engine", "native", "--coverage", "2", "--read-len", "100", "--mean-frag", "300", "--insert-sd",
+            "30", "--cache", cache]
+    seeded = [make_workdir(tmp_path / f"seeded{idx}", chrm_fa) for idx in range(2)]
+    for workdir in seeded:
+        sim_reads_main([workdir, "--seed", "5"] + opts)
+    assert read_stamp(seeded[0]) == read_stamp(seeded[1])
+    # Restored entries are hard links of the cached files
+    mate = os.path.join(seeded[1], "sim_reads_2_100_300_30_native", "art_illumina.simReads1.fq.gz")
+    assert os.stat(mate).st_nlink > 1
+
+    # Unseeded runs each pick a seed, so they don't share an entry
+    unseeded = [make_workdir(tmp_path / f"unseeded{idx}", chrm_fa) for idx in range(2)]
+    for workdir in unseeded:
+        sim_reads_main([workdir] + opts)
+    assert len({read_stamp(workdir) for workdir in seeded + unseeded}) == 3
+
+def test_surv_sim_cache(tmp_path, chrm_fa, stubs, monkeypatch):
+    cache = str(tmp_path / "cache")
+    ref = str(tmp_path / "ref.fa")
+    shutil.copy(chrm_fa, ref)
+
+    def surv_sim(name, *opts):
+        surv_sim_main([ref, str(tmp_path / name), "--num_sv_regions", "4", "--len_sv_region", "2000",
+                       "--cache", cache] + list(opts))
+        with open(str(tmp_path / name) + ".svt/" + CACHE_STAMP, "r") as fh:
+            return fh.read()
+
+    key = surv_sim("first", "--seed", "3")
+    assert surv_sim("second", "--seed", "3") == key
+    assert surv_sim("unseeded") != key
+    # Another SURVIVOR build makes different SVs from the same inputs
+    other_bin = tmp_path / "bin"
+    os.mkdir(other_bin)
+    with open(shutil.which("SURVIVOR"), "r") as fh, open(other_bin / "SURVIVOR", "w") as fout:
+        fout.write(fh.read() + "# another build\n")
+    os.chmod(other_bin / "SURVIVOR", 0o755)
+    monkeypatch.setenv("PATH", str(other_bin) + os.pathsep + os.environ["PATH"])
+    assert surv_sim("rebuilt", "--seed", "3") != key
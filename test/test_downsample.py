@@ -0,0 +1,65 @@
+import os
+import gzip
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+from svteaser.downsample import downsample_reads, DOWNSAMPLE_INFO
+from svteaser.native_reads import sim_reads_native
+from svteaser.ref_index import load_ref_index, valid_windows
+
+def pair_names(outdir):
+    """
+    Read names of both mates in a sim_reads directory, checking they're in step
+    """
+    names = []
+    for mate in ["1", "2"]:
+        with gzip.open(os.path.join(outdir, f"art_illumina.simReads{mate}.fq.gz"), "rt") as fh:
+            names.append([line.rstrip()[:-2] for line in fh.read().splitlines()[0::4]])
+    assert names[0] == names[1]
+    return names[0]
+
+def test_downsample_ladder(tmp_path, chrm_fa):
+    source = str(tmp_path / "sim_reads_20_100_300_30_native")
+    os.mkdir(source)
+    sim_reads_native(chrm_fa, os.path.join(source, "art_illumina.simReads"), coverage=20, readlen=100,
+                     meanfrag=300, insertsd=30, seed=2)
+    mid = str(tmp_path / "sim_reads_10_100_300_30_native")
+    low = str(tmp_path / "sim_reads_5_100_300_30_native")
+    direct = str(tmp_path / "direct" / "sim_reads_5_100_300_30_native")
+    os.mkdir(tmp_path / "direct")
+    downsample_reads(source, mid, 10, seed=4)
+    # The low rung is the same whether it's taken from the mid rung or the source
+    downsample_reads(mid, low, 5, seed=4)
+    downsample_reads(source, direct, 5, seed=4)
+
+    top, middle, bottom = pair_names(source), pair_names(mid), pair_names(low)
+    assert set(bottom) <= set(middle) <= set(top)
+    assert bottom == pair_names(direct)
+    assert abs(len(middle) / len(top) - 0.5) < 0.1
+    assert abs(len(bottom) / len(top) - 0.25) < 0.1
+    with open(os.path.join(low, DOWNSAMPLE_INFO), "r") as fh:
+        info = json.load(fh)
+    assert info["root"]["coverage"] == 20 and info["coverage"] == 5 and info["pairs"] == len(bottom)
+
+def test_downsample_needs_lower_coverage(tmp_path, chrm_fa):
+    source = str(tmp_path / "sim_reads_5_100_300_30_native")
+    os.mkdir(source)
+    sim_reads_native(chrm_fa, os.path.join(source, "art_illumina.simReads"), coverage=5, readlen=100,
+                     meanfrag=300, insertsd=30, seed=2)
+    with pytest.raises(SystemExit):
+        downsample_reads(source, str(tmp_path / "sim_reads_5_100_300_30_native_2"), 5)
+
+def test_ref_index_reload(tmp_path, chrm_fa):
+    ref = str(tmp_path / "ref.fa")
+    shutil.copy(chrm_fa, ref)
+    built = valid_windows(ref, 1000)
+    # These come from the sidecar the first call wrote
+    index = load_ref_index(ref)
+    assert list(index["lengths"].items()) == [("chrM", 16571)]
+    assert 1000 in index["windows"]
+    loaded = valid_windows(ref, 1000)
+    assert list(built) == list(loaded)
+    assert all(np.array_equal(built[chrom], loaded[chrom]) for chrom in built)
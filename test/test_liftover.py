@@ -0,0 +1,81 @@
+import os
+import random
+import shutil
+
+import pysam
+import pytest
+
+from svteaser.surv_sim import surv_sim_main
+from svteaser.liftover import RegionLifter, liftover_vcf, REGIONS_BED
+
+@pytest.fixture
+def workdir(tmp_path, chrm_fa):
+    """
+    A native surv_sim workdir of 5 regions over a copy of chrM
+    """
+    ref = str(tmp_path / "ref.fa")
+    shutil.copy(chrm_fa, ref)
+    surv_sim_main([ref, str(tmp_path / "sim"), "--engine", "native", "--num_sv_regions", "5",
+                   "--len_sv_region", "2500", "--seed", "4"])
+    return str(tmp_path / "sim.svt")
+
+def test_lift_positions(workdir, chrm_fa):
+    reference = pysam.FastaFile(chrm_fa).fetch("chrM")
+    for frame, fasta in [("altered", "svteaser.altered.fa"), ("ref", "svteaser.ref.fa")]:
+        lifter = RegionLifter(workdir, frame)
+        regions = pysam.FastaFile(os.path.join(workdir, fasta))
+        compared = 0
+        for name in regions.references:
+            seq = regions.fetch(name)
+            lifted = [lifter.lift(name, pos) for pos in range(len(seq))]
+            for pos in range(len(seq)):
+                # Inserted bases are clamped onto their anchor, every other base lands on itself
+                if pos and lifted[pos][1] == lifted[pos - 1][1]:
+                    continue
+                assert lifted[pos][0] == "chrM"
+                assert seq[pos] == reference[lifted[pos][1]]
+                compared += 1
+        assert compared > 0.9 * sum(regions.lengths)
+    assert lifter.lift("chrX", 10) is None
+
+def test_liftover_vcf(tmp_path, workdir, chrm_fa):
+    reference = pysam.FastaFile(chrm_fa).fetch("chrM")
+    altered = pysam.FastaFile(os.path.join(workdir, "svteaser.altered.fa"))
+    lifter = RegionLifter(workdir)
+    rng = random.Random(2)
+    # Regions in reverse so the lifted records need sorting
+    names = list(altered.references[::-1])
+    in_vcf = str(tmp_path / "calls.vcf")
+    expected = []
+    with open(in_vcf, "w") as fout:
+        fout.write("##fileformat=VCFv4.2\n")
+        fout.write('##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of the SV">\n')
+        fout.write('##INFO=<ID=END,Number=1,Type=Integer,Description="End of the SV">\n')
+        for name in names + ["chrX"]:
+            length = altered.get_reference_length(name) if name != "chrX" else 1000
+            fout.write(f"##contig=<ID={name},length={length}>\n")
+        fout.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for name in names:
+            seq = altered.fetch(name)
+            for pos in sorted(rng.sample(range(len(seq) - 100), 3)):
+                chrom, ref_pos = lifter.lift(name, pos)
+                fout.write(f"{name}\t{pos + 1}\t.\t{seq[pos]}\t<DEL>\t.\tPASS\tSVTYPE=DEL;END={pos + 51}\n")
+                expected.append((chrom, ref_pos + 1, seq[pos], lifter.lift(name, pos + 50)[1] + 1))
+        fout.write("chrX\t10\t.\tA\tT\t.\tPASS\t.\n")
+
+    out_fn = str(tmp_path / "lifted.vcf.gz")
+    assert liftover_vcf(workdir, in_vcf, out_fn, batch_size=4) == (len(expected), 1)
+    with pysam.VariantFile(out_fn) as vcf:
+        assert list(vcf.header.contigs) == ["chrM", "chrX"]
+        records = list(vcf)
+        assert len(list(vcf.fetch("chrM"))) == len(expected)
+    assert [(rec.chrom, rec.pos, rec.ref, rec.stop) for rec in records[:-1]] == sorted(expected)
+    assert all(rec.ref == reference[rec.pos - 1] for rec in records[:-1])
+    assert (records[-1].chrom, records[-1].pos) == ("chrX", 10)
+
+def test_regions_bed(workdir):
+    with pysam.TabixFile(os.path.join(workdir, REGIONS_BED)) as bed:
+        rows = [row.split("\t") for row in bed.fetch()]
+    names = pysam.FastaFile(os.path.join(workdir, "svteaser.ref.fa")).references
+    assert sorted(row[3] for row in rows) == sorted(names)
+    assert all(row[3] == f"{row[0]}_{row[1]}_{row[2]}" for row in rows)
@@ -0,0 +1,49 @@
+import gzip
+
+import numpy as np
+import pysam
+
+from svteaser.native_reads import sim_reads_native
+
+def read_fastq(fn):
+    """
+    (name, seq, qual) of every record in a gzipped fastq
+    """
+    with gzip.open(fn, "rt") as fh:
+        lines = fh.read().splitlines()
+    return list(zip(lines[0::4], lines[1::4], lines[3::4]))
+
+def revcomp(seq):
+    return seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+def test_pairs_map_at_insert_size(tmp_path, chrm_fa):
+    out_path = str(tmp_path / "reads")
+    # Without errors every pair is an exact forward and reverse match around its fragment
+    total = sim_reads_native(chrm_fa, out_path, coverage=5, readlen=100, meanfrag=400, insertsd=30, seed=1,
+                             sub_start=1e-12, sub_end=1e-12, indel_rate=0, batch_size=99)
+    ref = pysam.FastaFile(chrm_fa).fetch("chrM").upper()
+    mates1 = read_fastq(out_path + "1.fq.gz")
+    mates2 = read_fastq(out_path + "2.fq.gz")
+    assert len(mates1) == len(mates2) == total == int(5 * len(ref) / 200)
+
+    inserts = []
+    for idx, ((name1, seq1, qual1), (name2, seq2, qual2)) in enumerate(zip(mates1, mates2), 1):
+        assert (name1, name2) == (f"@chrM-{idx}/1", f"@chrM-{idx}/2")
+        assert len(seq1) == len(qual1) == len(seq2) == len(qual2) == 100
+        # One mate is on the forward strand at the fragment start, the other reverse at its end
+        fwd, rev = (seq1, seq2) if ref.find(seq1) != -1 else (seq2, seq1)
+        start = ref.find(fwd)
+        end = ref.find(revcomp(rev)) + 100
+        assert start != -1 and end != 99
+        inserts.append(end - start)
+    assert abs(np.mean(inserts) - 400) < 10
+    assert abs(np.std(inserts) - 30) < 10
+
+def test_deterministic_for_seed(tmp_path, chrm_fa):
+    outputs = []
+    for run in ["a", "b", "c"]:
+        out_path = str(tmp_path / run)
+        sim_reads_native(chrm_fa, out_path, coverage=3, seed=7 if run != "c" else 8, batch_size=50)
+        outputs.append([read_fastq(out_path + mate) for mate in ["1.fq.gz", "2.fq.gz"]])
+    assert outputs[0] == outputs[1]
+    assert outputs[0] != outputs[2]
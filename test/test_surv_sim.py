@@ -0,0 +1,76 @@
+import os
+import shutil
+from collections import Counter
+
+import pysam
+import pytest
+
+from svteaser import surv_sim
+from svteaser.surv_sim import (DEFAULT_SURV_PARAMS, write_surv_params, simulate_region, simulate_region_batch,
+                               surv_sim_main)
+
+REGIONS = [("chrM", 1000, 4000), ("chrM", 4500, 7500), ("chrM", 8000, 11000), ("chrM", 12000, 15000)]
+
+def indel_params(path, number):
+    """
+    A SURVIVOR parameter file making number INS/DEL of 50-100bp per call
+    """
+    params = dict(DEFAULT_SURV_PARAMS, INDEL_number=number, INDEL_minimum_length=50, INDEL_maximum_length=100)
+    write_surv_params(params, path)
+    return path
+
+def test_batch_keeps_events_per_region(tmp_path, chrm_fa, stubs):
+    param_file = indel_params(str(tmp_path / "params"), 2)
+    ref = pysam.FastaFile(chrm_fa)
+    results = simulate_region_batch(ref, REGIONS, str(tmp_path), param_file)
+    assert [name for name, *_ in results] == ["{}_{}_{}".format(*region) for region in REGIONS]
+    assert [len(records) for *_, records in results] == [2] * len(REGIONS)
+    # Every region's records are on that region
+    for name, _, _, _, records in results:
+        assert Counter(record.split("\t")[0] for record in records) == {name: 2}
+    assert not os.path.exists(tmp_path / "temp")
+
+def test_batch_matches_single_region(tmp_path, chrm_fa, stubs):
+    param_file = indel_params(str(tmp_path / "params"), 2)
+    ref = pysam.FastaFile(chrm_fa)
+    batched = simulate_region_batch(ref, REGIONS, str(tmp_path), param_file)
+    single = [simulate_region(ref, chrom, start, end, str(tmp_path), param_file) for chrom, start, end in REGIONS]
+    for (b_name, b_ref, b_alt, _, b_records), (s_name, s_ref, s_alt, _, s_records) in zip(batched, single):
+        assert (b_name, b_ref, b_alt, b_records) == (s_name, s_ref, s_alt, s_records)
+        assert len(b_alt) != len(b_ref) or b_alt != b_ref
+
+def read_outputs(out_dir):
+    """
+    Contents of a finished run's fastas and vcf
+    """
+    contents = {}
+    for name in ["svteaser.altered.fa", "svteaser.ref.fa", "svteaser.sim.vcf"]:
+        with open(os.path.join(out_dir, name), "r") as fh:
+            contents[name] = fh.read()
+    return contents
+
+def test_resume_matches_uninterrupted(tmp_path, chrm_fa, monkeypatch):
+    ref = str(tmp_path / "ref.fa")
+    shutil.copy(chrm_fa, ref)
+    opts = ["--engine", "native", "--num_sv_regions", "6", "--len_sv_region", "2000", "--seed", "11"]
+    surv_sim_main([ref, str(tmp_path / "whole")] + opts)
+
+    # Crash while simulating the fourth region, after a torn write to the vcf
+    simulate = surv_sim.simulate_region_native
+    calls = []
+    def crash(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 4:
+            with open(str(tmp_path / "crashed.svt" / "svteaser.sim.vcf"), "a") as fout:
+                fout.write("chrM\t12")
+            raise RuntimeError("crashed")
+        return simulate(*args, **kwargs)
+    monkeypatch.setattr(surv_sim, "simulate_region_native", crash)
+    with pytest.raises(RuntimeError):
+        surv_sim_main([ref, str(tmp_path / "crashed")] + opts)
+    monkeypatch.setattr(surv_sim, "simulate_region_native", simulate)
+
+    # The journaled seed is used whatever the command line says
+    surv_sim_main([ref, str(tmp_path / "crashed"), "--resume", "--seed", "12"])
+    assert read_outputs(str(tmp_path / "crashed.svt")) == read_outputs(str(tmp_path / "whole.svt"))
+    assert surv_sim.read_progress(str(tmp_path / "crashed.svt"))[:2] == (True, 6)
@@ -0,0 +1,40 @@
+import os
+import shutil
+
+from svteaser.sweep import sweep, sweep_grid, running_marker, MATES
+
+def make_workdir(tmp_path, chrm_fa):
+    """
+    A workdir whose altered reference is chrM
+    """
+    workdir = str(tmp_path / "workdir.svt")
+    os.mkdir(workdir)
+    shutil.copy(chrm_fa, os.path.join(workdir, "svteaser.altered.fa"))
+    return workdir
+
+def test_existing_reads_are_kept(tmp_path, chrm_fa):
+    workdir = make_workdir(tmp_path, chrm_fa)
+    # Reads from plain sim_reads or an older sweep have no marker
+    outdir = os.path.join(workdir, "sim_reads_2_100_300_30_native")
+    os.mkdir(outdir)
+    for mate in MATES:
+        with open(os.path.join(outdir, mate), "w") as fout:
+            fout.write("complete")
+    manifest = sweep(workdir, sweep_grid([2], [100], [300], [30], ["HS25"], "native"), engine="native", seed=1)
+    assert [entry["status"] for entry in manifest["runs"]] == ["skipped"]
+    for mate in MATES:
+        with open(os.path.join(outdir, mate), "r") as fh:
+            assert fh.read() == "complete"
+
+def test_unfinished_point_is_rerun(tmp_path, chrm_fa):
+    workdir = make_workdir(tmp_path, chrm_fa)
+    outdir = os.path.join(workdir, "sim_reads_2_100_300_30_native")
+    os.mkdir(outdir)
+    with open(os.path.join(outdir, MATES[0]), "w") as fout:
+        fout.write("truncated")
+    open(running_marker(workdir, "sim_reads_2_100_300_30_native"), "w").close()
+    manifest = sweep(workdir, sweep_grid([2], [100], [300], [30], ["HS25"], "native"), engine="native", seed=1)
+    assert [entry["status"] for entry in manifest["runs"]] == ["done"]
+    assert not os.path.exists(running_marker(workdir, "sim_reads_2_100_300_30_native"))
+    for mate in MATES:
+        assert os.path.getsize(os.path.join(outdir, mate)) > 100
@@ -0,0 +1,70 @@
+import os
+import random
+import shutil
+
+import pandas as pd
+import pysam
+import truvari
+
+from svteaser import utils
+from svteaser.utils import parse_truvari_dir, vcf_compress, TRUVARI_CACHE
+from svteaser.aggregate import find_truvari_dirs, load_run, write_dataset, load_aggregate
+
+def test_parse_truvari_dir_cached(tmp_path):
+    trudir = str(tmp_path / "truvari")
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "results_sv_multi"), trudir)
+    df, perf = parse_truvari_dir(trudir, threads=1)
+    assert (tmp_path / "truvari" / TRUVARI_CACHE).exists()
+    cached, _ = parse_truvari_dir(trudir, threads=1)
+    pd.testing.assert_frame_equal(df, cached)
+
+    assert set(df["state"]) <= {"fp", "fn", "tp-base", "tp-call"}
+    assert int(perf["TP-base"].iloc[0]) == (df["state"] == "tp-base").sum()
+    # svtype holds truvari's variant types, as it did before the columns were cached
+    assert all(isinstance(svtype, truvari.SV) for svtype in cached["svtype"])
+    assert cached["szbin"].dtype == utils.SZBINTYPE
+
+def test_szbintype_attribute():
+    from svteaser.utils import SZBINTYPE
+    assert list(SZBINTYPE.categories) == list(truvari.SZBINS)
+    assert SZBINTYPE.ordered
+
+def test_aggregate_round_trip(tmp_path):
+    root = tmp_path / "sweep"
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "results_sv_multi"),
+                    root / "sim_reads_10_150_400_50_HS25" / "truvari")
+    runs = [load_run(str(root), trudir) for trudir in find_truvari_dirs(str(root))]
+    write_dataset(runs, str(tmp_path / "dataset"))
+    loaded = load_aggregate(str(tmp_path / "dataset"))
+    df = runs[0][0]
+    assert loaded["svtype"].tolist() == df["svtype"].tolist()
+    assert loaded["szbin"].dtype == utils.SZBINTYPE
+    counts = pd.read_csv(tmp_path / "dataset" / "counts.tsv", sep="\t")
+    assert counts["cnt"].sum() == len(df)
+    assert set(counts["svtype"]) == {svtype.name for svtype in df["svtype"]}
+
+def write_vcf(path, records):
+    """
+    A vcf whose header has chrB before chrA and no chrZ
+    """
+    with open(path, "w") as fout:
+        fout.write("##fileformat=VCFv4.2\n##contig=<ID=chrB,length=100000>\n##contig=<ID=chrA,length=100000>\n")
+        fout.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for chrom, pos in records:
+            fout.write(f"{chrom}\t{pos}\t{chrom}_{pos}\tA\tT\t.\tPASS\t.\n")
+
+def test_vcf_compress_spills_in_order(tmp_path):
+    rng = random.Random(3)
+    records = [(chrom, rng.randint(1, 99999)) for chrom in ["chrA", "chrZ", "chrB"] for _ in range(40)]
+    rng.shuffle(records)
+    in_vcf = str(tmp_path / "in.vcf")
+    write_vcf(in_vcf, records)
+    order = {"chrB": 0, "chrA": 1, "chrZ": 2}
+    expected = sorted(records, key=lambda rec: (order[rec[0]], rec[1]))
+    for max_records in [1000, 7]:
+        out_fn = str(tmp_path / f"out{max_records}.vcf.gz")
+        vcf_compress(in_vcf, max_records=max_records, out_fn=out_fn)
+        with pysam.VariantFile(out_fn) as vcf:
+            assert [(rec.chrom, rec.pos) for rec in vcf] == expected
+            assert len(list(vcf.fetch("chrZ"))) == 40
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("tmp")]
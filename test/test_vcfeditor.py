@@ -0,0 +1,50 @@
+import subprocess
+
+import pysam
+
+from svteaser.utils import add_fasta_entry
+from svteaser.surv_sim import DEFAULT_SURV_PARAMS, write_surv_params
+from svteaser.vcfeditor import update_vcf
+
+PADDING = 800
+
+def apply_records(seq, records):
+    """
+    Spike sorted, non-overlapping records into seq, checking each REF against it
+    """
+    pieces = []
+    last = 0
+    for record in records:
+        start = record.pos - 1
+        assert seq[start:start + len(record.ref)] == record.ref, f"REF mismatch at {record.pos}"
+        pieces.extend([seq[last:start], record.alts[0]])
+        last = start + len(record.ref)
+    pieces.append(seq[last:])
+    return "".join(pieces)
+
+def simulate(tmp_path, seq, number):
+    """
+    Run the SURVIVOR stub over seq with its padding trimmed, as simulate_region does.
+    Returns the updated vcf's records and the altered sequence with the padding added back
+    """
+    trimmed_fa = str(tmp_path / "trimmed.fa")
+    with open(trimmed_fa, "w") as fh:
+        add_fasta_entry("region", seq[PADDING:-PADDING], fh)
+    param_file = str(tmp_path / "params")
+    write_surv_params(dict(DEFAULT_SURV_PARAMS, INDEL_number=number, INDEL_minimum_length=20,
+                           INDEL_maximum_length=60), param_file)
+    prefix = str(tmp_path / "simulated")
+    subprocess.run(["SURVIVOR", "simSV", trimmed_fa, param_file, "0.0", "0", prefix], check=True)
+    out_vcf = str(tmp_path / "updated.vcf")
+    update_vcf(trimmed_fa, prefix + ".insertions.fa", prefix + ".vcf", out_vcf, pos_padding=PADDING)
+    altered = pysam.FastaFile(prefix + ".fasta").fetch("region")
+    return list(pysam.VariantFile(out_vcf)), seq[:PADDING] + altered + seq[-PADDING:]
+
+def test_update_vcf_alleles_match_padded_region(tmp_path, chrm_fa, stubs):
+    seq = pysam.FastaFile(chrm_fa).fetch("chrM", 2000, 6000)
+    records, altered = simulate(tmp_path, seq, 12)
+    assert len(records) == 12
+    assert {record.info["SVTYPE"] for record in records} == {"INS", "DEL"}
+    # Events right up to the trimmed sequence's ends get their alleles from the right place
+    assert all(record.ref for record in records)
+    assert apply_records(seq, records) == altered